@@ -0,0 +1,46 @@
+"""Add sqlite export format
+
+Revision ID: 3b8e5f1d6a90
+Revises: 9d4b7e2a1c58
+Create Date: 2026-10-18 22:07:42.518306
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b8e5f1d6a90'
+down_revision = '9d4b7e2a1c58'
+branch_labels = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    alter_enum('export_format', ['csv', 'parquet', 'sqlite'])
+
+
+def downgrade():
+    op.execute("UPDATE export SET format = 'csv' WHERE format = 'sqlite'")
+    alter_enum('export_format', ['csv', 'parquet'])
+
+
+def alter_enum(name, new_values):
+    """
+    Swaps the type of export.format with a new type of the same name
+
+    ``ALTER TYPE ... ADD VALUE`` cannot run inside a transaction block.
+    """
+
+    op.execute('ALTER TYPE "{0}" RENAME TO "{0}_old"'.format(name))
+
+    sa.Enum(*new_values, name=name).create(op.get_bind(), checkfirst=False)
+
+    op.execute('ALTER TABLE export ALTER COLUMN format DROP DEFAULT')
+    op.execute("""
+        ALTER TABLE export
+        ALTER COLUMN format TYPE "{0}"
+        USING format::text::"{0}"
+        """.format(name))
+    op.execute("ALTER TABLE export ALTER COLUMN format SET DEFAULT 'csv'")
+
+    op.execute('DROP TYPE "{0}_old"'.format(name))
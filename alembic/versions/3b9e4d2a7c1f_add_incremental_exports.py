@@ -0,0 +1,95 @@
+"""Add incremental exports
+
+Revision ID: 3b9e4d2a7c1f
+Revises: 5eb8bce63d7e, fa6460f5386f
+Create Date: 2026-10-18 10:12:41.402365
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b9e4d2a7c1f'
+down_revision = ('5eb8bce63d7e', 'fa6460f5386f')
+branch_labels = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column(
+        'export',
+        sa.Column(
+            'is_incremental',
+            sa.Boolean,
+            nullable=False,
+            server_default=sa.sql.false()))
+    op.alter_column('export', 'is_incremental', server_default=None)
+    op.add_column(
+        'export',
+        sa.Column('watermark', sa.DateTime(timezone=True)))
+
+    op.create_table(
+        'tombstone',
+        sa.Column('id', sa.BigInteger, primary_key=True),
+        sa.Column('table_name', sa.String, nullable=False),
+        sa.Column('key', sa.BigInteger, nullable=False),
+        sa.Column('parent_key', sa.BigInteger),
+        sa.Column(
+            'deleted_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Index(
+            'ix_tombstone_table_name_deleted_at',
+            'table_name',
+            'deleted_at'))
+
+    op.execute(r"""
+        CREATE OR REPLACE FUNCTION tombstone() RETURNS TRIGGER AS $$
+        DECLARE
+            _parent_key bigint;
+        BEGIN
+            IF tg_nargs > 0 THEN
+                EXECUTE format('SELECT ($1).%I', tg_argv[0])
+                INTO _parent_key
+                USING OLD;
+            END IF;
+
+            INSERT INTO tombstone (table_name, key, parent_key, deleted_at)
+            VALUES (
+                tg_table_name, OLD.id, _parent_key, timeofday()::timestamptz);
+
+            RETURN OLD;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+
+    op.execute(r"""
+        CREATE OR REPLACE FUNCTION tombstone_table(
+            target_table regclass,
+            parent_column text DEFAULT NULL)
+            RETURNS void AS $$
+        BEGIN
+            EXECUTE '
+                DROP TRIGGER IF EXISTS tombstone_trigger
+                ON ' || target_table || ';
+                CREATE TRIGGER tombstone_trigger
+                AFTER DELETE
+                ON ' || target_table || '
+                FOR EACH ROW EXECUTE PROCEDURE tombstone('
+                || coalesce(quote_literal(parent_column), '') || ')';
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+
+    op.execute("SELECT tombstone_table('entity', 'schema_id')")
+    for table_name in ('patient', 'enrollment', 'visit'):
+        op.execute("SELECT tombstone_table('%s')" % table_name)
+
+
+def downgrade():
+    for table_name in ('entity', 'patient', 'enrollment', 'visit'):
+        op.execute(
+            'DROP TRIGGER IF EXISTS tombstone_trigger ON %s' % table_name)
+    op.execute('DROP FUNCTION IF EXISTS tombstone_table(regclass, text)')
+    op.execute('DROP FUNCTION IF EXISTS tombstone()')
+    op.drop_table('tombstone')
+    op.drop_column('export', 'watermark')
+    op.drop_column('export', 'is_incremental')
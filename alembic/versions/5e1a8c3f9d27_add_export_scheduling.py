@@ -0,0 +1,28 @@
+"""Add export scheduling
+
+Revision ID: 5e1a8c3f9d27
+Revises: 7c2f0d9a4b1e
+Create Date: 2026-10-18 18:22:47.031554
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e1a8c3f9d27'
+down_revision = '7c2f0d9a4b1e'
+branch_labels = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('export', sa.Column('estimated_cost', sa.BigInteger))
+    op.add_column('export', sa.Column('actual_cost', sa.BigInteger))
+    op.add_column(
+        'export', sa.Column('started_at', sa.DateTime(timezone=True)))
+
+
+def downgrade():
+    op.drop_column('export', 'started_at')
+    op.drop_column('export', 'actual_cost')
+    op.drop_column('export', 'estimated_cost')
@@ -0,0 +1,29 @@
+"""Add export layout
+
+Revision ID: 6f0c2d8e4b13
+Revises: 3b8e5f1d6a90
+Create Date: 2026-10-18 23:12:56.801433
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6f0c2d8e4b13'
+down_revision = '3b8e5f1d6a90'
+branch_labels = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+export_layout = sa.Enum('wide', 'long', name='export_layout')
+
+
+def upgrade():
+    export_layout.create(op.get_bind())
+    op.add_column('export', sa.Column(
+        'layout', export_layout, nullable=False, server_default='wide'))
+
+
+def downgrade():
+    op.drop_column('export', 'layout')
+    export_layout.drop(op.get_bind())
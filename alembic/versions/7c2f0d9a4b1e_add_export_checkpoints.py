@@ -0,0 +1,24 @@
+"""Add export checkpoints
+
+Revision ID: 7c2f0d9a4b1e
+Revises: 3b9e4d2a7c1f
+Create Date: 2026-10-18 16:04:12.518903
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c2f0d9a4b1e'
+down_revision = '3b9e4d2a7c1f'
+branch_labels = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+
+
+def upgrade():
+    op.add_column('export', sa.Column('checkpoints', JSONB))
+
+
+def downgrade():
+    op.drop_column('export', 'checkpoints')
@@ -0,0 +1,29 @@
+"""Add export format
+
+Revision ID: 9d4b7e2a1c58
+Revises: 5e1a8c3f9d27
+Create Date: 2026-10-18 20:41:05.264187
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9d4b7e2a1c58'
+down_revision = '5e1a8c3f9d27'
+branch_labels = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+export_format = sa.Enum('csv', 'parquet', name='export_format')
+
+
+def upgrade():
+    export_format.create(op.get_bind())
+    op.add_column('export', sa.Column(
+        'format', export_format, nullable=False, server_default='csv'))
+
+
+def downgrade():
+    op.drop_column('export', 'format')
+    export_format.drop(op.get_bind())
@@ -0,0 +1,28 @@
+"""Add export partition
+
+Revision ID: a4d91c7e3f05
+Revises: 6f0c2d8e4b13
+Create Date: 2026-10-19 00:34:18.220917
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a4d91c7e3f05'
+down_revision = '6f0c2d8e4b13'
+branch_labels = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+export_partition = sa.Enum('site', 'study', name='export_partition')
+
+
+def upgrade():
+    export_partition.create(op.get_bind())
+    op.add_column('export', sa.Column('partition_by', export_partition))
+
+
+def downgrade():
+    op.drop_column('export', 'partition_by')
+    export_partition.drop(op.get_bind())
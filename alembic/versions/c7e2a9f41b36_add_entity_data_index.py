@@ -0,0 +1,62 @@
+"""Add entity data index
+
+Revision ID: c7e2a9f41b36
+Revises: a4d91c7e3f05
+Create Date: 2026-10-19 02:11:47.508316
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c7e2a9f41b36'
+down_revision = 'a4d91c7e3f05'
+branch_labels = None
+
+from contextlib import contextmanager
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    with _autocommit_block():
+        op.create_index(
+            'ix_entity_data',
+            'entity',
+            ['data'],
+            postgresql_using='gin',
+            postgresql_ops={'data': 'jsonb_path_ops'},
+            postgresql_concurrently=True)
+
+
+def downgrade():
+    with _autocommit_block():
+        op.drop_index(
+            'ix_entity_data', 'entity', postgresql_concurrently=True)
+
+
+@contextmanager
+def _autocommit_block():
+    """
+    Runs the index statements outside of the migration's transaction
+
+    Building the index on a large entity table takes a while, so it is
+    built concurrently so that entities can still be written meanwhile,
+    which is only possible outside of a transaction. The audit settings
+    of the migration's transaction (see ``env.py``) are restored for the
+    migrations that follow.
+    """
+    names = ['application.name', 'application.user']
+    settings = []
+
+    if not op.get_context().as_sql:
+        values = op.get_bind().execute(
+            sa.select([sa.func.current_setting(name, True) for name in names])
+        ).first()
+        settings = [(n, v) for n, v in zip(names, values) if v]
+
+    with op.get_context().autocommit_block():
+        yield
+
+    for name, value in settings:
+        op.execute(
+            sa.select([sa.func.set_config(name, value, True)]))
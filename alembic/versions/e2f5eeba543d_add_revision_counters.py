@@ -0,0 +1,63 @@
+"""Add revision counters
+
+Revision ID: e2f5eeba543d
+Revises: e5b38d0c7a21
+Create Date: 2026-10-19 09:41:13.218470
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e2f5eeba543d'
+down_revision = 'e5b38d0c7a21'
+branch_labels = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'revision',
+        sa.Column('name', sa.String, primary_key=True),
+        sa.Column('value', sa.BigInteger, nullable=False))
+
+    op.execute(r"""
+        CREATE OR REPLACE FUNCTION revise() RETURNS TRIGGER AS $$
+        BEGIN
+            INSERT INTO revision (name, value) VALUES (tg_argv[0], 1)
+            ON CONFLICT (name) DO UPDATE SET value = revision.value + 1;
+
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+
+    op.execute(r"""
+        CREATE OR REPLACE FUNCTION revise_table(
+            target_table regclass,
+            revision_name text)
+            RETURNS void AS $$
+        BEGIN
+            EXECUTE '
+                DROP TRIGGER IF EXISTS revise_trigger
+                ON ' || target_table || ';
+                CREATE TRIGGER revise_trigger
+                AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+                ON ' || target_table || '
+                FOR EACH STATEMENT EXECUTE PROCEDURE revise('
+                || quote_literal(revision_name) || ')';
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+
+    for table_name in ('schema', 'attribute', 'stratum'):
+        op.execute("SELECT revise_table('%s', 'catalog')" % table_name)
+
+
+def downgrade():
+    for table_name in ('schema', 'attribute', 'stratum'):
+        op.execute(
+            'DROP TRIGGER IF EXISTS revise_trigger ON %s' % table_name)
+    op.execute('DROP FUNCTION IF EXISTS revise_table(regclass, text)')
+    op.execute('DROP FUNCTION IF EXISTS revise()')
+    op.drop_table('revision')
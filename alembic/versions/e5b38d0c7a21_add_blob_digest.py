@@ -0,0 +1,42 @@
+"""Add blob digest
+
+Revision ID: e5b38d0c7a21
+Revises: c7e2a9f41b36
+Create Date: 2026-10-19 03:26:52.904117
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e5b38d0c7a21'
+down_revision = 'c7e2a9f41b36'
+branch_labels = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column(
+        'entity_attachment_blob', sa.Column('digest', sa.String(64)))
+    op.add_column(
+        'entity_attachment_blob', sa.Column('size', sa.BigInteger))
+    op.alter_column('entity_attachment_blob', 'content', nullable=True)
+    op.create_check_constraint(
+        'ck_entity_attachment_blob_has_content',
+        'entity_attachment_blob',
+        'content IS NOT NULL OR digest IS NOT NULL')
+    op.create_index(
+        'ix_entity_attachment_blob_digest',
+        'entity_attachment_blob',
+        ['digest'])
+
+
+def downgrade():
+    op.drop_index(
+        'ix_entity_attachment_blob_digest', 'entity_attachment_blob')
+    op.drop_constraint(
+        'ck_entity_attachment_blob_has_content', 'entity_attachment_blob')
+    # Blobs moved to the blob store need to be moved back in first
+    op.alter_column('entity_attachment_blob', 'content', nullable=False)
+    op.drop_column('entity_attachment_blob', 'size')
+    op.drop_column('entity_attachment_blob', 'digest')
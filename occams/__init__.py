@@ -52,6 +52,10 @@ def main(global_config, **settings):
     # determine if deployment is development
     settings['occams.development'] = asbool(settings.get('occams.development'))
 
+    # Maximum size of uploaded files, in bytes (unlimited if not set)
+    max_size = settings.get('studies.blob.max_size')
+    settings['studies.blob.max_size'] = int(max_size) if max_size else None
+
     config = Configurator(
         settings=settings,
         root_factory=RootFactory,
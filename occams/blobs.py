@@ -0,0 +1,163 @@
+"""
+Content-addressed storage of entity attachments
+
+Attachment files used to be stored in the ``entity_attachment_blob``
+table, which bloats the database, its WAL and its backups, and requires
+loading every file through the ORM to download it. Files are instead
+stored in a directory (``studies.blob.dir``), named after the SHA-256
+digest of their content, and the blob rows only keep the digest and size
+of their file. Identical files are only stored once.
+
+Blobs stored before this existed still have their content in the table,
+until they are moved out with ``occams_migrateblobs``.
+"""
+
+from collections import namedtuple
+import errno
+import hashlib
+import os
+import tempfile
+
+import magic
+import six
+
+
+# Number of bytes read from files at a time
+CHUNK_SIZE = 2 << 16
+
+
+StoredFile = namedtuple('StoredFile', ['digest', 'size', 'mime_type'])
+
+
+class BlobTooLarge(ValueError):
+    """
+    Raised when a file exceeds the maximum size while it is being stored
+    """
+
+    def __init__(self, max_size):
+        super(BlobTooLarge, self).__init__(
+            'File exceeds the maximum size of %d bytes' % max_size)
+        self.max_size = max_size
+
+
+class BlobStore(object):
+    """
+    Files stored in a directory, named after the digest of their content
+
+    Files are spread over two levels of sub-directories named after the
+    first digits of their digest (e.g. ``ab/cd/abcd...``), so that no
+    single directory grows too large.
+    """
+
+    def __init__(self, path):
+        """
+        Parameters:
+        path -- directory where the files are stored
+        """
+        self.path = path
+
+        try:
+            os.makedirs(self.path)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    def file_path(self, digest):
+        """
+        Returns the path of the file with the specified digest
+        """
+        return os.path.join(self.path, digest[:2], digest[2:4], digest)
+
+    def put(self, fp, max_size=None):
+        """
+        Stores the contents of a file object
+
+        The contents are streamed into a temporary file one chunk at a
+        time, hashing them and checking their size along the way, so
+        only a single chunk is ever held in memory. The MIME type is
+        sniffed from the first chunk. The temporary file is then renamed
+        after its digest, unless a file with the same contents was
+        already stored.
+
+        Parameters:
+        fp -- a readable file object, read from its current position
+        max_size -- (Optional) the maximum number of bytes to store,
+                    ``BlobTooLarge`` is raised as soon as it is exceeded
+
+        Returns:
+        A ``StoredFile`` tuple
+        """
+        digest = hashlib.sha256()
+        size = 0
+        mime_type = None
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'wb') as output:
+                while True:
+                    chunk = fp.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if mime_type is None:
+                        mime_type = magic.from_buffer(chunk, mime=True)
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        raise BlobTooLarge(max_size)
+                    digest.update(chunk)
+                    output.write(chunk)
+                output.flush()
+                os.fsync(output.fileno())
+
+            path = self.file_path(digest.hexdigest())
+
+            if os.path.exists(path):
+                os.unlink(tmp_path)
+            else:
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError as exc:
+                    if exc.errno != errno.EEXIST:
+                        raise
+                os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        if mime_type is None:
+            mime_type = magic.from_buffer(b'', mime=True)
+
+        return StoredFile(digest.hexdigest(), size, mime_type)
+
+    def save(self, blob, fp, max_size=None):
+        """
+        Stores the contents of a file object as an attachment's blob
+
+        Parameters:
+        blob -- the ``EntityAttachmentBlob`` to update
+        fp -- a readable file object
+        max_size -- (Optional) the maximum number of bytes to store
+
+        Returns:
+        A ``StoredFile`` tuple
+        """
+        stored = self.put(fp, max_size)
+        blob.digest = stored.digest
+        blob.size = stored.size
+        blob.content = None
+        return stored
+
+    def open(self, blob):
+        """
+        Opens an attachment's blob for reading
+
+        Parameters:
+        blob -- the ``EntityAttachmentBlob`` to read
+
+        Returns:
+        A binary file object
+        """
+        if blob.digest is None:
+            return six.BytesIO(blob.content)
+        return open(self.file_path(blob.digest), 'rb')
@@ -0,0 +1,254 @@
+"""
+Compiled converters between entity JSON documents and form data
+
+Loading and saving a form used to walk the schema's attributes for every
+entity, sorting them and checking each attribute's type and section along
+the way. A schema version's attributes are instead compiled once into a
+flat list of fields, each with its own converter, and the compiled codec
+is reused for every entity of that version.
+
+Codecs of published versions are cached by schema id. Drafts are still
+being edited, so they are compiled every time. Published versions can
+still be corrected by any process (e.g. in the web application while the
+codec is cached by another worker), so every lookup first checks a cheap
+summary of the version's attributes and choices (see ``_revision``), and
+the codec is only compiled again when the summary changed. The cached
+codec of a schema is also discarded whenever its attributes or choices
+are changed in this process.
+
+Encoded values are written as patches of only the keys that changed (see
+``write_data``), so saving a large form does not rewrite its document.
+"""
+
+from collections import namedtuple
+from datetime import date, datetime
+from decimal import Decimal
+from itertools import chain
+
+from dateutil.parser import parse as dateutil_parse
+from six import iteritems
+import sqlalchemy as sa
+from sqlalchemy import orm
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm.attributes import set_committed_value
+
+from . import models
+
+
+Field = namedtuple('Field', ['name', 'parent', 'type', 'decode', 'encode'])
+
+
+_cache = {}
+
+
+class Codec(object):
+    """
+    The fields of a schema version in form order
+    """
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+
+    def decode(self, entity):
+        """
+        Converts an entity's data into nested form data
+
+        Sections are nested dictionaries of their attributes' values.
+        """
+        document = entity.data or {}
+        data = {}
+
+        for field in self.fields:
+            if field.parent is None:
+                target = data
+            else:
+                target = data.setdefault(field.parent, {})
+            value = document.get(field.name)
+            if value is not None and field.decode is not None:
+                value = field.decode(entity, value)
+            target[field.name] = value
+
+        return data
+
+    def encode(self, field, value):
+        """
+        Converts a form value into its JSON representation
+        """
+        if value is not None and field.encode is not None:
+            value = field.encode(value)
+        return value
+
+
+def get_codec(schema):
+    """
+    Returns the compiled codec of a schema version
+
+    Parameters:
+    schema -- the ``Schema`` version whose data will be converted
+
+    Returns:
+    A ``Codec`` instance
+    """
+    if schema.id is None or schema.publish_date is None:
+        return compile_codec(schema)
+
+    revision = _revision(schema)
+
+    try:
+        cached_revision, codec = _cache[schema.id]
+    except KeyError:
+        cached_revision = None
+
+    if cached_revision != revision:
+        codec = compile_codec(schema)
+        _cache[schema.id] = (revision, codec)
+
+    return codec
+
+
+def compile_codec(schema):
+    """
+    Compiles the fields of a schema version
+    """
+    return Codec(
+        Field(
+            attribute.name,
+            attribute.parent_attribute and attribute.parent_attribute.name,
+            attribute.type,
+            DECODERS.get(attribute.type),
+            ENCODERS.get(attribute.type))
+        for attribute in schema.iterleafs())
+
+
+def invalidate(schema_id=None):
+    """
+    Discards the cached codec of a schema, or all of them
+    """
+    if schema_id is None:
+        _cache.clear()
+    else:
+        _cache.pop(schema_id, None)
+
+
+def _revision(schema):
+    """
+    Summarizes the attributes and choices of a schema version
+
+    Attributes and choices are not necessarily changed along with their
+    schema, so their own latest modification times are checked as well.
+    Row counts catch deletions.
+    """
+    Attribute = models.Attribute
+    Choice = models.Choice
+    summary = (
+        orm.object_session(schema)
+        .query(
+            sa.func.count(sa.distinct(Attribute.id)),
+            sa.func.max(Attribute.modified_at),
+            sa.func.count(Choice.id),
+            sa.func.max(Choice.modified_at))
+        .select_from(Attribute)
+        .outerjoin(Choice, Choice.attribute_id == Attribute.id)
+        .filter(Attribute.schema_id == schema.id)
+        .one())
+    return (schema.modified_at,) + tuple(summary)
+
+
+def write_data(session, entity, values):
+    """
+    Writes the changed values of an entity's JSON document
+
+    Only the keys whose values actually changed are written. Entities
+    that are already stored are patched in place with a single ``||``
+    update of the changed keys, rather than rewriting the whole document,
+    and are not updated at all if nothing changed.
+
+    Parameters:
+    session -- the database session
+    entity -- the entity to update
+    values -- the new values, keyed by attribute name
+    """
+    document = entity.data or {}
+    changes = dict(
+        (name, value) for name, value in iteritems(values)
+        if name not in document or document[name] != value)
+
+    if not changes:
+        return
+
+    data = dict(document)
+    data.update(changes)
+
+    state = sa.inspect(entity)
+
+    # Documents that are not stored yet (or already being rewritten)
+    # cannot be patched
+    if (entity.data is None
+            or not state.persistent
+            or state.attrs.data.history.has_changes()):
+        entity.data = data
+        return
+
+    entity.data = models.Entity.data.op('||')(sa.literal(changes, JSONB))
+    session.flush()
+
+    # The patched column is expired by the update, which would otherwise
+    # reload the entire document as soon as it is accessed
+    set_committed_value(entity, 'data', data)
+
+
+def parse_date(value):
+    """
+    Parses a stored date, with a fast path for ISO dates
+    """
+    if len(value) == 10 and value[4] == value[7] == '-':
+        try:
+            return date(int(value[:4]), int(value[5:7]), int(value[8:]))
+        except ValueError:
+            pass
+    return dateutil_parse(value).date()
+
+
+def parse_datetime(value):
+    """
+    Parses a stored datetime, with a fast path for ``str(datetime)``
+    """
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return dateutil_parse(value)
+
+
+DECODERS = {
+    'number': lambda entity, value: Decimal(value),
+    'date': lambda entity, value: parse_date(value),
+    'datetime': lambda entity, value: parse_datetime(value),
+    'blob': lambda entity, value: entity.attachments.get(value),
+}
+
+
+ENCODERS = {
+    'number': str,
+    'date': str,
+    'datetime': str,
+}
+
+
+def _changed_schema_ids(session):
+    changed = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, models.Choice):
+            obj = obj.attribute
+        if isinstance(obj, models.Attribute):
+            obj = obj.schema
+        if isinstance(obj, models.Schema):
+            changed.add(obj.id)
+    return changed
+
+
+@sa.event.listens_for(orm.Session, 'after_flush')
+def _invalidate_on_flush(session, flush_context):
+    for schema_id in _changed_schema_ids(session):
+        invalidate(schema_id)
@@ -5,7 +5,14 @@ This module does the actual heavy-lifting wereas the others just
 offer an interface (gui or cli, etc)
 """
 
+from contextlib import closing
 import inspect
+import io
+import struct
+import sys
+import time
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+import zlib
 
 try:
     import unicodecsv as csv
@@ -18,9 +25,12 @@ except ImportError:  # pragma: nocover
 
 from pyramid.config import aslist
 from pyramid.path import DottedNameResolver
+import six
+import sqlalchemy as sa
 
 from .. import log
-from . import codebook
+from . import codebook, columnar, database, partition
+from .cache import PlanCache  # NOQA
 
 from .pid import PidPlan
 from .enrollment import EnrollmentPlan
@@ -31,6 +41,26 @@ from .schema import SchemaPlan
 plans = [PidPlan, EnrollmentPlan, VisitPlan, SchemaPlan.list_all]
 
 
+# Default number of rows to fetch at a time when streaming results
+FETCH_SIZE = 10000
+
+# Approximate number of bytes generated at a time when streaming files
+CHUNK_SIZE = 64 * 1024
+
+# Number of rows written between progress reports
+PROGRESS_ROWS = 1000
+
+# File listing the rows deleted since the last incremental export
+TOMBSTONES_FILE_NAME = 'tombstones.csv'
+
+# Formats data files can be generated in, where ``sqlite`` generates a
+# single database instead of one file per plan
+FORMATS = ('csv', 'parquet', 'sqlite')
+
+# Layouts of form data files, either one row per form or one row per value
+LAYOUTS = ('wide', 'long')
+
+
 def list_all(dbsession, include_rand=True, include_private=True):
     """
     Lists all available data files
@@ -64,23 +94,172 @@ def list_all(dbsession, include_rand=True, include_private=True):
     return all
 
 
-def write_data(buffer, query):
+def available_formats():
     """
-    Dumps a query to a CSV file using the specified buffer
-    Each record in the query is accessed as a `namedtuple`.
+    Lists the data file formats supported by the installed packages
+    """
+    return [f for f in FORMATS if f != 'parquet' or columnar.is_available()]
+
+
+def data_file_name(plan, format='csv'):
+    """
+    Returns the name of a plan's data file in the specified format
+    """
+    if format == 'parquet':
+        return plan.name + columnar.FILE_EXTENSION
+    return plan.file_name
+
 
-    See `namedtuple`.
+def write_data(buffer, query, fetch_size=None, progress=None):
+    """
+    Dumps a query to a CSV file using the specified buffer
+    Each record in the query is written as-is from its result tuple.
 
     Arguments:
     buffer -- a file object which will be used to write data contents
     query -- SQLAlchemy query that will be writen to a CSV file.
              Note that the column names will be used as the header.
+    fetch_size -- (Optional) Streams the results through a server-side
+                  cursor, fetching this many rows at a time. This keeps
+                  memory usage flat regardless of the size of the result.
+                  (default: if None, all results are buffered by the driver)
+    progress -- (Optional) callable that is passed the number of rows
+                written since it was last called, every ``PROGRESS_ROWS``
+                rows and once done
+
+    Returns:
+    The number of rows written, not including the header
     """
     fieldnames = [d['name'] for d in query.column_descriptions]
-    writer = csv.DictWriter(buffer, fieldnames=fieldnames)
-    writer.writeheader()
-    writer.writerows(r._asdict() for r in query)
+    writer = csv.writer(buffer)
+    writer.writerow(fieldnames)
+    if fetch_size:
+        query = query.yield_per(fetch_size)
+    rows = 0
+    for row in query:
+        writer.writerow(row)
+        rows += 1
+        if progress is not None and not rows % PROGRESS_ROWS:
+            progress(PROGRESS_ROWS)
     buffer.flush()
+    if progress is not None:
+        progress(rows % PROGRESS_ROWS)
+    return rows
+
+
+def copy_data(buffer, query, progress=None):
+    """
+    Dumps a query to a CSV file using PostgreSQL's ``COPY ... TO STDOUT``
+
+    The query is executed entirely by the database server and the CSV
+    output is piped straight into the buffer, so individual rows are never
+    loaded into Python. Values are formatted to match ``write_data`` so
+    either backend produces the same file.
+
+    Falls back to ``write_data`` for databases other than PostgreSQL.
+
+    Arguments:
+    buffer -- a binary file object which will be used to write data contents
+    query -- SQLAlchemy query that will be writen to a CSV file.
+             Note that the column names will be used as the header.
+    progress -- (Optional) callable that is passed the number of rows
+                written since it was last called, every ``PROGRESS_ROWS``
+                rows and once done
+
+    Returns:
+    The number of rows written, not including the header
+    """
+    connection = query.session.connection()
+
+    if connection.dialect.name != 'postgresql':
+        return write_data(buffer, query, progress=progress)
+
+    subquery = query.subquery()
+    select = sa.select([_copy_column(c) for c in subquery.c])
+    compiled = select.compile(dialect=connection.dialect)
+
+    cursor = connection.connection.cursor()
+    try:
+        sql = cursor.mogrify(six.text_type(compiled), compiled.params)
+        if isinstance(sql, six.binary_type):
+            sql = sql.decode(connection.connection.encoding)
+        cursor.copy_expert(
+            u'COPY ({}) TO STDOUT WITH CSV HEADER'.format(sql),
+            _CopyWriter(buffer, progress))
+        rows = cursor.rowcount
+    finally:
+        cursor.close()
+
+    buffer.flush()
+    if progress is not None:
+        progress(rows % PROGRESS_ROWS)
+    return rows
+
+
+def _copy_column(column):
+    """
+    Formats a column the same way Python's CSV writer would
+    """
+    type_ = column.type
+
+    if isinstance(type_, sa.Boolean):
+        value = sa.case([(column, u'True'), (~column, u'False')])
+
+    elif isinstance(type_, sa.DateTime):
+        # PostgreSQL trims trailing fractional zeros and offset minutes,
+        # whereas Python uses the full ISO format
+        value = (
+            sa.func.to_char(column, u'YYYY-MM-DD HH24:MI:SS')
+            + sa.case(
+                [(sa.func.to_char(column, u'US') != u'000000',
+                  u'.' + sa.func.to_char(column, u'US'))],
+                else_=u'')
+            + (sa.func.to_char(column, u'TZH:TZM')
+               if type_.timezone else u''))
+
+    elif isinstance(type_, sa.String):
+        # COPY quotes empty strings to distinguish them from NULL
+        value = sa.func.nullif(column, u'')
+
+    else:
+        value = column
+
+    return value.label(column.name)
+
+
+class _CopyWriter(object):
+    """
+    Adapts the ``COPY`` output stream to the CSV writer's line terminator
+
+    ``COPY`` terminates records with LF whereas Python's CSV writer uses CRLF.
+    Line breaks within values are always quoted, so only the line breaks
+    outside of quotes need to be replaced.
+
+    The driver writes one record at a time, so records are also counted
+    here for progress reports.
+    """
+
+    def __init__(self, buffer, progress=None):
+        self.buffer = buffer
+        self.progress = progress
+        self.quoted = False
+        # The header is the first record
+        self.rows = -1
+
+    def write(self, data):
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        parts = data.split(b'"')
+        for i, part in enumerate(parts):
+            if i > 0:
+                self.quoted = not self.quoted
+            if not self.quoted:
+                parts[i] = part.replace(b'\n', b'\r\n')
+        self.buffer.write(b'"'.join(parts))
+        if self.progress is not None:
+            self.rows += 1
+            if self.rows and not self.rows % PROGRESS_ROWS:
+                self.progress(PROGRESS_ROWS)
 
 
 def write_codebook(buffer, rows):
@@ -103,3 +282,209 @@ def write_codebook(buffer, rows):
         writer.writerow(row)
 
     buffer.flush()
+
+
+def write_manifest(buffer, partitions, format='csv'):
+    """
+    Lists the data files of partitioned plans in a CSV file
+
+    Arguments:
+    buffer -- a file object which will be used to write data contents
+    partitions -- the partitions, see ``occams.exports.partition.split``
+    format -- (Optional) the format of the data files
+    """
+    writer = csv.writer(buffer)
+    writer.writerow(partition.MANIFEST_HEADER)
+
+    for item in partitions:
+        writer.writerow([
+            item.parent.name,
+            item.by,
+            item.key or partition.UNASSIGNED,
+            data_file_name(item, format)])
+
+    buffer.flush()
+
+
+def iter_data(query, fetch_size=FETCH_SIZE, chunk_size=CHUNK_SIZE):
+    """
+    Generates a query's CSV file in chunks as rows come off the cursor
+
+    The header is generated before the query is even executed, so the
+    first chunk is available right away. Results are always streamed
+    through a server-side cursor, so memory usage stays flat.
+
+    Arguments:
+    query -- SQLAlchemy query that will be writen to a CSV file.
+             Note that the column names will be used as the header.
+    fetch_size -- (Optional) number of rows to fetch at a time
+    chunk_size -- (Optional) approximate number of bytes per chunk
+
+    Returns:
+    An iterator of byte strings
+    """
+    buffer = _StreamBuffer()
+    writer = csv.writer(buffer)
+    writer.writerow([d['name'] for d in query.column_descriptions])
+    yield buffer.drain()
+
+    for row in query.yield_per(fetch_size):
+        writer.writerow(row)
+        if buffer.size >= chunk_size:
+            yield buffer.drain()
+
+    if buffer.size:
+        yield buffer.drain()
+
+
+def iter_archive(plans, options, codebook_rows=None, fetch_size=FETCH_SIZE,
+                 compression=ZIP_DEFLATED):
+    """
+    Generates a zip archive of several data files in chunks
+
+    Each data file is compressed into the archive as its rows come off
+    the cursor, without any intermediate file.
+
+    Arguments:
+    plans -- the plans whose data files to include
+    options -- the options to generate the data files with
+    codebook_rows -- (Optional) codebook rows to include in the archive
+    fetch_size -- (Optional) number of rows to fetch at a time
+    compression -- (Optional) compression method of the archive members
+
+    Returns:
+    An iterator of byte strings
+    """
+    buffer = _StreamBuffer()
+
+    with closing(ZipFile(buffer, 'w', compression, allowZip64=True)) as zfp:
+        for plan in plans:
+            with open_member(zfp, plan.file_name) as fp:
+                for chunk in iter_data(plan.data(**options), fetch_size):
+                    fp.write(chunk)
+                    if buffer.size:
+                        yield buffer.drain()
+
+        if codebook_rows is not None:
+            with open_member(zfp, codebook.FILE_NAME) as fp:
+                write_codebook(fp, codebook_rows)
+
+    yield buffer.drain()
+
+
+def open_member(zfp, name):
+    """
+    Opens a new member of a zip archive for writing
+
+    The size of the member is not known in advance, so it is always
+    allowed to grow past the ZIP64 limit. Members can only be written
+    directly by zipfile as of Python 3.6, earlier versions use
+    ``_MemberWriter`` instead.
+
+    Parameters:
+    zfp -- the ``ZipFile`` to add the member to
+    name -- the name of the member
+
+    Returns:
+    A writable binary file object
+    """
+    if sys.version_info >= (3, 6):
+        return zfp.open(name, 'w', force_zip64=True)
+    return _MemberWriter(zfp, name)
+
+
+class _MemberWriter(io.BufferedIOBase):
+    """
+    Writes a zip archive member as a stream of data
+
+    The member's CRC and sizes are written in a data descriptor after its
+    data, the same way zipfile writes members as of Python 3.6, so the
+    archive's file never needs to be seeked.
+    """
+
+    # Signature of data descriptors
+    signature = 0x08074b50
+
+    def __init__(self, zfp, name):
+        self.zfp = zfp
+        self.zinfo = zinfo = ZipInfo(name, time.localtime(time.time())[:6])
+        zinfo.compress_type = zfp.compression
+        zinfo.external_attr = 0o600 << 16
+        zinfo.flag_bits |= 0x08
+        zinfo.CRC = zinfo.file_size = zinfo.compress_size = 0
+        zinfo.header_offset = zfp.fp.tell()
+
+        if zinfo.compress_type == ZIP_DEFLATED:
+            level = getattr(zfp, 'compresslevel', None)
+            if level is None:
+                level = zlib.Z_DEFAULT_COMPRESSION
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        else:
+            self.compressor = None
+
+        zfp._writecheck(zinfo)
+        zfp._didModify = True
+        zfp.fp.write(zinfo.FileHeader(True))
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        zinfo = self.zinfo
+        size = len(data)
+        zinfo.file_size += size
+        zinfo.CRC = zlib.crc32(data, zinfo.CRC) & 0xffffffff
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        zinfo.compress_size += len(data)
+        self.zfp.fp.write(data)
+        return size
+
+    def close(self):
+        if self.closed:
+            return
+        zinfo = self.zinfo
+        if self.compressor is not None:
+            data = self.compressor.flush()
+            zinfo.compress_size += len(data)
+            self.zfp.fp.write(data)
+        self.zfp.fp.write(struct.pack(
+            '<LLQQ', self.signature,
+            zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+        self.zfp.filelist.append(zinfo)
+        self.zfp.NameToInfo[zinfo.filename] = zinfo
+        # The central directory is written after the last member
+        self.zfp.start_dir = self.zfp.fp.tell()
+        super(_MemberWriter, self).close()
+
+
+class _StreamBuffer(object):
+    """
+    Collects written data until it is drained
+
+    The buffer cannot be seeked, so zip archives written to it use data
+    descriptors instead of going back to update their member headers.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
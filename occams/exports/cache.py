@@ -0,0 +1,187 @@
+"""
+Content-addressed cache of generated data files
+
+Generating a plan's data file is by far the most expensive part of an
+export, yet most exports request the same files with the same options
+while the underlying data rarely changes. Files are cached under a key
+derived from everything that affects their contents, so unchanged files
+can be linked into new exports instead of being queried again.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from .. import log
+
+
+class PlanCache(object):
+    """
+    A size-bounded directory of generated plan data files
+    """
+
+    # Redis hash with the cache's hit/miss counters
+    redis_key = 'export:cache'
+
+    def __init__(self, path, max_size, redis=None):
+        """
+        Parameters:
+        path -- directory where the cached files are stored
+        max_size -- maximum total size of the cached files, in bytes
+        redis -- (Optional) redis connection for keeping hit/miss counters
+        """
+        self.path = path
+        self.max_size = max_size
+        self.redis = redis
+
+        try:
+            os.makedirs(self.path)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    def key(self, plan, options):
+        """
+        Generates the cache key of a plan's data file
+
+        The key is the file's name in the cache: the digest of its contents
+        (see ``plan_key``) followed by the extension of its format.
+        """
+        extension = options.get('format', 'csv')
+        return '%s.%s' % (plan_key(plan, options), extension)
+
+    def get(self, key, path):
+        """
+        Places a cached file at the specified path, if available
+
+        Returns:
+        True if the file was found in the cache
+        """
+        cached_path = self._path(key)
+
+        try:
+            link_file(cached_path, path)
+        except (IOError, OSError) as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            self._count('misses')
+            return False
+
+        # Recently used files are the last to be evicted
+        os.utime(cached_path, None)
+        self._count('hits')
+        return True
+
+    def open(self, key):
+        """
+        Opens a cached file for reading, if available
+
+        Returns:
+        A binary file object, or None if the file is not in the cache
+        """
+        cached_path = self._path(key)
+
+        try:
+            fp = open(cached_path, 'rb')
+        except (IOError, OSError) as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            self._count('misses')
+            return None
+
+        # Recently used files are the last to be evicted
+        os.utime(cached_path, None)
+        self._count('hits')
+        return fp
+
+    def put(self, key, path):
+        """
+        Adds a generated file to the cache, evicting old files if needed
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        os.close(fd)
+        os.unlink(tmp_path)
+        link_file(path, tmp_path)
+        os.rename(tmp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used files until the cache fits its size
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.tmp'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                continue
+            total -= size
+            self._count('evictions')
+            log.debug('Evicted {} from export cache'.format(name))
+
+    def stats(self):
+        """
+        Returns the cache's counters
+        """
+        if self.redis is None:
+            return {}
+        return dict(
+            (k, int(v)) for k, v in self.redis.hgetall(self.redis_key).items())
+
+    def _path(self, key):
+        return os.path.join(self.path, key)
+
+    def _count(self, counter):
+        if self.redis is not None:
+            self.redis.hincrby(self.redis_key, counter)
+
+
+def plan_key(plan, options):
+    """
+    Generates a key that identifies the contents of a plan's data file
+
+    Parameters:
+    plan -- the plan to generate the key for
+    options -- the options the data file is generated with, including
+               the file ``format`` unless it is the default CSV
+
+    Returns:
+    A hex digest string
+    """
+    data_options = dict(
+        (k, v) for k, v in options.items() if k != 'format')
+    content = json.dumps({
+        'name': plan.name,
+        'options': options,
+        'versions': [str(v) for v in plan.versions],
+        'fingerprint': plan.fingerprint(**data_options),
+    }, sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def link_file(src, dst):
+    """
+    Hard-links a file, falling back to a copy across file systems
+    """
+    try:
+        os.link(src, dst)
+    except OSError as exc:
+        if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copyfile(src, dst)
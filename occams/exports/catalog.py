@@ -0,0 +1,151 @@
+"""
+Catalog of the schemata available for export
+
+Listing schema plans requires inspecting every version of every schema,
+which is needed by almost every export page and task. The catalog
+summarizes all schemata in a single grouped query and keeps the result in
+memory until the schemata change.
+
+Schemata can be published, retracted or randomized by any process (e.g.
+in the web application while the catalog is cached by a Celery worker), so
+every read first checks the ``catalog`` revision counter, which triggers
+on the tables the catalog is built from increment (see ``_revision``), and
+the catalog is only queried again when the counter changed. Changes made
+through the ORM in this process also invalidate the catalog as soon as
+they are committed.
+"""
+
+from collections import namedtuple
+from itertools import chain
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from .. import models
+
+
+SchemaInfo = namedtuple(
+    'SchemaInfo', ['name', 'title', 'has_private', 'has_rand', 'versions'])
+
+
+_cache = {}
+
+
+def list_schemata(dbsession):
+    """
+    Lists the published schemata
+
+    Sessions with uncommitted changes to the schemata always query the
+    database directly, so that they see their own changes without leaking
+    them to other sessions.
+
+    Parameters:
+    dbsession -- the database session
+
+    Returns:
+    A list of ``SchemaInfo`` tuples, one for each published schema name
+    """
+    if dbsession.info.get('catalog_changed') or _has_changes(dbsession):
+        return _query_schemata(dbsession)
+
+    key = str(dbsession.get_bind().url)
+    revision = _revision(dbsession)
+    cached = _cache.get(key)
+
+    if cached is None or cached[0] != revision:
+        cached = _cache[key] = (revision, _query_schemata(dbsession))
+
+    return cached[1]
+
+
+def invalidate():
+    """
+    Discards the cached catalogs
+    """
+    _cache.clear()
+
+
+def _revision(dbsession):
+    """
+    Returns the revision of the tables the catalog is built from
+
+    The counter is incremented by every statement that changes a schema,
+    an attribute or a stratum (publishing or retracting a schema updates
+    its row, and randomizing a patient updates the assigned stratum). It
+    is a single row, read by its primary key, and it only changes once
+    the change is committed, however late.
+    """
+    return (
+        dbsession.query(models.Revision.value)
+        .filter_by(name=u'catalog')
+        .scalar())
+
+
+def _query_schemata(dbsession):
+    Schema = models.Schema
+
+    is_published = (
+        (Schema.publish_date != sa.null())
+        & (Schema.retract_date == sa.null()))
+
+    private_ids = (
+        sa.select([models.Attribute.schema_id])
+        .where(models.Attribute.is_private))
+
+    rand_ids = (
+        sa.select([models.Entity.schema_id])
+        .select_from(
+            sa.join(
+                models.Entity, models.Context,
+                models.Context.entity_id == models.Entity.id)
+            .join(
+                models.Stratum,
+                models.Context.key == models.Stratum.id))
+        .where(models.Context.external == u'stratum'))
+
+    query = (
+        dbsession.query(
+            Schema.name,
+            sa.func.array_agg(
+                aggregate_order_by(Schema.title, Schema.publish_date.desc())
+            ).filter(is_published),
+            sa.func.bool_or(Schema.id.in_(private_ids)),
+            sa.func.bool_or(Schema.id.in_(rand_ids)),
+            sa.func.array_agg(
+                aggregate_order_by(Schema.publish_date, Schema.publish_date)
+            ).filter(is_published))
+        .group_by(Schema.name)
+        .having(sa.func.bool_or(is_published)))
+
+    return [
+        SchemaInfo(name, titles[0], has_private, has_rand, sorted(versions))
+        for name, titles, has_private, has_rand, versions in query]
+
+
+def _affects_catalog(obj):
+    if isinstance(obj, models.Context):
+        return obj.external == u'stratum'
+    return isinstance(obj, (models.Schema, models.Attribute, models.Stratum))
+
+
+def _has_changes(session):
+    changed = chain(session.new, session.dirty, session.deleted)
+    return any(_affects_catalog(obj) for obj in changed)
+
+
+@sa.event.listens_for(orm.Session, 'after_flush')
+def _track_changes(session, flush_context):
+    if _has_changes(session):
+        session.info['catalog_changed'] = True
+
+
+@sa.event.listens_for(orm.Session, 'after_commit')
+def _invalidate_on_commit(session):
+    if session.info.pop('catalog_changed', False):
+        invalidate()
+
+
+@sa.event.listens_for(orm.Session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('catalog_changed', None)
@@ -2,6 +2,12 @@
 Code Book Utilities
 """
 
+import errno
+import hashlib
+import json
+import os
+import tempfile
+
 # Convenience header for passing to csv's dictrow function
 HEADER = [
     'table',
@@ -24,6 +30,9 @@ HEADER = [
 # File name for the generated codebook
 FILE_NAME = 'codebook.csv'
 
+# Directory name for the pre-cooked codebooks of each plan
+STORE_DIR_NAME = 'codebooks'
+
 
 class types:
     """
@@ -81,3 +90,86 @@ def row(
         'choices':        sorted(choices, key=lambda c: int(c[0])),
         'order':          order
     }
+
+
+class CodebookStore(object):
+    """
+    Pre-cooked codebook rows, stored separately for each plan
+
+    Generating a codebook requires inspecting every attribute of every
+    version of a plan's schemata, but the result only changes when new
+    versions are published. Each plan's rows are stored as a JSON file
+    named after the plan's codebook fingerprint, so they are only rebuilt
+    for plans that have actually changed.
+    """
+
+    def __init__(self, path):
+        """
+        Parameters:
+        path -- directory where the codebook files are stored
+        """
+        self.path = path
+
+        try:
+            os.makedirs(self.path)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    def get(self, plan):
+        """
+        Returns a plan's codebook rows, generating them only if needed
+        """
+        path = self._path(plan)
+
+        try:
+            with open(path) as fp:
+                rows = json.load(fp)
+        except (IOError, OSError) as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            rows = self._build(plan, path)
+
+        for row in rows:
+            row['choices'] = [tuple(c) for c in row['choices']]
+
+        return rows
+
+    def rows(self, plans):
+        """
+        Returns an iterator of the codebook rows of several plans
+        """
+        for plan in plans:
+            for row in self.get(plan):
+                yield row
+
+    def _build(self, plan, path):
+        rows = []
+        for row in plan.codebook():
+            if row['publish_date'] is not None:
+                row['publish_date'] = row['publish_date'].isoformat()
+            rows.append(row)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(rows, fp)
+        os.rename(tmp_path, path)
+
+        # Remove rows of previous versions of the plan
+        prefix = plan.name + '.'
+        for name in os.listdir(self.path):
+            if (name.startswith(prefix)
+                    and name.count('.') == 2
+                    and os.path.join(self.path, name) != path):
+                try:
+                    os.unlink(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+        # Return a copy the same way it would've been loaded from disk
+        return json.loads(json.dumps(rows))
+
+    def _path(self, plan):
+        content = json.dumps(plan.codebook_fingerprint(), sort_keys=True)
+        digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, '%s.%s.json' % (plan.name, digest))
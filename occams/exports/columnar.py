@@ -0,0 +1,244 @@
+"""
+Typed columnar data files
+
+CSV files lose the type of every value, so every consumer has to parse
+them from text and infer their types all over again. Data files can
+instead be written as Parquet, a compressed columnar format that R (via
+the ``arrow`` package) and pandas load natively, with the column types
+taken from the plan's codebook.
+
+Requires the optional ``pyarrow`` package.
+"""
+
+import six
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: nocover
+    pa = pq = None
+
+from .codebook import types
+
+
+# Extension of Parquet data files
+FILE_EXTENSION = '.parquet'
+
+# Compression codec of the column chunks
+COMPRESSION = 'zstd'
+
+# Number of rows buffered into each row group. Larger groups compress
+# better, at the cost of holding more rows in memory.
+ROW_GROUP_SIZE = 50000
+
+
+def is_available():
+    """
+    Returns True if Parquet files can be written
+    """
+    return pa is not None
+
+
+def arrow_type(row):
+    """
+    Maps a codebook row to the type of its column
+
+    Collections are joined into a single string, so they are kept as
+    strings. Choices are dictionary-encoded, since they only have a few
+    distinct values (R and pandas load them as factors/categoricals).
+    """
+    type_ = row['type']
+
+    if row.get('is_collection'):
+        return pa.string()
+    elif type_ == types.BOOLEAN:
+        return pa.bool_()
+    elif type_ == types.CHOICE:
+        return pa.dictionary(pa.int32(), pa.string())
+    elif type_ == types.DATE:
+        return pa.date32()
+    elif type_ == types.DATETIME:
+        return pa.timestamp('us', tz='UTC')
+    elif type_ == types.TIME:
+        return pa.time64('us')
+    elif type_ == types.NUMBER:
+        if row.get('decimal_places') == 0:
+            return pa.int64()
+        return pa.float64()
+    else:
+        return pa.string()
+
+
+def column_types(codebook_rows, ignore_private=True):
+    """
+    Maps the fields of a plan's codebook to the types of their columns
+
+    A plan's codebook has a row per field for every version of the form,
+    and all of them end up in the same column. Numbers are only written as
+    integers if every version has no decimal places, and fields whose
+    versions disagree on their type are written as strings.
+
+    Arguments:
+    codebook_rows -- the codebook rows of a plan
+    ignore_private -- (Optional) whether private fields were de-identified,
+                      in which case they are written as strings
+
+    Returns:
+    A dictionary of arrow types, keyed by field name
+    """
+    rows_by_field = {}
+    for row in codebook_rows:
+        rows_by_field.setdefault(row['field'], []).append(row)
+
+    types_by_field = {}
+
+    for field, rows in six.iteritems(rows_by_field):
+        found = set(arrow_type(row) for row in rows)
+
+        if ignore_private and any(row.get('is_private') for row in rows):
+            type_ = pa.string()
+        elif len(found) == 1:
+            type_ = found.pop()
+        elif found == set([pa.int64(), pa.float64()]):
+            type_ = pa.float64()
+        else:
+            type_ = pa.string()
+
+        types_by_field[field] = type_
+
+    return types_by_field
+
+
+def write_parquet(buffer, query, codebook_rows, fetch_size=None,
+                  progress=None, ignore_private=True):
+    """
+    Dumps a query to a Parquet file using the specified buffer
+
+    Arguments:
+    buffer -- a binary file object which will be used to write data contents
+    query -- SQLAlchemy query that will be writen to a Parquet file.
+             Note that the column names will be used as the field names.
+    codebook_rows -- the codebook rows of the query's plan, which
+                     determine the type of each column (see
+                     ``column_types``). Columns that are not in the
+                     codebook are written as strings.
+    fetch_size -- (Optional) number of rows to fetch at a time
+                  (default: a row group at a time)
+    progress -- (Optional) callable that is passed the number of rows
+                written since it was last called, every row group and
+                once done
+    ignore_private -- (Optional) whether the query de-identifies private
+                      fields, default: True (as plans do)
+
+    Returns:
+    The number of rows written
+    """
+    if not is_available():
+        raise RuntimeError('Parquet files require the pyarrow package')
+
+    types_by_field = column_types(codebook_rows, ignore_private)
+    schema = pa.schema([
+        pa.field(d['name'], types_by_field.get(d['name'], pa.string()))
+        for d in query.column_descriptions])
+
+    writer = pq.ParquetWriter(_Sink(buffer), schema, compression=COMPRESSION)
+    rows = 0
+    batch = []
+
+    try:
+        for row in query.yield_per(fetch_size or ROW_GROUP_SIZE):
+            batch.append(row)
+            if len(batch) >= ROW_GROUP_SIZE:
+                writer.write_table(_table(schema, batch))
+                rows += len(batch)
+                if progress is not None:
+                    progress(len(batch))
+                batch = []
+
+        if batch:
+            writer.write_table(_table(schema, batch))
+            rows += len(batch)
+
+    finally:
+        writer.close()
+
+    buffer.flush()
+    if progress is not None:
+        progress(len(batch))
+    return rows
+
+
+def _table(schema, rows):
+    """
+    Converts a batch of result rows to a table of the specified schema
+    """
+    columns = []
+    for i, field in enumerate(schema):
+        values = _coerce(field.type, [row[i] for row in rows])
+        if pa.types.is_dictionary(field.type):
+            column = pa.array(values, pa.string()).dictionary_encode()
+        else:
+            column = pa.array(values, field.type)
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def _coerce(type_, values):
+    """
+    Converts database values to what the column type expects
+
+    Values extracted from JSON documents are not always of the type their
+    codebook claims (e.g. numbers come back as ``Decimal`` and booleans
+    as integers).
+    """
+    if pa.types.is_string(type_) or pa.types.is_dictionary(type_):
+        convert = six.text_type
+    elif pa.types.is_boolean(type_):
+        convert = bool
+    elif pa.types.is_floating(type_):
+        convert = float
+    elif pa.types.is_integer(type_):
+        convert = _integer
+    else:
+        return values
+    return [None if v is None else convert(v) for v in values]
+
+
+def _integer(value):
+    """
+    Converts a whole number to an integer, refusing to truncate fractions
+    """
+    integer = int(value)
+    if not isinstance(value, six.string_types) and integer != value:
+        raise ValueError('Not a whole number: {}'.format(value))
+    return integer
+
+
+class _Sink(object):
+    """
+    Adapts a file object to the output stream interface of pyarrow
+
+    Archive members and tees cannot be seeked, so only the position is
+    tracked.
+    """
+
+    closed = False
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.position = 0
+
+    def write(self, data):
+        self.buffer.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        self.buffer.flush()
+
+    def close(self):
+        # The buffer belongs to the caller
+        pass
@@ -0,0 +1,189 @@
+"""
+Single-file SQLite database exports
+
+A zip of CSV files has to be loaded file by file before any of its data
+can be joined. Exports can instead be written as one SQLite database,
+with a table per plan, column types taken from each plan's codebook,
+the codebook itself as a table, and the columns that data files are
+usually joined on already indexed.
+"""
+
+from datetime import date, datetime, time
+from decimal import Decimal
+import sqlite3
+
+import six
+
+from . import codebook
+from .codebook import types
+
+
+# Name of the database in an export archive
+FILE_NAME = 'export.sqlite'
+
+# Name of the table the codebook is loaded into
+CODEBOOK_TABLE = 'codebook'
+
+# Name of the table the rows deleted since the last incremental export are
+# loaded into
+TOMBSTONES_TABLE = 'tombstones'
+
+# Number of rows inserted at a time
+BATCH_SIZE = 10000
+
+# Columns that are indexed in every table that has them
+INDEXED_COLUMNS = ('id', 'pid', 'visit_id')
+
+_INTEGER_CODEBOOK_COLUMNS = (
+    'is_required', 'is_system', 'is_collection', 'is_private',
+    'decimal_places', 'order')
+
+
+def connect(path):
+    """
+    Opens a database for loading
+
+    Each table is loaded in a transaction of its own, so the database is
+    consistent at the end of every table and the rollback journal is all
+    that is needed to recover from an interrupted one.
+    """
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA synchronous = NORMAL')
+    return connection
+
+
+def sqlite_type(row):
+    """
+    Maps a codebook row to the type of its column
+
+    SQLite has no date/time types, so those are stored as ISO strings,
+    which sort in chronological order and are understood by SQLite's
+    date and time functions.
+    """
+    type_ = row['type']
+
+    if row.get('is_collection'):
+        return 'TEXT'
+    elif type_ == types.BOOLEAN:
+        return 'INTEGER'
+    elif type_ == types.NUMBER:
+        if row.get('decimal_places') == 0:
+            return 'INTEGER'
+        return 'REAL'
+    else:
+        return 'TEXT'
+
+
+def load_table(connection, name, query, codebook_rows, fetch_size=None,
+               progress=None):
+    """
+    Loads a query into a table, replacing the table if it already exists
+
+    Rows are inserted in batches of ``BATCH_SIZE`` and the table is
+    indexed only once all rows are in, all in a single transaction.
+
+    Arguments:
+    connection -- the database connection (see ``connect``)
+    name -- the name of the table
+    query -- SQLAlchemy query whose results will be loaded.
+             Note that the column names will be used as the column names.
+    codebook_rows -- the codebook rows of the query's plan, which
+                     determine the type of each column. Columns that are
+                     not in the codebook are stored as text.
+    fetch_size -- (Optional) number of rows to fetch at a time
+                  (default: a batch at a time)
+    progress -- (Optional) callable that is passed the number of rows
+                loaded since it was last called, every batch and once done
+
+    Returns:
+    The number of rows loaded
+    """
+    rows_by_field = dict((row['field'], row) for row in codebook_rows)
+    columns = [
+        (d['name'], sqlite_type(rows_by_field[d['name']])
+         if d['name'] in rows_by_field else 'TEXT')
+        for d in query.column_descriptions]
+
+    insert = 'INSERT INTO {} VALUES ({})'.format(
+        _quote(name), ', '.join('?' for _ in columns))
+    rows = 0
+    batch = []
+
+    with connection:
+        _create_table(connection, name, columns)
+
+        for row in query.yield_per(fetch_size or BATCH_SIZE):
+            batch.append(tuple(_adapt(v) for v in row))
+            if len(batch) >= BATCH_SIZE:
+                connection.executemany(insert, batch)
+                rows += len(batch)
+                if progress is not None:
+                    progress(len(batch))
+                batch = []
+
+        if batch:
+            connection.executemany(insert, batch)
+            rows += len(batch)
+
+        _create_indexes(connection, name, [c for c, _ in columns])
+
+    if progress is not None:
+        progress(len(batch))
+    return rows
+
+
+def load_codebook(connection, rows):
+    """
+    Loads codebook rows into the codebook table
+
+    Choices are joined the same way as in the codebook file.
+    """
+    columns = [
+        (c, 'INTEGER' if c in _INTEGER_CODEBOOK_COLUMNS else 'TEXT')
+        for c in codebook.HEADER]
+
+    def values(row):
+        row = dict(row)
+        row['choices'] = ';'.join(
+            '%s=%s' % c for c in (row['choices'] or []))
+        return tuple(_adapt(row.get(c)) for c, _ in columns)
+
+    with connection:
+        _create_table(connection, CODEBOOK_TABLE, columns)
+        connection.executemany(
+            'INSERT INTO {} VALUES ({})'.format(
+                _quote(CODEBOOK_TABLE), ', '.join('?' for _ in columns)),
+            (values(row) for row in rows))
+
+
+def _create_table(connection, name, columns):
+    connection.execute('DROP TABLE IF EXISTS {}'.format(_quote(name)))
+    connection.execute('CREATE TABLE {} ({})'.format(
+        _quote(name),
+        ', '.join('{} {}'.format(_quote(c), t) for c, t in columns)))
+
+
+def _create_indexes(connection, name, columns):
+    for column in INDEXED_COLUMNS:
+        if column in columns:
+            connection.execute('CREATE INDEX {} ON {} ({})'.format(
+                _quote('ix_{}_{}'.format(name, column)),
+                _quote(name),
+                _quote(column)))
+
+
+def _quote(identifier):
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+
+def _adapt(value):
+    """
+    Converts database values to what SQLite can store
+    """
+    if isinstance(value, (date, datetime, time)):
+        return value.isoformat()
+    elif isinstance(value, Decimal):
+        return float(value)
+    elif isinstance(value, six.binary_type):
+        return value.decode('utf-8')
+    return value
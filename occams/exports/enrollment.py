@@ -17,6 +17,8 @@ class EnrollmentPlan(ExportPlan):
 
     title = _(u'Enrollments')
 
+    tombstone_table = 'enrollment'
+
     def codebook(self):
 
         return iter([
@@ -49,7 +51,8 @@ class EnrollmentPlan(ExportPlan):
     def data(self,
              use_choice_labels=False,
              expand_collections=False,
-             ignore_private=True):
+             ignore_private=True,
+             layout='wide'):
         session = self.dbsession
         query = (
             session.query(
@@ -77,3 +80,10 @@ class EnrollmentPlan(ExportPlan):
                       models.Study.title,
                       models.Patient.pid))
         return query
+
+    def joined_tables(self):
+        return [
+            models.Patient.__table__,
+            models.Study.__table__,
+            models.Site.__table__,
+        ]
@@ -0,0 +1,155 @@
+"""
+Site- and study-sharded data files
+
+A plan's data file for a form collected at many sites can be huge, and
+it is generated by a single query. Plans can instead be split into one
+data file per site (or per study the patients are enrolled in), so that
+each partition is generated on its own, possibly in parallel with the
+others, and consumers only have to fetch the partitions they need.
+"""
+
+from copy import copy
+
+from sqlalchemy import orm
+
+from .. import models
+from .plan import ExportPlan
+
+
+# Ways plans can be partitioned
+PARTITIONS = ('site', 'study')
+
+# Partition of the rows that do not belong to any site/study
+UNASSIGNED = '_unassigned'
+
+# File listing the partitions of an export
+MANIFEST_FILE_NAME = 'manifest.csv'
+
+# Columns of the manifest
+MANIFEST_HEADER = ['table', 'partition_by', 'partition', 'file']
+
+
+class Partition(ExportPlan):
+    """
+    The rows of a plan that belong to a site or a study
+
+    Partitions behave like plans of their own, named after their plan and
+    partition (e.g. ``visit/ucsd``), so their data files are generated,
+    cached and checkpointed like any other plan's.
+    """
+
+    def __init__(self, parent, by, key):
+        """
+        Parameters:
+        parent -- the plan that is partitioned
+        by -- what the plan is partitioned by (see ``PARTITIONS``)
+        key -- the name of the site/study, or None for the rows that do
+               not belong to any
+        """
+        super(Partition, self).__init__(parent.dbsession)
+        self.parent = parent
+        self.by = by
+        self.key = key
+        self.name = parent.name + '/' + (key or UNASSIGNED)
+        self.title = parent.title
+        self.is_system = parent.is_system
+        self.has_private = parent.has_private
+        self.has_rand = parent.has_rand
+        self.versions = parent.versions
+        self.tombstone_table = parent.tombstone_table
+
+    def codebook(self):
+        return self.parent.codebook()
+
+    def codebook_fingerprint(self):
+        return self.parent.codebook_fingerprint()
+
+    def data(self, **kw):
+        # The partition may have been copied to generate it in another
+        # session (see ``tasks._generate_plans``)
+        parent = copy(self.parent)
+        parent.dbsession = self.dbsession
+        return parent.partition_data(self.by, self.key, **kw)
+
+    def joined_tables(self):
+        # Rows also move between partitions along with their patients
+        if self.by == 'site':
+            tables = [models.Patient, models.Site]
+        else:
+            tables = [models.Patient, models.Enrollment, models.Study]
+        joined = list(self.parent.joined_tables())
+        for table in tables:
+            if table.__table__ not in joined:
+                joined.append(table.__table__)
+        return joined
+
+    def tombstones(self, since=None):
+        # Deleted rows cannot be traced back to their site/study
+        return self.parent.tombstones(since)
+
+    def to_json(self):
+        ret = super(Partition, self).to_json()
+        ret['partition_by'] = self.by
+        ret['partition'] = self.key
+        return ret
+
+
+def split(plans, by):
+    """
+    Splits plans into their partitions
+
+    Parameters:
+    plans -- the plans to partition
+    by -- what to partition them by (see ``PARTITIONS``), the plans are
+          returned as-is if None
+
+    Returns:
+    A list of the partitions of each plan in turn. Plans are only split
+    into the sites/studies they have rows for, followed by a partition of
+    the rows that do not belong to any if there are such rows (or if the
+    plan has no rows at all, so that it is still exported).
+    """
+    if not by or not plans:
+        return list(plans)
+
+    if by not in PARTITIONS:
+        raise ValueError('Cannot partition by {}'.format(by))
+
+    return [
+        Partition(plan, by, key) for plan in plans for key in _keys(plan, by)]
+
+
+def _keys(plan, by):
+    """
+    Lists the partitions a plan has rows for, using a single query
+
+    Returns:
+    The sorted names of the plan's sites/studies, followed by None if some
+    of its rows do not belong to any
+    """
+    pids = plan.pids().order_by(None).subquery()
+    Patient = orm.aliased(models.Patient)
+    keys = (
+        plan.dbsession.query(pids)
+        .outerjoin(Patient, Patient.pid == pids.c.pid))
+
+    if by == 'site':
+        Site = orm.aliased(models.Site)
+        keys = (
+            keys
+            .outerjoin(Site, Site.id == Patient.site_id)
+            .with_entities(Site.name))
+    else:
+        Enrollment = orm.aliased(models.Enrollment)
+        Study = orm.aliased(models.Study)
+        keys = (
+            keys
+            .outerjoin(Enrollment, Enrollment.patient_id == Patient.id)
+            .outerjoin(Study, Study.id == Enrollment.study_id)
+            .with_entities(Study.name))
+
+    names = set(name for name, in keys.distinct())
+
+    if not names or None in names:
+        return sorted(names - set([None])) + [None]
+    return sorted(names)
@@ -16,11 +16,10 @@ Formerly: avrcdataexport/sql/additional/OurEarlyTest.sql
 """
 
 from pyramid.decorator import reify
-from sqlalchemy import literal_column
+from sqlalchemy import func, literal_column
 from sqlalchemy.orm import aliased
 
 from .. import _, models
-from ..utils.sql import group_concat
 from .plan import ExportPlan
 from .codebook import row, types
 
@@ -31,6 +30,8 @@ class PidPlan(ExportPlan):
 
     title = _(u'Patient Identifiers')
 
+    tombstone_table = 'patient'
+
     @reify
     def reftypes(self):
         return list(
@@ -62,10 +63,16 @@ class PidPlan(ExportPlan):
             yield row(reftype.name, name, types.STRING,
                       is_system=True, is_collection=True)
 
+    def codebook_fingerprint(self):
+        fingerprint = super(PidPlan, self).codebook_fingerprint()
+        fingerprint['reftypes'] = [reftype.name for reftype in self.reftypes]
+        return fingerprint
+
     def data(self,
              use_choice_labels=False,
              expand_collections=False,
-             ignore_private=True):
+             ignore_private=True,
+             layout='wide'):
         session = self.dbsession
         query = (
             session.query(
@@ -89,19 +96,16 @@ class PidPlan(ExportPlan):
             .add_column(subquery.c.reference_number.label('early_id')))
 
         # Add every known reference number
-        for reftype in self.reftypes:
-            query = query.add_column(
-                session.query(
-                    group_concat(
-                        models.PatientReference.reference_number, ';'))
-                .filter(
-                    models.PatientReference.patient_id == models.Patient.id)
-                .filter(
-                    models.PatientReference.reference_type_id == reftype.id)
-                .group_by(models.PatientReference.patient_id)
-                .correlate(models.Patient)
-                .as_scalar()
-                .label(reftype.name))
+        if self.reftypes:
+            references = self._references_subquery()
+            query = (
+                query
+                .outerjoin(
+                    references,
+                    references.c.patient_id == models.Patient.id)
+                .add_columns(*[
+                    references.c[reftype.name].label(reftype.name)
+                    for reftype in self.reftypes]))
 
         query = (
             query
@@ -114,3 +118,36 @@ class PidPlan(ExportPlan):
             .order_by(models.Patient.id))
 
         return query
+
+    def joined_tables(self):
+        return [
+            models.Site.__table__,
+            models.Enrollment.__table__,
+            models.Study.__table__,
+            models.PatientReference.__table__,
+            # Reference types are exported as columns
+            models.ReferenceType.__table__,
+        ]
+
+    def _references_subquery(self):
+        """
+        Pivots the reference numbers of every patient into one row
+
+        All reference numbers are aggregated in a single grouped pass,
+        each reference type filtered into its own column, so patients are
+        only joined once regardless of the number of reference types.
+        """
+        session = self.dbsession
+        PatientReference = models.PatientReference
+
+        return (
+            session.query(
+                PatientReference.patient_id.label('patient_id'),
+                *[func.array_to_string(
+                    func.array_agg(PatientReference.reference_number)
+                    .filter(PatientReference.reference_type_id == reftype.id),
+                    u';')
+                  .label(reftype.name)
+                  for reftype in self.reftypes])
+            .group_by(PatientReference.patient_id)
+            .subquery())
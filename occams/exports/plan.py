@@ -1,3 +1,11 @@
+import json
+
+import six
+from sqlalchemy import exists, func, literal, null, orm, select, String
+
+from .. import models
+
+
 class ExportPlan(object):
     """
     An export plan
@@ -14,6 +22,8 @@ class ExportPlan(object):
 
     versions = []           # All versions avaialble
 
+    tombstone_table = None  # Table that tracks deleted rows of this plan
+
     def __init__(self, dbsession=None):
         self.dbsession = dbsession
 
@@ -30,10 +40,27 @@ class ExportPlan(object):
         """
         raise NotImplemented  # pragma: nocover
 
+    def codebook_fingerprint(self):
+        """
+        Identifies the revision of the plan's codebook
+
+        Published schema versions cannot be modified, so the codebook only
+        changes when the plan's set of versions does.
+
+        Returns:
+        A JSON-serializable value that changes with the codebook
+        """
+        return {
+            'versions': [str(v) for v in self.versions],
+            'has_private': self.has_private,
+            'has_rand': self.has_rand,
+        }
+
     def data(self,
              use_choice_labels=False,
              expand_collections=False,
-             ignore_private=True):
+             ignore_private=True,
+             layout='wide'):
         """
         Generate export data
 
@@ -45,12 +72,200 @@ class ExportPlan(object):
                               default: False
         ignore_private -- (Optional) De-identity private information
                           default: True
+        layout -- (Optional) ``wide`` for one row per record, or ``long`` for
+                  one row per value of forms (other plans are always wide)
+                  default: wide
 
         Returns:
         An iterator of row data
         """
         raise NotImplemented  # pragma: nocover
 
+    def partition_data(self, by, key, **kw):
+        """
+        Generate the export data of the rows that belong to a site or study
+
+        The plan's rows are filtered as a whole (see
+        ``partition_condition``), which suits plans that select their rows
+        in a single query. Plans that build their rows in a subquery
+        should restrict them before they are built instead, since the
+        database cannot push the filter into it.
+
+        Parameters:
+        by -- what the rows are partitioned by (see ``partition.PARTITIONS``)
+        key -- the name of the site/study, or None for the rows that do
+               not belong to any
+        **kw -- Options accepted by ``data()``
+
+        Returns:
+        An iterator of row data
+        """
+        query = self.data(**kw)
+        return query.filter(partition_condition(query, by, key))
+
+    def pids(self):
+        """
+        Generate the pids of the plan's rows
+
+        Used to tell which sites/studies the plan has rows for, so plans
+        should select them without building the rest of their rows.
+
+        Returns:
+        An iterator of ``pid`` rows, which are None for rows that do not
+        belong to any patient
+        """
+        query = self.data()
+        return query.with_entities(_column(query, 'pid').label('pid'))
+
+    def delta(self, since=None, **kw):
+        """
+        Generate export data that has changed since a point in time
+
+        Rows are selected by their ``modified_at`` column, which is
+        maintained by the database for every insert and update. Rows also
+        change along with the tables joined into them (see
+        ``joined_tables``), but those are only tracked per table, so any
+        change to one of them since then includes all of the plan's rows.
+        Deleted joined rows are only noticed for tables that keep
+        tombstones.
+
+        Parameters:
+        since -- (Optional) Only include rows modified at or after this time
+                 default: None (i.e. all rows)
+        **kw -- Options accepted by ``data()``
+
+        Returns:
+        An iterator of row data
+        """
+        query = self.data(**kw)
+
+        if since is not None:
+            changed = _modified_at(query) >= since
+            tables = self.joined_tables()
+
+            # Aliased so they are not correlated with the plan's own joins
+            for table in tables:
+                if 'modified_at' in table.c:
+                    table = table.alias()
+                    changed |= exists().where(table.c.modified_at >= since)
+
+            if tables:
+                Tombstone = orm.aliased(models.Tombstone)
+                changed |= exists().where(
+                    Tombstone.table_name.in_([t.name for t in tables])
+                    & (Tombstone.deleted_at >= since))
+
+            query = query.filter(changed)
+
+        return query
+
+    def fingerprint(self, **kw):
+        """
+        Summarizes the current state of the export data
+
+        Any insert, update or delete of the plan's rows changes the
+        fingerprint, so it can be used to tell if previously generated
+        data is still current without generating it again. The tables
+        joined into the plan's rows (see ``joined_tables``) are summarized
+        as well, so that changing e.g. a patient's site also changes the
+        fingerprint.
+
+        Parameters:
+        **kw -- Options accepted by ``data()``
+
+        Returns:
+        A JSON-serializable list of the row count, the latest modification
+        time and the latest deletion time, followed by the row count and
+        latest modification time of each joined table.
+        """
+        query = self.data(**kw)
+        count, modified_at = (
+            query
+            .with_entities(func.count(), func.max(_modified_at(query)))
+            .order_by(None)
+            .one())
+        deleted_at = (
+            self.tombstones()
+            .with_entities(func.max(models.Tombstone.deleted_at))
+            .scalar())
+        fingerprint = [count, modified_at, deleted_at]
+
+        summaries = []
+        for table in self.joined_tables():
+            summaries.append(
+                select([func.count()]).select_from(table).as_scalar())
+            if 'modified_at' in table.c:
+                summaries.append(
+                    select([func.max(table.c.modified_at)]).as_scalar())
+        if summaries:
+            fingerprint.extend(self.dbsession.query(*summaries).one())
+
+        return [
+            value.isoformat() if hasattr(value, 'isoformat') else value
+            for value in fingerprint]
+
+    def joined_tables(self):
+        """
+        Lists the tables, other than the plan's own, that feed its rows
+
+        Returns:
+        A list of ``Table`` objects
+        """
+        return []
+
+    def estimate(self, **kw):
+        """
+        Estimates the size of the export data without generating it
+
+        Parameters:
+        **kw -- Options accepted by ``data()``
+
+        Returns:
+        The estimated number of values (rows times columns)
+        """
+        query = self.data(**kw)
+        return _planned_rows(query) * len(query.column_descriptions)
+
+    def estimate_rows(self, since=None, **kw):
+        """
+        Estimates the number of rows of the export data
+
+        The query is only planned by the database, never executed, so the
+        row count is an estimate based on the database statistics.
+
+        Parameters:
+        since -- (Optional) Only count rows modified at or after this time
+        **kw -- Options accepted by ``data()``
+
+        Returns:
+        The estimated number of rows
+        """
+        return _planned_rows(self.delta(since, **kw))
+
+    def tombstones(self, since=None):
+        """
+        Generate the rows of this plan that have been deleted
+
+        Parameters:
+        since -- (Optional) Only include rows deleted at or after this time
+                 default: None (i.e. all deleted rows)
+
+        Returns:
+        An iterator of (table, id, deleted_at) rows
+        """
+        Tombstone = models.Tombstone
+        query = (
+            self.dbsession.query(
+                literal(self.name, String).label('table'),
+                Tombstone.key.label('id'),
+                Tombstone.deleted_at.label('deleted_at'))
+            .filter(Tombstone.table_name == self.tombstone_table))
+
+        if since is not None:
+            query = query.filter(Tombstone.deleted_at >= since)
+
+        return query
+
     def to_json(self):
         """
         Serialize to JSON
@@ -59,3 +274,84 @@ class ExportPlan(object):
         ret = dict((k, getattr(self, k)) for k in keys)
         ret['versions'] = list(map(str, self.versions))
         return ret
+
+
+def partition_condition(query, by, key):
+    """
+    Builds the condition of the rows of a query that belong to a partition
+
+    Rows are matched through their ``pid`` column, which every plan has,
+    whereas the ``site`` column is used directly when available. Patients
+    enrolled in several studies have their rows in each of those studies.
+    """
+    columns = dict((c['name'], c['expr']) for c in query.column_descriptions)
+
+    if by == 'site' and 'site' in columns:
+        if key is None:
+            return columns['site'] == null()
+        return columns['site'] == key
+
+    # The plan's query may already use these tables
+    Patient = orm.aliased(models.Patient)
+    pid = columns['pid']
+
+    if by == 'site':
+        if key is None:
+            return ~exists().where(Patient.pid == pid)
+        Site = orm.aliased(models.Site)
+        return exists().where(
+            (Patient.pid == pid)
+            & (Site.id == Patient.site_id)
+            & (Site.name == key))
+
+    Enrollment = orm.aliased(models.Enrollment)
+    is_enrolled = (Patient.pid == pid) & (Enrollment.patient_id == Patient.id)
+
+    if key is None:
+        return ~exists().where(is_enrolled)
+
+    Study = orm.aliased(models.Study)
+    return exists().where(
+        is_enrolled
+        & (Study.id == Enrollment.study_id)
+        & (Study.name == key))
+
+
+def _column(query, name):
+    """
+    Returns the expression of a plan query's column
+    """
+    return next(
+        c['expr'] for c in query.column_descriptions if c['name'] == name)
+
+
+def _modified_at(query):
+    """
+    Returns the expression of a plan query's ``modified_at`` column
+    """
+    return _column(query, 'modified_at')
+
+
+def _planned_rows(query):
+    """
+    Returns the number of rows the database expects a query to return
+    """
+    connection = query.session.connection()
+
+    if connection.dialect.name != 'postgresql':
+        return query.order_by(None).count()
+
+    compiled = query.statement.compile(dialect=connection.dialect)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(
+            u'EXPLAIN (FORMAT JSON) ' + six.text_type(compiled),
+            compiled.params)
+        plan, = cursor.fetchone()
+    finally:
+        cursor.close()
+
+    if isinstance(plan, six.string_types):
+        plan = json.loads(plan)
+
+    return int(plan[0]['Plan']['Plan Rows'])
@@ -8,34 +8,34 @@ Also incorporates:
 
 """
 
-from datetime import datetime
 from six import itervalues
-from sqlalchemy import orm, null, cast, String, literal_column
+from sqlalchemy import orm, func, null, cast, exists, String, literal_column
 
 
 from .. import models
+from . import catalog
 from .plan import ExportPlan
 from .codebook import types, row
-from ..reporting import build_report
-from ..utils.sql import group_concat, to_date
+from ..reporting import build_report, build_long_report
 
 
 class SchemaPlan(ExportPlan):
 
     is_system = False
 
+    tombstone_table = 'entity'
+
     @classmethod
-    def from_sql(cls, dbsession, record):
+    def from_info(cls, dbsession, info):
         """
-        Creates a plan instance from an internal query inspection
+        Creates a plan instance from a catalog entry
         """
         report = cls(dbsession)
-        report.name = record.name
-        report.title = record.title
-        report.has_private = record.has_private
-        report.has_rand = record.has_rand
-        report.versions = sorted([datetime.strptime(v, '%Y-%m-%d').date()
-                                  for v in record.versions.split(';')])
+        report.name = info.name
+        report.title = info.title
+        report.has_private = info.has_private
+        report.has_rand = info.has_rand
+        report.versions = list(info.versions)
         return report
 
     @classmethod
@@ -43,27 +43,27 @@ class SchemaPlan(ExportPlan):
         """
         Creates a plan from a schema name
         """
-        subquery = _list_schemata_info(dbsession).subquery()
-        query = dbsession.query(subquery).filter(subquery.c.name == name)
-        return cls.from_sql(dbsession, query.one())
+        for info in catalog.list_schemata(dbsession):
+            if info.name == name:
+                return cls.from_info(dbsession, info)
+        raise orm.exc.NoResultFound
 
     @classmethod
     def list_all(cls, dbsession, include_rand=True, include_private=True):
         """
         Lists all the schema plans
         """
-        subquery = _list_schemata_info(dbsession).subquery()
-        query = dbsession.query(subquery)
+        schemata = catalog.list_schemata(dbsession)
 
         if not include_rand:
-            query = query.filter(~subquery.c.has_rand)
+            schemata = [i for i in schemata if not i.has_rand]
 
         if not include_private:
-            query = query.filter(~subquery.c.has_private)
+            schemata = [i for i in schemata if not i.has_private]
 
-        query = query.order_by(subquery.c.title)
+        schemata = sorted(schemata, key=lambda i: i.title)
 
-        return [cls.from_sql(dbsession, r) for r in query]
+        return [cls.from_info(dbsession, i) for i in schemata]
 
     @property
     def _is_aeh_partner_form(self):
@@ -168,12 +168,17 @@ class SchemaPlan(ExportPlan):
     def data(self,
              use_choice_labels=False,
              expand_collections=False,
-             ignore_private=True):
+             ignore_private=True,
+             layout='wide',
+             condition=None):
+        # ``condition`` restricts the entities before the report is built
+        # (see ``partition_data``)
         session = self.dbsession
-        ids_query = (
-            session.query(models.Schema.id)
-            .filter(models.Schema.publish_date.in_(self.versions)))
-        ids = [id for id, in ids_query]
+        ids = self._schema_ids()
+
+        if layout == 'long':
+            return self._long_data(
+                ids, use_choice_labels, ignore_private, condition)
 
         report = build_report(
             session,
@@ -181,155 +186,61 @@ class SchemaPlan(ExportPlan):
             ids=ids,
             expand_collections=expand_collections,
             use_choice_labels=use_choice_labels,
-            ignore_private=ignore_private)
+            ignore_private=ignore_private,
+            condition=condition)
+
+        # All contexts are resolved in a single pass, rather than looking
+        # them up separately for every exported column of every entity
+        contexts = self._contexts_subquery(ids, condition)
 
         query = (
             session.query(report.c.id.label('id'))
-            .add_column(
-                session.query(models.Patient.pid)
-                .join(models.Context,
-                      (models.Context.external == u'patient')
-                      & (models.Context.key == models.Patient.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .correlate(report)
-                .as_scalar()
-                .label('pid'))
-            .add_column(
-                session.query(models.Site.name)
-                .select_from(models.Patient)
-                .join(models.Site)
-                .join(models.Context,
-                      (models.Context.external == u'patient')
-                      & (models.Context.key == models.Patient.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .correlate(report)
-                .as_scalar()
-                .label('site'))
-            .add_column(
-                session.query(group_concat(models.Study.name, ';'))
-                .select_from(models.Enrollment)
-                .join(models.Study)
-                .join(models.Context,
-                      (models.Context.external == u'enrollment')
-                      & (models.Context.key == models.Enrollment.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .group_by(models.Context.entity_id)
-                .correlate(report)
-                .as_scalar()
-                .label('enrollment'))
-            .add_column(
-                session.query(group_concat(models.Enrollment.id, ';'))
-                .select_from(models.Enrollment)
-                .join(models.Context,
-                      (models.Context.external == u'enrollment')
-                      & (models.Context.key == models.Enrollment.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .group_by(models.Context.entity_id)
-                .correlate(report)
-                .as_scalar()
-                .label('enrollment_ids'))
-            )
+            .select_from(report)
+            .outerjoin(contexts, contexts.c.entity_id == report.c.id)
+            .outerjoin(
+                models.Patient,
+                models.Patient.id == contexts.c.patient_id)
+            .outerjoin(
+                models.Site,
+                models.Site.id == models.Patient.site_id)
+            .add_column(models.Patient.pid.label('pid'))
+            .add_column(models.Site.name.label('site'))
+            .add_column(contexts.c.enrollment.label('enrollment'))
+            .add_column(contexts.c.enrollment_ids.label('enrollment_ids'))
+        )
 
         if self._is_aeh_partner_form:
             PartnerPatient = orm.aliased(models.Patient)
             query = (
                 query
-                .add_column(
-                    session.query(models.Partner.id)
-                    .select_from(models.Partner)
-                    .join(models.Context,
-                          (models.Context.external == u'partner')
-                          & (models.Context.key == models.Partner.id))
-                    .filter(models.Context.entity_id == report.c.id)
-                    .correlate(report)
-                    .as_scalar()
-                    .label('partner_id'))
-                .add_column(
-                    session.query(PartnerPatient.pid)
-                    .select_from(models.Partner)
-                    .join(PartnerPatient, models.Partner.enrolled_patient)
-                    .join(models.Context,
-                          (models.Context.external == u'partner')
-                          & (models.Context.key == models.Partner.id))
-                    .filter(models.Context.entity_id == report.c.id)
-                    .correlate(report)
-                    .as_scalar()
-                    .label('partner_pid')))
+                .outerjoin(
+                    models.Partner,
+                    models.Partner.id == contexts.c.partner_id)
+                .outerjoin(PartnerPatient, models.Partner.enrolled_patient)
+                .add_column(models.Partner.id.label('partner_id'))
+                .add_column(PartnerPatient.pid.label('partner_pid')))
 
         if self.has_rand:
             query = (
                 query
-                .add_column(
-                    session.query(models.Stratum.block_number)
-                    .select_from(models.Stratum)
-                    .join(models.Context,
-                          (models.Context.external == u'stratum')
-                          & (models.Context.key == models.Stratum.id))
-                    .filter(models.Context.entity_id == report.c.id)
-                    .correlate(report)
-                    .as_scalar()
-                    .label('block_number'))
-                .add_column(
-                    session.query(models.Stratum.randid)
-                    .select_from(models.Stratum)
-                    .join(models.Context,
-                          (models.Context.external == u'stratum')
-                          & (models.Context.key == models.Stratum.id))
-                    .filter(models.Context.entity_id == report.c.id)
-                    .correlate(report)
-                    .as_scalar()
-                    .label('randid'))
-                .add_column(
-                    session.query(models.Arm.title)
-                    .select_from(models.Stratum)
-                    .join(models.Context,
-                          (models.Context.external == u'stratum')
-                          & (models.Context.key == models.Stratum.id))
-                    .filter(models.Context.entity_id == report.c.id)
-                    .join(models.Stratum.arm)
-                    .correlate(report)
-                    .as_scalar()
-                    .label('arm_name')))
+                .outerjoin(
+                    models.Stratum,
+                    models.Stratum.id == contexts.c.stratum_id)
+                .outerjoin(
+                    models.Arm,
+                    models.Arm.id == models.Stratum.arm_id)
+                .add_column(models.Stratum.block_number.label('block_number'))
+                .add_column(models.Stratum.randid.label('randid'))
+                .add_column(models.Arm.title.label('arm_name')))
 
         query = (
             query
-            .add_column(
-                session.query(group_concat(models.Study.title
-                                           + literal_column(u"'('")
-                                           + cast(models.Cycle.week, String)
-                                           + literal_column(u"')'"),
-                                           literal_column(u"';'")))
-                .select_from(models.Visit)
-                .join(models.Visit.cycles)
-                .join(models.Cycle.study)
-                .join(models.Context,
-                      (models.Context.external == u'visit')
-                      & (models.Context.key == models.Visit.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .group_by(models.Context.entity_id)
-                .correlate(report)
-                .as_scalar()
-                .label('visit_cycles'))
-            .add_column(
-                session.query(models.Visit.id)
-                .select_from(models.Visit)
-                .join(models.Context,
-                      (models.Context.external == u'visit')
-                      & (models.Context.key == models.Visit.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .correlate(report)
-                .as_scalar()
-                .label('visit_id'))
-            .add_column(
-                session.query(models.Visit.visit_date)
-                .select_from(models.Visit)
-                .join(models.Context,
-                      (models.Context.external == u'visit')
-                      & (models.Context.key == models.Visit.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .correlate(report)
-                .as_scalar()
-                .label('visit_date'))
+            .outerjoin(
+                models.Visit,
+                models.Visit.id == contexts.c.visit_id)
+            .add_column(contexts.c.visit_cycles.label('visit_cycles'))
+            .add_column(models.Visit.id.label('visit_id'))
+            .add_column(models.Visit.visit_date.label('visit_date'))
         )
 
         query = query.add_columns(
@@ -337,59 +248,188 @@ class SchemaPlan(ExportPlan):
 
         return query
 
+    def joined_tables(self):
+        tables = [
+            models.Context,
+            models.Patient,
+            models.Site,
+            models.Enrollment,
+            models.Study,
+            models.Visit,
+            models.visit_cycle_table,
+            models.Cycle,
+        ]
+
+        if self.has_rand:
+            tables.extend([models.Stratum, models.Arm])
+
+        return [getattr(t, '__table__', t) for t in tables]
+
+    def partition_data(self, by, key, **kw):
+        # The report and contexts are grouped subqueries, which a filter
+        # on the plan's rows would not reach
+        return self.data(condition=_partition_condition(by, key), **kw)
+
+    def pids(self):
+        Context = models.Context
+        return (
+            self.dbsession.query(models.Patient.pid.label('pid'))
+            .select_from(models.Entity)
+            .outerjoin(Context, (
+                (Context.external == u'patient')
+                & (Context.entity_id == models.Entity.id)))
+            .outerjoin(models.Patient, models.Patient.id == Context.key)
+            .filter(models.Entity.schema_id.in_(self._schema_ids())))
+
+    def _long_data(self, ids, use_choice_labels, ignore_private,
+                   condition=None):
+        """
+        Generates one row per value instead of one row per entity
+
+        Only the patient is looked up for each entity, the rest of its
+        context is available in the wide layout.
+        """
+        session = self.dbsession
+        report = build_long_report(
+            session,
+            self.name,
+            ids=ids,
+            use_choice_labels=use_choice_labels,
+            ignore_private=ignore_private,
+            condition=condition)
+
+        Context = models.Context
+        return (
+            session.query(report.c.id.label('id'))
+            .select_from(report)
+            .outerjoin(Context, (
+                (Context.external == u'patient')
+                & (Context.entity_id == report.c.id)))
+            .outerjoin(models.Patient, models.Patient.id == Context.key)
+            .add_column(models.Patient.pid.label('pid'))
+            .add_columns(
+                report.c.attribute,
+                report.c.value,
+                report.c.modified_at))
+
+    def _contexts_subquery(self, ids, condition=None):
+        """
+        Aggregates the contexts of each of the plan's entities into one row
+
+        Enrollments and visit cycles are joined in only for their own
+        context rows, so each context row matches at most the rows that
+        describe it.
+        """
+        session = self.dbsession
+        Context = models.Context
+        VisitCycle = models.visit_cycle_table
+        EnrollmentStudy = orm.aliased(models.Study)
+        CycleStudy = orm.aliased(models.Study)
+
+        is_enrollment = Context.external == u'enrollment'
+        is_visit = Context.external == u'visit'
+        has_enrollment = is_enrollment & (models.Enrollment.id != null())
+        has_cycle = is_visit & (models.Cycle.id != null())
+
+        def key_of(external):
+            return (
+                func.max(Context.key)
+                .filter(Context.external == external)
+                .label(external + '_id'))
+
+        def concat(expr, condition):
+            return func.array_to_string(
+                func.array_agg(expr).filter(condition), u';')
+
+        # The entities are joined first, as the database keeps the order of
+        # this many joins, so that only their own context rows get fetched
+        entities = (
+            session.query(models.Entity.id.label('id'))
+            .filter(models.Entity.schema_id.in_(ids)))
+        if condition is not None:
+            entities = entities.filter(condition)
+        entities = entities.subquery()
+
+        return (
+            session.query(
+                Context.entity_id.label('entity_id'),
+                key_of(u'patient'),
+                key_of(u'partner'),
+                key_of(u'stratum'),
+                key_of(u'visit'),
+                concat(EnrollmentStudy.name, has_enrollment)
+                .label('enrollment'),
+                concat(models.Enrollment.id, has_enrollment)
+                .label('enrollment_ids'),
+                concat(CycleStudy.title
+                       + literal_column(u"'('")
+                       + cast(models.Cycle.week, String)
+                       + literal_column(u"')'"),
+                       has_cycle)
+                .label('visit_cycles'))
+            .select_from(Context)
+            .join(entities, entities.c.id == Context.entity_id)
+            .outerjoin(
+                models.Enrollment,
+                is_enrollment & (models.Enrollment.id == Context.key))
+            .outerjoin(
+                EnrollmentStudy,
+                EnrollmentStudy.id == models.Enrollment.study_id)
+            .outerjoin(
+                VisitCycle,
+                is_visit & (VisitCycle.c.visit_id == Context.key))
+            .outerjoin(
+                models.Cycle,
+                models.Cycle.id == VisitCycle.c.cycle_id)
+            .outerjoin(
+                CycleStudy,
+                CycleStudy.id == models.Cycle.study_id)
+            .group_by(Context.entity_id)
+            .subquery())
+
+    def tombstones(self, since=None):
+        Tombstone = models.Tombstone
+        query = super(SchemaPlan, self).tombstones(since)
+        query = query.filter(Tombstone.parent_key.in_(self._schema_ids()))
+        return query
 
-def _list_schemata_info(dbsession):
-    InnerSchema = orm.aliased(models.Schema)
-    OuterSchema = orm.aliased(models.Schema)
-
-    schemata_query = (
-        dbsession.query(OuterSchema.name.label('name'))
-        .add_column(literal_column("'schema'").label('type'))
-        .add_column(
-            dbsession.query(models.Attribute)
-            .filter(models.Attribute.is_private)
-            .join(InnerSchema)
-            .filter(InnerSchema.name == OuterSchema.name)
-            .correlate(OuterSchema)
-            .exists()
-            .label('has_private'))
-        .add_column(
-            dbsession.query(models.Entity)
-            .join(models.Entity.contexts)
-            .filter(models.Context.external == 'stratum')
-            .join(models.Stratum, models.Context.key == models.Stratum.id)
-            .join(InnerSchema, models.Entity.schema)
-            .filter(InnerSchema.name == OuterSchema.name)
-            .correlate(OuterSchema)
-            .exists()
-            .label('has_rand'))
-        .add_column(
-            dbsession.query(InnerSchema.title)
-            .select_from(InnerSchema)
-            .filter(InnerSchema.name == OuterSchema.name)
-            .filter(InnerSchema.publish_date != null())
-            .filter(InnerSchema.retract_date == null())
-            .order_by(InnerSchema.publish_date.desc())
-            .limit(1)
-            .correlate(OuterSchema)
-            .as_scalar()
-            .label('title'))
-        .add_column(
-            dbsession.query(
-                group_concat(to_date(InnerSchema.publish_date), ';'))
-            .filter(InnerSchema.name == OuterSchema.name)
-            .filter(InnerSchema.publish_date != null())
-            .filter(InnerSchema.retract_date == null())
-            .group_by(InnerSchema.name)
-            .correlate(OuterSchema)
-            .as_scalar()
-            .label('versions'))
-        .filter(OuterSchema.publish_date != null())
-        .filter(OuterSchema.retract_date == null()))
-
-    schemata_query = (
-        schemata_query
-        .group_by(OuterSchema.name)
-        .from_self())
-
-    return schemata_query
+    def _schema_ids(self):
+        """
+        Lists the ids of the schema versions included in this plan
+        """
+        query = (
+            self.dbsession.query(models.Schema.id)
+            .filter(models.Schema.name == self.name)
+            .filter(models.Schema.publish_date.in_(self.versions)))
+        return [id for id, in query]
+
+
+def _partition_condition(by, key):
+    """
+    Builds the condition of the entities that belong to a partition
+
+    Entities are matched through their patient, the same way as the rows
+    of other plans (see ``plan.partition_condition``).
+    """
+    Context = orm.aliased(models.Context)
+    Patient = orm.aliased(models.Patient)
+    belongs = (
+        (Context.entity_id == models.Entity.id)
+        & (Context.external == u'patient')
+        & (Patient.id == Context.key))
+
+    if by == 'site':
+        Site = orm.aliased(models.Site)
+        belongs &= Site.id == Patient.site_id
+        is_named = Site.name == key
+    else:
+        Enrollment = orm.aliased(models.Enrollment)
+        Study = orm.aliased(models.Study)
+        belongs &= (
+            (Enrollment.patient_id == Patient.id)
+            & (Study.id == Enrollment.study_id))
+        is_named = Study.name == key
+
+    if key is None:
+        return ~exists().where(belongs)
+    return exists().where(belongs & is_named)
@@ -15,6 +15,8 @@ class VisitPlan(ExportPlan):
 
     title = _(u'Visits')
 
+    tombstone_table = 'visit'
+
     def codebook(self):
         return iter([
             row('id', self.name, types.NUMBER, decimal_places=0,
@@ -40,7 +42,8 @@ class VisitPlan(ExportPlan):
     def data(self,
              use_choice_labels=False,
              expand_collections=False,
-             ignore_private=True):
+             ignore_private=True,
+             layout='wide'):
         session = self.dbsession
         query = (
             session.query(
@@ -62,3 +65,12 @@ class VisitPlan(ExportPlan):
             .join(models.Patient.site)
             .order_by(models.Visit.id))
         return query
+
+    def joined_tables(self):
+        return [
+            models.Patient.__table__,
+            models.visit_cycle_table,
+            models.Cycle.__table__,
+            models.Study.__table__,
+            models.Site.__table__,
+        ]
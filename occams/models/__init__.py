@@ -54,7 +54,7 @@ from .schema import (  # noqa
     Choice
 )
 
-from .metadata import User  # noqa
+from .metadata import User, Tombstone, Revision  # noqa
 
 from .storage import (  # noqa
     State,
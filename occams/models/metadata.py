@@ -50,6 +50,73 @@ def create_touch_procedures(target, connection, **kw):
         $$ LANGUAGE plpgsql;
     """)
 
+    connection.execute(r"""
+        CREATE OR REPLACE FUNCTION tombstone() RETURNS TRIGGER AS $$
+        DECLARE
+            _parent_key bigint;
+        BEGIN
+            IF tg_nargs > 0 THEN
+                EXECUTE format('SELECT ($1).%%I', tg_argv[0])
+                INTO _parent_key
+                USING OLD;
+            END IF;
+
+            INSERT INTO tombstone (table_name, key, parent_key, deleted_at)
+            VALUES (
+                tg_table_name, OLD.id, _parent_key, timeofday()::timestamptz);
+
+            RETURN OLD;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+
+    connection.execute(r"""
+        CREATE OR REPLACE FUNCTION tombstone_table(
+            target_table regclass,
+            parent_column text DEFAULT NULL)
+            RETURNS void AS $$
+        BEGIN
+            EXECUTE '
+                DROP TRIGGER IF EXISTS tombstone_trigger
+                ON ' || target_table || ';
+                CREATE TRIGGER tombstone_trigger
+                AFTER DELETE
+                ON ' || target_table || '
+                FOR EACH ROW EXECUTE PROCEDURE tombstone('
+                || coalesce(quote_literal(parent_column), '') || ')';
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+
+    connection.execute(r"""
+        CREATE OR REPLACE FUNCTION revise() RETURNS TRIGGER AS $$
+        BEGIN
+            INSERT INTO revision (name, value) VALUES (tg_argv[0], 1)
+            ON CONFLICT (name) DO UPDATE SET value = revision.value + 1;
+
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+
+    connection.execute(r"""
+        CREATE OR REPLACE FUNCTION revise_table(
+            target_table regclass,
+            revision_name text)
+            RETURNS void AS $$
+        BEGIN
+            EXECUTE '
+                DROP TRIGGER IF EXISTS revise_trigger
+                ON ' || target_table || ';
+                CREATE TRIGGER revise_trigger
+                AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+                ON ' || target_table || '
+                FOR EACH STATEMENT EXECUTE PROCEDURE revise('
+                || quote_literal(revision_name) || ')';
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+
 
 class Referenceable(object):
     """
@@ -150,3 +217,67 @@ class Modifiable(object):
             'after_create',
             sa.DDL(r"select touch_table('%(fullname)s')")
         )
+
+
+class Tombstone(Base, Referenceable):
+    """
+    A record of a deleted row, so that incremental exports can tell
+    downstream consumers what to remove.
+
+    Rows are added by the ``tombstone()`` trigger, which is installed
+    on a table using ``tombstone_table()``.
+    """
+
+    __tablename__ = 'tombstone'
+
+    table_name = sa.Column(
+        sa.String,
+        nullable=False,
+        doc='The table the deleted row belonged to')
+
+    key = sa.Column(
+        sa.BigInteger,
+        nullable=False,
+        doc='The id of the deleted row')
+
+    parent_key = sa.Column(
+        sa.BigInteger,
+        doc='The id of the deleted row\'s parent, if the table has one '
+            '(e.g. the schema of an entity)')
+
+    deleted_at = sa.Column(sa.DateTime(timezone=True), nullable=False)
+
+    @declared_attr
+    def __table_args__(cls):
+        return (
+            sa.Index(
+                'ix_%s_table_name_deleted_at' % cls.__tablename__,
+                'table_name',
+                'deleted_at'),
+            {'info': {'audit_exclude': True}})
+
+
+class Revision(Base):
+    """
+    A counter of the changes to data that is cached in memory, so that
+    caches can tell they are stale by reading a single row.
+
+    Counters are incremented by the ``revise()`` trigger, which is
+    installed on a table using ``revise_table()``. The counter is
+    incremented within the transaction that makes the change, so it is
+    only seen to change once the change is committed.
+    """
+
+    __tablename__ = 'revision'
+
+    name = sa.Column(
+        sa.String,
+        primary_key=True,
+        doc='The name of the cached data (e.g. ``catalog``)')
+
+    value = sa.Column(
+        sa.BigInteger,
+        nullable=False,
+        doc='The number of statements that changed the cached data')
+
+    __table_args__ = {'info': {'audit_exclude': True}}
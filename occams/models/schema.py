@@ -596,6 +596,20 @@ sa.Index(
     unique=True)
 
 
+# Keep track of changes to the schemata for the export catalog
+sa.event.listen(
+    Schema.__table__,
+    'after_create',
+    sa.DDL(r"select revise_table('%(fullname)s', 'catalog')")
+)
+
+sa.event.listen(
+    Attribute.__table__,
+    'after_create',
+    sa.DDL(r"select revise_table('%(fullname)s', 'catalog')")
+)
+
+
 class Choice(
         Base, Referenceable, Describeable, Modifiable, ):
     """
@@ -137,7 +137,21 @@ class Entity(Base, Referenceable, Modifiable):
                 ondelete='CASCADE'),
             sa.Index('ix_%s_schema_id' % cls.__tablename__, 'schema_id'),
             sa.Index('ix_%s_state_id' % cls.__tablename__, 'state_id'),
-            sa.Index('ix_%s_collect_date' % cls.__tablename__, 'collect_date'))
+            sa.Index('ix_%s_collect_date' % cls.__tablename__, 'collect_date'),
+            # Supports value lookups by containment (see ``querying``)
+            sa.Index(
+                'ix_%s_data' % cls.__tablename__,
+                'data',
+                postgresql_using='gin',
+                postgresql_ops={'data': 'jsonb_path_ops'}))
+
+
+# Keep track of deleted entities (and their schema) for incremental exports
+sa.event.listen(
+    Entity.__table__,
+    'after_create',
+    sa.DDL(r"select tombstone_table('%(fullname)s', 'schema_id')")
+)
 
 
 class HasEntities(object):
@@ -213,6 +227,24 @@ class EntityAttachmentBlob(Base, Referenceable, Modifiable):
 
     content = sa.Column(
         sa.LargeBinary,
-        nullable=False,
-        info={'audit_exclude': True}
+        info={'audit_exclude': True},
+        doc='The file contents, unless moved to the blob store'
+    )
+
+    digest = sa.Column(
+        sa.String(64),
+        doc='The SHA-256 digest of the file in the blob store'
     )
+
+    size = sa.Column(
+        sa.BigInteger,
+        doc='The size of the file in the blob store, in bytes'
+    )
+
+    @declared_attr
+    def __table_args__(cls):
+        return (
+            sa.CheckConstraint(
+                'content IS NOT NULL OR digest IS NOT NULL',
+                name='ck_%s_has_content' % cls.__tablename__),
+            sa.Index('ix_%s_digest' % cls.__tablename__, 'digest'))
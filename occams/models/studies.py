@@ -587,6 +587,14 @@ class Patient(Base,
             sa.Index('ix_%s_initials' % cls.__tablename__, 'initials'))
 
 
+# Keep track of deleted patients for incremental exports
+sa.event.listen(
+    Patient.__table__,
+    'after_create',
+    sa.DDL(r"select tombstone_table('%(fullname)s')")
+)
+
+
 class ReferenceTypeFactory(object):
 
     __acl__ = [
@@ -836,6 +844,14 @@ class Enrollment(Base,
                 name='ck_%s_lifespan' % cls.__tablename__))
 
 
+# Keep track of deleted enrollments for incremental exports
+sa.event.listen(
+    Enrollment.__table__,
+    'after_create',
+    sa.DDL(r"select tombstone_table('%(fullname)s')")
+)
+
+
 class Stratum(Base,
               Referenceable,
               Modifiable,
@@ -931,6 +947,14 @@ class Stratum(Base,
             sa.Index('ix_%s_arm_id' % cls.__tablename__, cls.arm_id))
 
 
+# Keep track of randomizations for the export catalog
+sa.event.listen(
+    Stratum.__table__,
+    'after_create',
+    sa.DDL(r"select revise_table('%(fullname)s', 'catalog')")
+)
+
+
 class VisitFactory(object):
 
     @property
@@ -1052,6 +1076,14 @@ class Visit(Base,
                 name='uq_%s_patient_id_visit_date' % cls.__tablename__))
 
 
+# Keep track of deleted visits for incremental exports
+sa.event.listen(
+    Visit.__table__,
+    'after_create',
+    sa.DDL(r"select tombstone_table('%(fullname)s')")
+)
+
+
 class EntryFactory(object):
 
     @property
@@ -1188,6 +1220,60 @@ class Export(Base,
 
     use_choice_labels = sa.Column(sa.Boolean, nullable=False, default=False)
 
+    is_incremental = sa.Column(
+        sa.Boolean,
+        nullable=False,
+        default=False,
+        doc='If set, only export rows that have changed since the owner\'s '
+            'last export of the same contents')
+
+    format = sa.Column(
+        sa.Enum('csv', 'parquet', 'sqlite', name='export_format'),
+        nullable=False,
+        default='csv',
+        server_default='csv',
+        doc='The file format of the data files, or sqlite for a single '
+            'database of all data files')
+
+    layout = sa.Column(
+        sa.Enum('wide', 'long', name='export_layout'),
+        nullable=False,
+        default='wide',
+        server_default='wide',
+        doc='The layout of form data files, long for one row per value')
+
+    partition_by = sa.Column(
+        sa.Enum('site', 'study', name='export_partition'),
+        doc='If set, each data file is split into one file per site or '
+            'per study')
+
+    watermark = sa.Column(
+        sa.DateTime(timezone=True),
+        doc='The time up until which changes are guaranteed to be included '
+            'in this export. Subsequent incremental exports resume from here')
+
+    checkpoints = sa.Column(
+        JSONB,
+        doc='The data files of an unfinished export that have already been '
+            'added to its archive, each with the size of the archive after '
+            'it was added. Resumed exports continue from the last one')
+
+    estimated_cost = sa.Column(
+        sa.BigInteger,
+        doc='The number of values (rows times columns) the export\'s data '
+            'files were estimated to contain when it was requested. '
+            'Determines the lane the export is generated in')
+
+    actual_cost = sa.Column(
+        sa.BigInteger,
+        doc='The number of values actually generated for the export. '
+            'Data files reused from the cache are not counted')
+
+    started_at = sa.Column(
+        sa.DateTime(timezone=True),
+        doc='The time a worker started generating the export. Until then '
+            'the export is waiting in its queue')
+
     notify = sa.Column(
         sa.Boolean,
         nullable=False,
@@ -0,0 +1,239 @@
+"""
+Query entities by the values of their attributes.
+
+Finding the entities of a form that have a given answer does not require
+pivoting the form into a report (see ``reporting.build_report``), the
+predicates can be evaluated against ``Entity.data`` directly. Predicates
+are compiled into JSONB containment (``@>``), which the ``jsonb_path_ops``
+GIN index on ``entity.data`` supports, and into path expressions
+(``data->>'name'``) for ranges and null checks, which are supported by
+the per-attribute expression indexes created with ``valueindex``.
+
+Example::
+
+    values = querying.values(dbsession, u'HIVTest')
+    query = querying.entities(
+        dbsession, u'HIVTest',
+        values['hiv_result'] == u'positive',
+        models.Entity.collect_date >= date(2017, 1, 1))
+
+"""
+
+from sqlalchemy import cast, or_, null, Index, Numeric
+
+from . import models
+
+
+class Value(object):
+    """
+    An attribute of a form that can be compared against literal values
+
+    Comparisons are evaluated against the JSON document of the entity
+    and follow the attribute type: numbers are compared numerically,
+    dates and datetimes chronologically (their ISO strings sort the same
+    way) and everything else as text. Choice values are compared by code,
+    and collections match if any of their selected codes match.
+    """
+
+    def __init__(self, name, type, is_collection=False):
+        self.name = name
+        self.type = type
+        self.is_collection = is_collection
+
+    @property
+    def expression(self):
+        """
+        The (indexable) column expression of the value
+        """
+        return expression(self.name, self.type)
+
+    def __eq__(self, other):
+        if other is None:
+            return self.is_null()
+        if self.type == 'number':
+            return self.expression == other
+        if self.is_collection:
+            other = [other]
+        return models.Entity.data.contains({self.name: _literal(other)})
+
+    def __ne__(self, other):
+        if other is None:
+            return self.is_not_null()
+        return ~(self == other)
+
+    def __lt__(self, other):
+        return self.expression < _literal(other)
+
+    def __le__(self, other):
+        return self.expression <= _literal(other)
+
+    def __gt__(self, other):
+        return self.expression > _literal(other)
+
+    def __ge__(self, other):
+        return self.expression >= _literal(other)
+
+    __hash__ = object.__hash__
+
+    def between(self, lower, upper):
+        """
+        Matches values within an inclusive range
+        """
+        return self.expression.between(_literal(lower), _literal(upper))
+
+    def in_(self, others):
+        """
+        Matches values that are any of the specified values
+
+        For choices, this is choice membership: a collection matches if
+        any of its selected codes are in the specified codes.
+        """
+        if self.type == 'number':
+            return self.expression.in_(list(others))
+        return or_(*[self == other for other in others])
+
+    def contains(self, *others):
+        """
+        Matches collections that have all the specified codes selected
+        """
+        return models.Entity.data.contains(
+            {self.name: [_literal(other) for other in others]})
+
+    def is_null(self):
+        """
+        Matches unanswered values (missing or JSON null)
+        """
+        return models.Entity.data[self.name].astext == null()
+
+    def is_not_null(self):
+        """
+        Matches answered values
+        """
+        return models.Entity.data[self.name].astext != null()
+
+
+def expression(name, type):
+    """
+    Builds the expression of an attribute's value in ``Entity.data``
+
+    The expression is also used to create expression indexes, so it only
+    uses immutable functions: numbers are cast, while dates and datetimes
+    are left as text since casting text to dates depends on the session's
+    date style.
+
+    Parameters:
+    name -- the attribute name
+    type -- the attribute type
+
+    Returns:
+    A SQLAlchemy column expression over the ``Entity`` table
+    """
+    value = models.Entity.data[name].astext
+    if type == 'number':
+        value = cast(value, Numeric)
+    return value
+
+
+def values(session, schema_name):
+    """
+    Lists the queryable values of a form
+
+    Parameters:
+    session -- the database session to use
+    schema_name -- the name of the form
+
+    Returns:
+    A dictionary of ``Value`` objects keyed by attribute name, using the
+    attribute's type in the most recently published version.
+    """
+    query = (
+        session.query(models.Attribute)
+        .join(models.Schema)
+        .filter(models.Schema.name == schema_name)
+        .filter(models.Schema.publish_date != null())
+        .filter(models.Schema.retract_date == null())
+        .filter(models.Attribute.type != u'section')
+        .order_by(models.Schema.publish_date))
+
+    return dict(
+        (a.name, Value(a.name, a.type, a.is_collection)) for a in query)
+
+
+def schema_ids(session, schema_name):
+    """
+    Lists the ids of the published versions of a form
+
+    Queries and expression indexes are both restricted to these versions
+    so that partial indexes can be used by the planner.
+    """
+    query = (
+        session.query(models.Schema.id)
+        .filter(models.Schema.name == schema_name)
+        .filter(models.Schema.publish_date != null())
+        .filter(models.Schema.retract_date == null())
+        .order_by(models.Schema.id))
+    return [id for id, in query]
+
+
+def entities(session, schema_name, *criteria):
+    """
+    Queries the entities of a form that match the specified criteria
+
+    Parameters:
+    session -- the database session to use
+    schema_name -- the name of the form
+    criteria -- predicates built from ``values`` and/or ``Entity`` columns
+
+    Returns:
+    A query of ``Entity`` objects
+    """
+    ids = schema_ids(session, schema_name)
+    return (
+        session.query(models.Entity)
+        .filter(models.Entity.schema_id.in_(ids or [None]))
+        .filter(*criteria))
+
+
+def build_index(session, schema_name, name):
+    """
+    Builds the expression index of a form's attribute
+
+    The index is partial to the published versions of the form, since
+    other forms may use the same attribute name for values of another
+    type (that could not be cast). It needs to be rebuilt whenever a new
+    version of the form is published.
+
+    Parameters:
+    session -- the database session to use
+    schema_name -- the name of the form
+    name -- the attribute name
+
+    Returns:
+    A SQLAlchemy ``Index`` on the ``entity`` table, which still needs to
+    be created (or dropped)
+    """
+    value = values(session, schema_name)[name]
+    ids = schema_ids(session, schema_name)
+    index = Index(
+        index_name(schema_name, name),
+        value.expression,
+        postgresql_where=models.Entity.schema_id.in_(ids or [None]))
+    # Expression indexes are managed by hand, keep them out of the metadata
+    models.Entity.__table__.indexes.discard(index)
+    return index
+
+
+def index_name(schema_name, name):
+    """
+    Names the expression index of a form's attribute
+    """
+    return 'ix_entity_{}_{}'.format(schema_name, name).lower()
+
+
+def _literal(value):
+    """
+    Converts a value to the way it is stored in ``Entity.data``
+    """
+    if hasattr(value, 'isoformat'):
+        return str(value)
+    return value
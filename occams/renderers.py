@@ -7,20 +7,15 @@ and associated plugins must be enabled.
 
 from __future__ import division
 import collections
-from decimal import Decimal
 from datetime import date, datetime
 import os
 from itertools import groupby
 import cgi
 from decimal import ROUND_UP
-import tempfile
 
-import magic
 from pyramid.renderers import render
-from dateutil.parser import parse as dateutil_parse
 import six
 import sqlalchemy as sa
-from sqlalchemy.orm.attributes import flag_modified
 import wtforms
 import wtforms.fields.html5
 import wtforms.widgets.html5
@@ -28,6 +23,8 @@ import wtforms.ext.dateutil.fields
 from wtforms_components import DateRange
 
 from . import _, log, models
+from .blobs import BlobStore
+from .codec import get_codec, write_data
 from .fields import FileField
 
 
@@ -489,36 +486,17 @@ def entity_data(entity):
         }
     }
 
-    for attribute in entity.schema.iterleafs():
-
-        if attribute.parent_attribute:
-            parent = data.setdefault(attribute.parent_attribute.name, {})
-        else:
-            parent = data
-
-        if entity.data:
-            value = entity.data.get(attribute.name)
-        else:
-            value = None
-
-        if value is not None:
-            if attribute.type == 'number':
-                value = Decimal(value)
-            elif attribute.type == 'date':
-                value = dateutil_parse(value).date()
-            elif attribute.type == 'datetime':
-                value = dateutil_parse(value)
-            elif attribute.type == 'blob':
-                value = entity.attachments.get(value)
-
-        parent[attribute.name] = value
+    data.update(get_codec(entity.schema).decode(entity))
 
     return data
 
 
-def apply_data(session, entity, data, upload_path):
+def apply_data(session, entity, data, upload_path, max_size=None):
     """
     Updates an entity with a dictionary of data
+
+    Uploaded files are stored in the blob store at ``upload_path``, and
+    ``blobs.BlobTooLarge`` is raised if one exceeds ``max_size`` bytes.
     """
 
     assert upload_path is not None, u'Destination path is required'
@@ -549,12 +527,14 @@ def apply_data(session, entity, data, upload_path):
         else:
             entity.not_done = metadata['not_done']
         entity.collect_date = metadata['collect_date']
-        entity.schema = (
-            session.query(models.Schema)
-            .filter_by(
-                name=entity.schema.name,
-                publish_date=metadata['version'])
-            .one())
+        # Only look up the version if it was actually changed
+        if str(metadata['version']) != str(entity.schema.publish_date):
+            entity.schema = (
+                session.query(models.Schema)
+                .filter_by(
+                    name=entity.schema.name,
+                    publish_date=metadata['version'])
+                .one())
 
     clear_data = entity.not_done or next_state == states.PENDING_ENTRY
 
@@ -562,32 +542,33 @@ def apply_data(session, entity, data, upload_path):
         entity.data = None
         return entity
 
-    if entity.data is None:
-        entity.data = {}
+    document = entity.data or {}
+    values = {}
+    codec = get_codec(entity.schema)
 
-    for attribute in entity.schema.iterleafs():
+    for field in codec.fields:
 
         value = None
 
         # Find the appropriate attribute to update
-        if attribute.parent_attribute:
-            parent = data[attribute.parent_attribute.name]
+        if field.parent is not None:
+            parent = data[field.parent]
         else:
             parent = data
 
         # Accomodate patch data (i.e. incomplete data, for updates)
-        if attribute.name not in parent:
+        if field.name not in parent:
             continue
 
-        if attribute.type == 'blob':
-            # if data[attribute.name] is empty, it means field was empty
+        if field.type == 'blob':
+            # if parent[field.name] is empty, it means field was empty
             # Python 2.7-3.3 has a bug where FieldStorage will yield False
             # unexpectetly, so ensure that the actual key value is an
             # instance of FieldStorage
 
-            if isinstance(data[attribute.name], cgi.FieldStorage):
+            if isinstance(parent[field.name], cgi.FieldStorage):
 
-                previous_attachment_id = entity.data.get(attribute.name)
+                previous_attachment_id = document.get(field.name)
 
                 if previous_attachment_id:
                     try:
@@ -601,32 +582,22 @@ def apply_data(session, entity, data, upload_path):
                     else:
                         session.flush()
 
-                original_name = os.path.basename(data[attribute.name].filename)
+                original_name = os.path.basename(parent[field.name].filename)
 
-                input_file = data[attribute.name].file
-                output_file = tempfile.NamedTemporaryFile()
+                # Stream the upload straight into the blob store, which
+                # also sniffs its type and enforces the maximum size
+                input_file = parent[field.name].file
                 input_file.seek(0)
 
-                while True:
-                    chunk = input_file.read(2 << 16)
-                    if not chunk:
-                        break
-                    output_file.write(chunk)
-
-                # Ensure the data is commited to the file system before closing
-                output_file.flush()
-                os.fsync(output_file.fileno())
-                output_file.seek(0)
-
-                mime_type = magic.from_file(output_file.name, mime=True)
+                blob = models.EntityAttachmentBlob()
+                stored = BlobStore(upload_path).save(
+                    blob, input_file, max_size=max_size)
 
                 attachment = models.EntityAttachment(
                     entity=entity,
                     file_name=original_name,
-                    mime_type=mime_type,
-                    blob=models.EntityAttachmentBlob(
-                        content=output_file.read(),
-                    )
+                    mime_type=stored.mime_type,
+                    blob=blob
                 )
 
                 session.add(attachment)
@@ -634,18 +605,14 @@ def apply_data(session, entity, data, upload_path):
 
                 value = attachment.id
 
-            elif isinstance(data[attribute.name], models.EntityAttachment):
-                value = data[attribute.name].id
+            elif isinstance(parent[field.name], models.EntityAttachment):
+                value = parent[field.name].id
 
         else:
-            value = parent[attribute.name]
-
-        if value is not None \
-                and attribute.type in ('number', 'date', 'datetime'):
-            value = str(value)
+            value = codec.encode(field, parent[field.name])
 
-        entity.data[attribute.name] = value
+        values[field.name] = value
 
-    flag_modified(entity, 'data')
+    write_data(session, entity, values)
 
     return entity
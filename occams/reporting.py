@@ -8,7 +8,10 @@ except ImportError:  # pragma: nocover
     from ordereddict import OrderedDict
 
 from six import itervalues, iteritems
-from sqlalchemy import orm, cast, null, literal, Integer, case, Unicode
+from sqlalchemy import (
+    orm, cast, func, null, literal, literal_column, select, case, true,
+    Integer, Numeric, Unicode)
+from sqlalchemy.dialects.postgresql import JSONB
 
 from . import models
 from .utils.sql import group_concat, to_date, to_datetime
@@ -21,10 +24,15 @@ def build_report(session,
                  expand_collections=False,
                  use_choice_labels=False,
                  context=None,
-                 ignore_private=True):
+                 ignore_private=True,
+                 condition=None):
     """
     Builds a schema entity data report query table from the data dictioanry.
 
+    Every column is projected directly out of the entity's JSONB document so
+    that the report is generated in a single pass over the entity table,
+    regardless of how many attributes the schema has.
+
     Parameters:
     session -- The database session to use
     schema_name -- The name of the schema
@@ -35,6 +43,11 @@ def build_report(session,
                          (default is False)
     use_choice_labels -- (Optional) Uses choice labels instead of codes
                          (default is False)
+    context -- (Optional) Includes the key of the specified context external
+    ignore_private -- (Optional) De-identifies private columns
+                      (default is True)
+    condition -- (Optional) Only include the entities that match this
+                 condition on ``Entity``
 
     Returns:
     A SQLAlchemy aliased sub-query. Depending on the database driver,
@@ -55,6 +68,7 @@ def build_report(session,
             models.State.name.label('state'),
             models.Entity.collect_date.label('collect_date'),
             cast(models.Entity.not_done, Integer).label('not_done'))
+        .select_from(models.Entity)
         .outerjoin(models.State)
         .join(models.Schema)
         .filter(models.Schema.name == schema_name)
@@ -64,6 +78,9 @@ def build_report(session,
     if ids:
         query = query.filter(models.Schema.id.in_(ids))
 
+    if condition is not None:
+        query = query.filter(condition)
+
     if context:
         query = (
             query
@@ -87,106 +104,213 @@ def build_report(session,
             query = query.add_column(literal(u'[PRIVATE]').label(column.name))
             continue
 
-        # evaluate the target mapped class and casted value column
-        Value = orm.aliased(models.nameModelMap[column.type])
-        value_column = Value._value
-
-        if column.type in ('date', 'datetime'):
-            # Cast datetimes to match their attribute types
-            conv = to_date if column.type == 'date' else to_datetime
-            value_column = conv(Value._value)
-
-        if column.type == 'blob':
-            value_column = case(
-                whens=[((value_column != null()), literal(u'[FILE]'))],
-                else_=null())
-
-        filter_expression = (
-            (models.Entity.id == Value.entity_id)
-            & (Value.attribute_id.in_([a.id for a in column.attributes])))
-
-        Choice = orm.aliased(models.Choice)
-
-        if column.is_collection:
-            # Collections are added via correlated sub-queries to the entity
-            if not expand_collections:
-
-                if use_choice_labels:
-                    value_column = Choice.title
-                else:
-                    value_column = Choice.name
-
-                # Not all vendors suppoar ARRAY, so we just concatenate the
-                # and let clients deal with spliting
-                value_column = (
-                    session.query(group_concat(value_column, ';'))
-                    .select_from(Value)
-                    .filter(filter_expression)
-                    .join(Choice)
-                    .group_by(Value.attribute_id)
-                    .correlate(models.Entity)
-                    .as_scalar())
-
-            else:
-                selected_exists = (
-                    session.query(Value)
-                    .join(Choice, Value._value == Choice.id)
-                    .filter(filter_expression)
-                    .filter(Choice.name == column.choice.name)
-                    .correlate(models.Entity)
-                    .exists())
-
-                if use_choice_labels:
-                    selected_value_column = (
-                        session.query(
-                            cast(literal(column.choice.title), Unicode))
-                        .filter(selected_exists)
-                        .as_scalar())
-                else:
-                    selected_value_column = (
-                        session.query(cast(selected_exists, Integer))
-                        .as_scalar())
-
-                is_selected = (
-                    session.query(Value)
-                    .filter(filter_expression)
-                    .correlate(models.Entity)
-                    .exists())
-
-                value_column = case([(is_selected, selected_value_column)])
-
-        else:
-            # Scalar columns are added via LEFT OUTER JOIN
-            query = query.outerjoin(Value, filter_expression)
-
-            if column.type == 'choice':
-                Choice = orm.aliased(models.Choice)
-                query = query.outerjoin(Choice, Value._value == Choice.id)
-                if use_choice_labels:
-                    value_column = Choice.title
-                else:
-                    value_column = Choice.name
-
+        value_column = build_value(column, use_choice_labels)
         query = query.add_column(value_column.label(column.name))
 
-    CreateUser = orm.aliased(models.User)
-    ModifyUser = orm.aliased(models.User)
-
     query = (
         query
-        .join(CreateUser, models.Entity.create_user)
-        .join(ModifyUser, models.Entity.modify_user)
         .add_columns(
-            models.Entity.create_date,
-            CreateUser.key.label('create_user'),
-            models.Entity.modify_date,
-            ModifyUser.key.label('modify_user'))
+            models.Entity.created_at,
+            models.Entity.created_by,
+            models.Entity.modified_at,
+            models.Entity.modified_by)
         .order_by(models.Entity.id))
 
     return query.cte(schema_name) \
         if not is_sqlite else query.subquery(schema_name)
 
 
+def build_long_report(session,
+                      schema_name,
+                      ids=None,
+                      use_choice_labels=False,
+                      ignore_private=True,
+                      condition=None):
+    """
+    Builds a schema entity data report query with one row per value
+
+    Sparse schemata with many optional attributes make for very wide
+    reports that are mostly blank. Instead, each entity's JSONB document
+    is expanded with ``jsonb_each`` into (id, attribute, value) rows, so
+    the report is still generated in a single pass over the entity table
+    and blank values are never generated at all. Collections are expanded
+    to one row per selected value.
+
+    Parameters:
+    session -- The database session to use
+    schema_name -- The name of the schema
+    ids -- (Optional) The spcific ids to include in the report
+    use_choice_labels -- (Optional) Uses choice labels instead of codes
+                         (default is False)
+    ignore_private -- (Optional) De-identifies private values, which are
+                      never expanded so not even their number is revealed
+                      (default is True)
+    condition -- (Optional) Only include the entities that match this
+                 condition on ``Entity``
+
+    Returns:
+    A SQLAlchemy aliased sub-query (PostgreSQL only) with the columns
+    ``id``, ``attribute``, ``value`` and ``modified_at``
+    """
+    columns = build_columns(session, schema_name, ids)
+
+    field = func.jsonb_each(models.Entity.data).alias('field')
+    key = literal_column('field.key', Unicode)
+    document = literal_column('field.value', JSONB)
+
+    private = [c.name for c in itervalues(columns)
+               if c.is_private and ignore_private]
+    blobs = [c.name for c in itervalues(columns) if c.type == 'blob']
+
+    is_expanded = func.jsonb_typeof(document) == u'array'
+    if private:
+        is_expanded &= key.notin_(private)
+
+    element = (
+        func.jsonb_array_elements_text(
+            case([(is_expanded, document)],
+                 else_=func.jsonb_build_array(document)))
+        .alias('element'))
+    value = literal_column('element', Unicode)
+
+    whens = []
+
+    if private:
+        whens.append((key.in_(private), literal(u'[PRIVATE]')))
+
+    if blobs:
+        whens.append((key.in_(blobs), literal(u'[FILE]')))
+
+    if use_choice_labels:
+        choices = [c for c in itervalues(columns) if c.type == 'choice']
+        for column in choices:
+            for code, label in sorted(iteritems(column.choices)):
+                whens.append(
+                    ((key == column.name) & (value == code), literal(label)))
+        if choices:
+            # Same as ``choice_label``, unknown codes are left blank
+            whens.append((
+                key.in_([c.name for c in choices]), cast(null(), Unicode)))
+
+    if whens:
+        value = case(whens, else_=value)
+
+    query = (
+        session.query(
+            models.Entity.id.label('id'),
+            key.label('attribute'),
+            value.label('value'),
+            models.Entity.modified_at.label('modified_at'))
+        .select_from(models.Entity)
+        .join(models.Schema)
+        .join(field, true())
+        .join(element, true())
+        .filter(models.Schema.name == schema_name)
+        .filter(models.Schema.publish_date != null())
+        .filter(models.Schema.retract_date == null())
+        .filter(key.in_(list(columns)))
+        .filter(func.jsonb_typeof(document) != u'null')
+        .order_by(models.Entity.id))
+
+    if ids:
+        query = query.filter(models.Schema.id.in_(ids))
+
+    if condition is not None:
+        query = query.filter(condition)
+
+    return query.cte(schema_name + '_long')
+
+
+def build_value(column, use_choice_labels=False):
+    """
+    Compiles a report column into an expression over ``Entity.data``
+
+    Scalar values are extracted as text (``->>``) and casted to the
+    column's type. Collections are expanded from the JSON array with a
+    correlated set-returning function, so no joins against other tables
+    are needed to generate the value.
+
+    Parameters:
+    column -- the ``DataColumn`` to compile
+    use_choice_labels -- (Optional) Uses choice labels instead of codes
+                         (default is False)
+
+    Returns:
+    A SQLAlchemy column expression correlated to the ``Entity`` table
+    """
+    # Expanded columns are suffixed with the choice code, the document
+    # is still keyed by the attribute name
+    document = models.Entity.data[column.attributes[0].name]
+
+    if column.is_collection:
+        # Guard against JSON nulls since array functions fail on scalars
+        array_value = case([(func.jsonb_typeof(document) == u'array',
+                             document)])
+
+        if column.choice is not None:
+            selected = document.contains([column.choice.name])
+
+            if use_choice_labels:
+                selected_value = case(
+                    [(selected, cast(literal(column.choice.title), Unicode))])
+            else:
+                selected_value = cast(selected, Integer)
+
+            # Leave blank (not zero) if nothing was selected at all
+            is_selected = func.jsonb_array_length(array_value) > 0
+            return case([(is_selected, selected_value)])
+
+        value_column = literal_column('value', Unicode)
+
+        if column.type == 'choice' and use_choice_labels:
+            value_column = choice_label(value_column, column.choices)
+
+        # Not all vendors suppoar ARRAY, so we just concatenate the
+        # and let clients deal with spliting
+        return (
+            select([group_concat(value_column, ';')])
+            .select_from(
+                func.jsonb_array_elements_text(array_value).alias('value'))
+            .as_scalar())
+
+    value_column = document.astext
+
+    if column.type == 'choice':
+        if use_choice_labels:
+            value_column = choice_label(value_column, column.choices)
+
+    elif column.type == 'number':
+        value_column = cast(value_column, Numeric)
+
+    elif column.type in ('date', 'datetime'):
+        # Cast datetimes to match their attribute types
+        conv = to_date if column.type == 'date' else to_datetime
+        value_column = conv(value_column)
+
+    elif column.type == 'blob':
+        value_column = case(
+            whens=[((value_column != null()), literal(u'[FILE]'))],
+            else_=null())
+
+    return value_column
+
+
+def choice_label(value_column, choices):
+    """
+    Maps choice codes to their labels
+
+    Parameters:
+    value_column -- the column expression containing the choice code
+    choices -- a dictionary of (code, label) pairs
+
+    Returns:
+    A CASE expression of the label, NULL if the code is not a choice
+    """
+    if not choices:
+        return cast(null(), Unicode)
+    return case(choices, value=value_column)
+
+
 def build_columns(session, schema_name, ids=None, expand_collections=False):
     """
     Helper method to determine the columns of the report to generate
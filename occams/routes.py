@@ -32,6 +32,7 @@ def includeme(config):
 
     config.add_route('studies.exports',                     '/studies/exports',                         factory=models.ExportFactory)
     config.add_route('studies.exports_checkout',            '/studies/exports/checkout',                factory=models.ExportFactory)
+    config.add_route('studies.exports_stream',              '/studies/exports/stream',                  factory=models.ExportFactory)
     config.add_route('studies.exports_status',              '/studies/exports/status',                  factory=models.ExportFactory)
     config.add_route('studies.exports_notifications',       '/studies/exports/notifications',           factory=models.ExportFactory)
     config.add_route('studies.exports_faq',                 '/studies/exports/faq',                     factory=models.ExportFactory)
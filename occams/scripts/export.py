@@ -72,6 +72,34 @@ def parse_args(argv=sys.argv):
         dest='show_private',
         action='store_true',
         help='De-identifies private data.')
+    export_group.add_argument(
+        '--layout',
+        choices=exports.LAYOUTS,
+        default='wide',
+        help='Layout of form data files (long has one row per value)')
+    export_group.add_argument(
+        '--partition',
+        choices=exports.partition.PARTITIONS,
+        help='Split each data file into one file per site or study '
+             '(listed in manifest.csv)')
+    export_group.add_argument(
+        '--fetch-size',
+        metavar='ROWS',
+        dest='fetch_size',
+        type=int,
+        default=exports.FETCH_SIZE,
+        help='Number of rows to stream from the database at a time')
+    export_group.add_argument(
+        '--use-copy',
+        dest='use_copy',
+        action='store_true',
+        help='Have PostgreSQL generate the CSV files using COPY')
+    export_group.add_argument(
+        '--format',
+        choices=exports.FORMATS,
+        default='csv',
+        help='File format of the data files (parquet requires pyarrow, '
+             'sqlite generates a single database)')
     export_group.add_argument(
         '--dir',
         metavar='PATH',
@@ -110,9 +138,7 @@ def print_list(args, env):
 
     header = ['sys', 'priv', 'rand', 'name', 'title']
     dbsession = env['request'].dbsession
-    plans = exports.plans
-    rows = iter(format(e) for e in itervalues(
-        exports.list_all(plans, dbsession)))
+    rows = iter(format(e) for e in itervalues(exports.list_all(dbsession)))
     print(tabulate(rows, header, tablefmt='simple'))
 
 
@@ -128,9 +154,11 @@ def make_export(args, env):
             or args.names):
         sys.exit('You must specifiy something to export!')
 
+    if args.format not in exports.available_formats():
+        sys.exit('The %s format is not available!' % args.format)
+
     dbsession = env['request'].dbsession
-    plans = exports.plans
-    exportables = exports.list_all(plans, dbsession)
+    exportables = exports.list_all(dbsession)
 
     if args.atomic:
         out_dir = '%s-%s' % (args.dir.rstrip('/'), uuid.uuid4())
@@ -140,25 +168,69 @@ def make_export(args, env):
         if not os.path.exists(args.dir):
             os.makedirs(args.dir)
 
-    for plan in itervalues(exportables):
+    if args.format == 'sqlite':
+        database = exports.database.connect(
+            os.path.join(out_dir, exports.database.FILE_NAME))
+    else:
+        database = None
+
+    selected = [
+        plan for plan in itervalues(exportables)
         if (args.all
-                or (args.all_private
-                    and plan.has_private
-                    and not plan.has_rand)
-                or (args.all_public
-                    and not plan.has_private
-                    and not plan.has_rand)
-                or (args.all_rand and plan.has_rand)
-                or (args.names and plan.name in args.names)):
-            with open(os.path.join(out_dir, plan.file_name), 'w+b') as fp:
-                exports.write_data(fp, plan.data(
-                    use_choice_labels=args.use_choice_labels,
-                    expand_collections=args.expand_collections,
-                    ignore_private=not args.show_private))
-
-    with open(os.path.join(out_dir, exports.codebook.FILE_NAME), 'w+b') as fp:
-        codebooks = [p.codebook() for p in itervalues(exportables)]
-        exports.write_codebook(fp, chain.from_iterable(codebooks))
+            or (args.all_private and plan.has_private and not plan.has_rand)
+            or (args.all_public
+                and not plan.has_private
+                and not plan.has_rand)
+            or (args.all_rand and plan.has_rand)
+            or (args.names and plan.name in args.names))]
+
+    if database is None and args.partition:
+        partitions = exports.partition.split(selected, args.partition)
+    else:
+        partitions = selected
+
+    for plan in partitions:
+        query = plan.data(
+            use_choice_labels=args.use_choice_labels,
+            expand_collections=args.expand_collections,
+            ignore_private=not args.show_private,
+            layout=args.layout)
+        if database is not None:
+            exports.database.load_table(
+                database, plan.name, query, list(plan.codebook()),
+                fetch_size=args.fetch_size)
+            continue
+        path = os.path.join(
+            out_dir, exports.data_file_name(plan, args.format))
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w+b') as fp:
+            if args.format == 'parquet':
+                exports.columnar.write_parquet(
+                    fp, query, list(plan.codebook()),
+                    fetch_size=args.fetch_size,
+                    ignore_private=not args.show_private)
+            elif args.use_copy:
+                exports.copy_data(fp, query)
+            else:
+                exports.write_data(fp, query, fetch_size=args.fetch_size)
+
+    if partitions is not selected:
+        manifest_path = os.path.join(
+            out_dir, exports.partition.MANIFEST_FILE_NAME)
+        with open(manifest_path, 'w+b') as fp:
+            exports.write_manifest(fp, partitions, args.format)
+
+    codebooks = [p.codebook() for p in itervalues(exportables)]
+
+    if database is not None:
+        exports.database.load_codebook(
+            database, chain.from_iterable(codebooks))
+        database.close()
+    else:
+        codebook_path = os.path.join(out_dir, exports.codebook.FILE_NAME)
+        with open(codebook_path, 'w+b') as fp:
+            exports.write_codebook(fp, chain.from_iterable(codebooks))
 
     if args.atomic:
         old_dir = os.path.realpath(args.dir)
@@ -0,0 +1,95 @@
+"""
+Moves attachment files out of the database and into the blob store
+
+Blobs are moved in batches, each in its own transaction, so the command
+can be interrupted and run again to resume where it left off. The space
+freed in the ``entity_attachment_blob`` table is only returned to the
+file system once the table is vacuumed (``VACUUM FULL``).
+"""
+
+import argparse
+import sys
+
+from pyramid.paster import bootstrap, setup_logging
+import sqlalchemy as sa
+import transaction
+
+from .. import models
+from ..blobs import BlobStore
+
+
+# Number of blobs moved per transaction
+BATCH_SIZE = 100
+
+
+def parse_args(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description='Move attachment files to the blob store.')
+    parser.add_argument(
+        '-c', '--config',
+        metavar='INI',
+        dest='config',
+        help='Application INI file')
+    parser.add_argument(
+        '--batch-size',
+        metavar='BLOBS',
+        dest='batch_size',
+        type=int,
+        default=BATCH_SIZE,
+        help='Number of blobs to move per transaction')
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv[1:])
+
+    setup_logging(args.config)
+    env = bootstrap(args.config)
+
+    registry = env['registry']
+    store = BlobStore(registry.settings['studies.blob.dir'])
+    session_factory = registry['dbsession_factory']
+    blame = models.get_blame_from_url(session_factory.kw['bind'].url)
+
+    while True:
+        with transaction.manager:
+            dbsession = models.get_tm_session(
+                session_factory, transaction.manager)
+            models.set_pg_locals(dbsession, 'occams_migrateblobs', blame)
+            moved = migrate_batch(dbsession, store, args.batch_size)
+
+        if not moved:
+            break
+
+        print('Moved %d blobs' % moved)
+
+
+def migrate_batch(dbsession, store, batch_size=BATCH_SIZE):
+    """
+    Moves a batch of blobs still stored in the database to the blob store
+
+    Parameters:
+    dbsession -- the database session
+    store -- the ``BlobStore`` to move the blobs to
+    batch_size -- (Optional) the maximum number of blobs to move
+
+    Returns:
+    The number of blobs moved, zero once all blobs were moved
+    """
+    Blob = models.EntityAttachmentBlob
+
+    blobs = (
+        dbsession.query(Blob)
+        .filter(Blob.digest == sa.null())
+        .order_by(Blob.id)
+        .limit(batch_size)
+        # Do not move the same blobs as another running migration
+        .with_for_update(skip_locked=True)
+        .all())
+
+    for blob in blobs:
+        store.save(blob, store.open(blob))
+
+    dbsession.flush()
+
+    return len(blobs)
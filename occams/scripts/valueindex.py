@@ -0,0 +1,101 @@
+"""
+Command-line interface for indexing frequently queried form values
+
+Creates an expression index on ``entity.data`` for each attribute, so
+that lookups built with ``occams.querying`` (equality, ranges and null
+checks on those attributes) are index scans. The indexes only cover the
+currently published versions of the form, so they should be recreated
+whenever a new version is published.
+
+Indexes are built concurrently, so the entity table stays writable while
+they are being built.
+"""
+
+import argparse
+import sys
+
+from pyramid.paster import bootstrap, setup_logging
+from sqlalchemy.schema import CreateIndex, DropIndex
+
+from .. import querying
+
+
+def parse_args(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description='Manage expression indexes of form values.')
+    parser.add_argument(
+        '-c', '--config',
+        metavar='INI',
+        dest='config',
+        help='Application INI file')
+    parser.add_argument(
+        '--drop',
+        action='store_true',
+        help='Drop the indexes instead of creating them')
+    parser.add_argument(
+        'form',
+        metavar='FORM',
+        help='The name of the form')
+    parser.add_argument(
+        'names',
+        metavar='NAME',
+        nargs='+',
+        help='The attributes to index')
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv[1:])
+
+    setup_logging(args.config)
+    env = bootstrap(args.config)
+
+    dbsession = env['request'].dbsession
+    statements = build_statements(dbsession, args.form, args.names, args.drop)
+
+    # Concurrent index builds cannot be run within a transaction
+    engine = dbsession.get_bind()
+    with engine.connect() as connection:
+        connection = connection.execution_options(
+            isolation_level='AUTOCOMMIT')
+        for statement in statements:
+            print(statement)
+            connection.execute(statement)
+
+
+def build_statements(dbsession, form, names, drop=False):
+    """
+    Builds the DDL statements of the indexes of a form's attributes
+
+    Parameters:
+    dbsession -- the database session to use
+    form -- the name of the form
+    names -- the attribute names
+    drop -- (Optional) Drop the indexes instead of creating them
+
+    Returns:
+    A list of compiled DDL statements
+    """
+    values = querying.values(dbsession, form)
+    unknown = sorted(set(names) - set(values))
+
+    if unknown:
+        sys.exit('Unknown attributes: %s' % ', '.join(unknown))
+
+    statements = []
+    engine = dbsession.get_bind()
+
+    for name in names:
+        index = querying.build_index(dbsession, form, name)
+        if drop:
+            ddl = DropIndex(index)
+            sql = str(ddl.compile(dialect=engine.dialect)).strip()
+            sql = sql.replace(
+                'DROP INDEX', 'DROP INDEX CONCURRENTLY IF EXISTS', 1)
+        else:
+            index.dialect_options['postgresql']['concurrently'] = True
+            ddl = CreateIndex(index)
+            sql = str(ddl.compile(dialect=engine.dialect)).strip()
+        statements.append(sql)
+
+    return statements
@@ -12,12 +12,17 @@ function Export(data) {
   self.status = ko.observable();
   self.use_choice_labels = ko.observable();
   self.expand_collections = ko.observable();
+  self.is_incremental = ko.observable();
   self.contents = ko.observable();
   self.count = ko.observable();
   self.total = ko.observable();
+  self.rows = ko.observable();
+  self.estimated_rows = ko.observable();
+  self.eta = ko.observable();
   self.file_size = ko.observable();
   self.download_url = ko.observable();
   self.delete_url = ko.observable();
+  self.resume_url = ko.observable();
   self.create_date = ko.observable();
   self.expire_date = ko.observable();
 
@@ -29,23 +34,50 @@ function Export(data) {
     self.status(data.status);
     self.use_choice_labels(data.use_choice_labels);
     self.expand_collections(data.expand_collections);
+    self.is_incremental(data.is_incremental);
     self.contents(data.contents);
     self.count(data.count);
     self.total(data.total);
+    self.rows(data.rows);
+    self.estimated_rows(data.estimated_rows);
+    self.eta(data.eta);
     self.file_size(data.file_size);
     self.download_url(data.download_url);
     self.delete_url(data.delete_url);
+    self.resume_url(data.resume_url);
     self.create_date(data.create_date);
     self.expire_date(data.expire_date);
   };
 
   /**
    * Calculates this export's current progress
+   *
+   * Rows are more granular than files, but only estimated, so the export
+   * is never shown as done until all its files are.
    */
   self.progress = ko.pureComputed(function(){
+    if (self.estimated_rows() && self.count() < self.total()){
+      return Math.min(
+        99, Math.floor((self.rows() / self.estimated_rows()) * 100));
+    }
     return Math.ceil((self.count() / self.total()) * 100);
   }).extend({ throttle: 1 });
 
+  /**
+   * Rounds the estimated time left for display
+   */
+  self.eta_text = ko.pureComputed(function(){
+    var eta = self.eta();
+    if (eta === null || eta === undefined){
+      return null;
+    }
+    if (eta < 60){
+      return 'Less than a minute left';
+    }
+    var minutes = Math.round(eta / 60);
+    return 'About ' + minutes + (minutes == 1 ? ' minute' : ' minutes') + ' left';
+  });
+
   self.update(data);
 }
 
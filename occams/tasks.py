@@ -17,21 +17,68 @@ try:
 except ImportError:  # pragma: nocover
     from ordereddict import OrderedDict  # NOQA
 from contextlib import closing
-from itertools import chain
+from copy import copy
+import errno
+from functools import partial
+import hashlib
 import json
+from multiprocessing.pool import ThreadPool
 import os
+import shutil
+import sys
 import tempfile
-from zipfile import ZipFile, ZIP_DEFLATED
+import threading
+import time
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 
 import celery.signals
 import humanize
+from pyramid.settings import asbool
+from redis import WatchError
 import six
+import sqlalchemy as sa
+from sqlalchemy import orm
 
 from occams.celery import app, Session, log, with_transaction
 
 from . import models, exports
 
 
+# Number of bytes to copy at a time from cached files
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Seconds during which identical exports can attach to an export in flight,
+# in case its task is lost without ever finishing
+FLIGHT_TTL = 24 * 60 * 60
+
+# Compression methods of the export archive members
+COMPRESSION = {
+    'deflated': ZIP_DEFLATED,
+    'stored': ZIP_STORED,
+}
+
+# Exports estimated to generate at most this many values (rows times
+# columns) are queued in the fast lane, anything larger in the heavy lane
+FAST_LANE_COST = 1000000
+
+# Default maximum number of exports generated at the same time per user
+USER_CONCURRENCY = 2
+
+# Default maximum number of heavy lane exports generated at the same time
+HEAVY_CONCURRENCY = 2
+
+# Seconds to wait before trying again to start an export that is over
+# its concurrency limits
+DEFER_COUNTDOWN = 30
+
+# Seconds after which a running export's slot is considered abandoned,
+# in case its worker died without releasing it
+SLOT_TTL = 6 * 60 * 60
+
+# Default minimum number of seconds between progress updates of an export
+PROGRESS_INTERVAL = 1.0
+
+
 def includeme(config):
     """
     Configures the Celery connection from the pyramid side of the application.
@@ -60,6 +107,50 @@ def includeme(config):
         settings['studies.export.expire'] = \
             int(settings['studies.export.expire'])
 
+    if 'studies.export.fetch_size' in settings:
+        settings['studies.export.fetch_size'] = \
+            int(settings['studies.export.fetch_size'])
+
+    settings['studies.export.use_copy'] = \
+        asbool(settings.get('studies.export.use_copy'))
+
+    if 'studies.export.parallelism' in settings:
+        settings['studies.export.parallelism'] = \
+            int(settings['studies.export.parallelism'])
+
+    if 'studies.export.cache_size' in settings:
+        settings['studies.export.cache_size'] = \
+            int(settings['studies.export.cache_size'])
+
+    if 'studies.export.stream_limit' in settings:
+        settings['studies.export.stream_limit'] = \
+            int(settings['studies.export.stream_limit'])
+
+    compression = settings.get('studies.export.compression', 'deflated')
+    assert compression in COMPRESSION, \
+        'Unsupported compression: %s' % compression
+    settings['studies.export.compression'] = compression
+
+    if 'studies.export.compression_level' in settings:
+        settings['studies.export.compression_level'] = \
+            int(settings['studies.export.compression_level'])
+
+    if 'studies.export.fast_lane_cost' in settings:
+        settings['studies.export.fast_lane_cost'] = \
+            int(settings['studies.export.fast_lane_cost'])
+
+    if 'studies.export.user_concurrency' in settings:
+        settings['studies.export.user_concurrency'] = \
+            int(settings['studies.export.user_concurrency'])
+
+    if 'studies.export.heavy_concurrency' in settings:
+        settings['studies.export.heavy_concurrency'] = \
+            int(settings['studies.export.heavy_concurrency'])
+
+    if 'studies.export.progress_interval' in settings:
+        settings['studies.export.progress_interval'] = \
+            float(settings['studies.export.progress_interval'])
+
 
 @celery.signals.celeryd_after_setup.connect
 def on_celeryd_after_setup(**kw):
@@ -88,10 +179,274 @@ class ExportTask(celery.Task):
         redis.hset(export.redis_key, 'status', export.status)
         redis.publish('export', json.dumps(redis.hgetall(export.redis_key)))
 
+        # Exports attached to this one would otherwise wait forever
+        flight = kwargs.get('flight')
+        if flight is not None:
+            names = _land_flight(redis, flight, task_id)
+            for follower in _query_followers(names):
+                follower.status = u'failed'
+                redis.hset(follower.redis_key, 'status', follower.status)
+                redis.publish(
+                    'export', json.dumps(redis.hgetall(follower.redis_key)))
+
+
+def flight_key(plans, options, format='csv', partition_by=None):
+    """
+    Generates the key that identifies identical exports
+
+    Exports of the same versions of the same plans, requested with the
+    same options, produce the same archive. The key is generated while
+    the export is being requested, so it is derived from the request
+    alone rather than from the data, which would have to be queried. An
+    export attached to one in flight therefore receives data read after
+    the export in flight was requested, which can be older than its own
+    request by up to the time it takes to generate.
+
+    Parameters:
+    plans -- the plans of the export
+    options -- the options the export is generated with
+    format -- (Optional) the format of the export's data files
+    partition_by -- (Optional) what the export's plans are partitioned by
+
+    Returns:
+    A redis key string
+    """
+    content = json.dumps({
+        'plans': [plan.to_json() for plan in plans],
+        'options': _file_options(options, format),
+        'partition_by': partition_by,
+    }, sort_keys=True)
+    return 'export:flight:' + hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def queue_export(redis, name, flight=None, cost=None, countdown=4):
+    """
+    Queues an export for generation
+
+    If an identical export is already being generated (i.e. it is in
+    flight), the export is attached to it instead of being queued. Once
+    done, the export in flight links its archive to every export attached
+    to it.
+
+    Otherwise the export is queued in the lane that matches its estimated
+    cost (see ``export_lane``), so that small exports are not stuck behind
+    large ones.
+
+    Parameters:
+    redis -- redis connection
+    name -- the export to queue
+    flight -- (Optional) key of identical exports, see ``flight_key``
+    cost -- (Optional) estimated cost of the export, see ``estimate_cost``
+    countdown -- (Optional) number of seconds to wait before starting
+
+    Returns:
+    The name of the export in flight the export was attached to, if any
+    """
+    if flight is not None:
+        leader = _join_flight(redis, flight, name)
+        if leader is not None:
+            log.info('Export {} attached to {}'.format(name, leader))
+            return leader
+
+    _dispatch(name, flight, export_lane(cost), countdown)
+
+
+def estimate_cost(plans, options):
+    """
+    Estimates the cost of generating an export
+
+    The cost is the number of values (rows times columns) in the export's
+    data files. Row counts are the query planner's estimates, which are
+    derived from the database statistics, so the estimate is cheap to
+    compute but only as accurate as the statistics are recent.
+
+    Parameters:
+    plans -- the plans of the export
+    options -- the options the export is generated with
+
+    Returns:
+    The estimated number of values
+    """
+    return sum(plan.estimate(**options) for plan in plans)
+
+
+def export_lane(cost):
+    """
+    Determines the lane an export is generated in
+
+    Parameters:
+    cost -- the estimated cost of the export, or None if unknown
+
+    Returns:
+    Either ``'fast'`` or ``'heavy'``. Exports of unknown cost are
+    assumed to be heavy.
+    """
+    limit = app.settings.get('studies.export.fast_lane_cost', FAST_LANE_COST)
+    if cost is not None and cost <= limit:
+        return 'fast'
+    return 'heavy'
+
+
+def _dispatch(name, flight, lane, countdown):
+    """
+    Sends an export's task to the queue of its lane
+
+    Lanes without a configured queue use Celery's default queue.
+    """
+    queue = app.settings.get('studies.export.{}_queue'.format(lane))
+    options = {'queue': queue} if queue else {}
+    make_export.apply_async(
+        args=[name],
+        kwargs={'flight': flight},
+        task_id=name,
+        countdown=countdown,
+        **options)
+
+
+def _slots(export, lane):
+    """
+    Lists the concurrency limits that apply to an export
+
+    Returns:
+    A list of (redis key, limit) tuples
+    """
+    settings = app.settings
+    slots = [(
+        'export:running:user:' + export.owner_user.key,
+        settings.get('studies.export.user_concurrency', USER_CONCURRENCY))]
+    if lane == 'heavy':
+        slots.append((
+            'export:running:heavy',
+            settings.get(
+                'studies.export.heavy_concurrency', HEAVY_CONCURRENCY)))
+    return slots
+
+
+def _acquire_slots(redis, slots, name):
+    """
+    Reserves a slot under every concurrency limit for a running export
+
+    Each limit is a redis hash of the running exports and the time their
+    slot expires, so that slots of workers that died are eventually
+    reclaimed. An export that already holds its slots (e.g. when it is
+    redelivered) gets them back.
+
+    Returns:
+    True if the slots were reserved, False if any limit has been reached
+    """
+    keys = [key for key, _ in slots]
+    with redis.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(*keys)
+                now = time.time()
+                expired = []
+                for key, limit in slots:
+                    running = 0
+                    for other, expires in pipe.hgetall(key).items():
+                        other = _text(other)
+                        if float(expires) < now:
+                            expired.append((key, other))
+                        elif other != name:
+                            running += 1
+                    if running >= limit:
+                        pipe.reset()
+                        return False
+                pipe.multi()
+                for key, stale in expired:
+                    pipe.hdel(key, stale)
+                for key in keys:
+                    pipe.hset(key, name, now + SLOT_TTL)
+                pipe.execute()
+                return True
+            except WatchError:
+                continue
+
+
+def _refresh_slots(redis, slots, name):
+    """
+    Keeps the slots of a long-running export from expiring
+    """
+    expires = time.time() + SLOT_TTL
+    for key, _ in slots:
+        redis.hset(key, name, expires)
+
 
-@celery.task(name='make_export', base=ExportTask, ignore_result=True)
+def _release_slots(redis, slots, name):
+    for key, _ in slots:
+        redis.hdel(key, name)
+
+
+def _join_flight(redis, flight, name):
+    """
+    Attaches an export to the export in flight, or puts it in flight
+
+    Returns:
+    The name of the export in flight, or None if the export is now in
+    flight itself
+    """
+    with redis.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(flight)
+                leader = pipe.get(flight)
+                pipe.multi()
+                if leader is None:
+                    pipe.set(flight, name, ex=FLIGHT_TTL)
+                else:
+                    pipe.sadd(flight + ':followers', name)
+                pipe.execute()
+                return _text(leader) if leader is not None else None
+            except WatchError:
+                continue
+
+
+def _land_flight(redis, flight, name):
+    """
+    Stops accepting identical exports
+
+    Returns:
+    The names of the exports attached to the export in flight
+    """
+    followers = flight + ':followers'
+    with redis.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(flight, followers)
+                if _text(pipe.get(flight)) != name:
+                    return []
+                names = [_text(n) for n in pipe.smembers(followers)]
+                pipe.multi()
+                pipe.delete(flight, followers)
+                pipe.execute()
+                return names
+            except WatchError:
+                continue
+
+
+def _query_followers(names):
+    """
+    Returns the pending exports with the specified names
+    """
+    if not names:
+        return []
+    return (
+        Session.query(models.Export)
+        .filter(models.Export.name.in_(names))
+        .filter(models.Export.status == u'pending')
+        .all())
+
+
+def _text(value):
+    if isinstance(value, six.binary_type):
+        return value.decode('utf-8')
+    return value
+
+
+@celery.task(
+    name='make_export', base=ExportTask, ignore_result=True, acks_late=True)
 @with_transaction
-def make_export(name):
+def make_export(name, flight=None):
     """
     Handles generating exports in a separate process.
 
@@ -106,59 +461,830 @@ def make_export(name):
     owner_user -- the user who this export belongs to
     count -- the current number of files processed
     total -- the total number of files that will be processed
+    rows -- the current number of rows written
+    estimated_rows -- the estimated total number of rows
+    eta -- estimated number of seconds left, based on the rows written
+           per second so far (None until the first rows are written)
     status -- current status of the export
 
+    Progress is published as rows are written, but no more often than
+    every ``studies.export.progress_interval`` seconds.
+
+    Incremental exports only include rows that changed since the owner's
+    last export of the same data files and options, along with a
+    tombstones file listing the rows that have been deleted since.
+
+    A checkpoint is recorded every time a data file is added to the
+    archive. If the export is retried after a failure (or redelivered
+    after its worker died), it resumes from the last checkpoint instead
+    of starting over.
+
+    Identical exports requested while this one is being generated may be
+    attached to it (see ``queue_export``), in which case they receive a
+    link to this export's archive and its progress events.
+
+    Exports are subject to a per-user concurrency limit, and heavy lane
+    exports to a global one as well. An export over its limits is queued
+    again to be retried later instead of occupying a worker.
+
     Parameters:
     export_id -- export to process
+    flight -- (Optional) key under which identical exports are attached
 
     """
 
     redis = app.redis
 
     export = Session.query(models.Export).filter_by(name=name).one()
+    lane = export_lane(export.estimated_cost)
+    slots = _slots(export, lane)
+
+    if not _acquire_slots(redis, slots, name):
+        log.info('Export {} deferred, over its {} lane limits'.format(
+            name, lane))
+        _dispatch(name, flight, lane, DEFER_COUNTDOWN)
+        return
+
+    try:
+        _generate_export(redis, export, flight, slots)
+    finally:
+        _release_slots(redis, slots, name)
+
+
+def _generate_export(redis, export, flight, slots):
+    """
+    Generates an export's archive, see ``make_export``
+    """
+
+    name = export.name
+    checkpoints = list(export.checkpoints or [])
+
+    if export.started_at is None:
+        started_at = Session.query(sa.func.now()).scalar()
+        _save_export(export, started_at=started_at)
+        orm.attributes.set_committed_value(export, 'started_at', started_at)
+
+    exportables = exports.list_all(Session)
+    plans = [exportables[item['name']] for item in export.contents]
+    parallelism = app.settings.get('studies.export.parallelism', 1)
+    options = _plan_options(export)
+
+    if export.is_incremental:
+        since = _previous_watermarks(export, plans)
+    else:
+        since = {}
+
+    # Partitions are generated like plans of their own, except in databases
+    # where all of a plan's rows are loaded into one table
+    if export.partition_by and export.format != 'sqlite':
+        partitions = exports.partition.split(plans, export.partition_by)
+        since.update(
+            (p.name, since[p.parent.name])
+            for p in partitions if p.parent.name in since)
+    else:
+        partitions = plans
+
+    if checkpoints and os.path.exists(export.path) and (
+            export.format != 'sqlite'
+            or os.path.exists(_database_path(export))):
+        # Don't claim changes made while the export was interrupted
+        watermark = export.watermark
+        archive = _Archive(export.path, checkpoints[-1]['size'])
+    else:
+        checkpoints = []
+        watermark = _current_watermark()
+        archive = _Archive(export.path)
+
+    finished = set(checkpoint['name'] for checkpoint in checkpoints)
+    pending = [plan for plan in partitions if plan.name not in finished]
+
+    progress = _Progress(
+        redis,
+        export,
+        dict((plan.name, plan.estimate_rows(since.get(plan.name), **options))
+             for plan in pending),
+        app.settings.get('studies.export.progress_interval',
+                         PROGRESS_INTERVAL),
+        len(partitions))
+    progress.publish(count=len(checkpoints))
 
-    redis.hmset(export.redis_key, {
-        'export_id': export.id,
-        'owner_user': export.owner_user.key,
-        'status': export.status,
-        'count': 0,
-        'total': len(export.contents),
-    })
-
-    with closing(ZipFile(export.path, 'w', ZIP_DEFLATED)) as zfp:
-
-        exportables = exports.list_all(Session)
-
-        for item in export.contents:
-            plan = exportables[item['name']]
-
-            with tempfile.NamedTemporaryFile() as tfp:
-                exports.write_data(tfp, plan.data(
-                    use_choice_labels=export.use_choice_labels,
-                    expand_collections=export.expand_collections))
-                zfp.write(tfp.name, plan.file_name)
-
-            redis.hincrby(export.redis_key, 'count')
-            data = redis.hgetall(export.redis_key)
-            # redis-py returns everything as string, so we need to clean it
-            for key in ('export_id', 'count', 'total'):
-                data[key] = int(data[key])
-            redis.publish('export', json.dumps(data))
-            count, total = data['count'], data['total']
-            log.info(', '.join(map(str, [count, total, item['name']])))
-
-        with tempfile.NamedTemporaryFile() as tfp:
-            codebook_chain = \
-                [p.codebook() for p in six.itervalues(exportables)]
-            exports.write_codebook(tfp, chain.from_iterable(codebook_chain))
-            zfp.write(tfp.name, exports.codebook.FILE_NAME)
+    # Keep temporary files on the same file system as the cache
+    tmp_dir = tempfile.mkdtemp(dir=app.settings['studies.export.dir'])
 
+    if export.format == 'sqlite':
+        # Tables are committed as they are loaded, so the database is kept
+        # next to the archive to be resumed along with it
+        database = exports.database.connect(_database_path(export))
+        generated = _load_plans(database, export, pending, since, progress)
+    else:
+        database = None
+        generated = _archive_plans(
+            archive, export, pending, tmp_dir, parallelism, since,
+            _get_cache(), progress)
+
+    try:
+        with closing(archive):
+
+            for plan, cost in generated:
+                checkpoints.append({
+                    'name': plan.name,
+                    'size': archive.checkpoint(),
+                    'cost': cost})
+                _save_checkpoints(export, checkpoints, watermark)
+                _refresh_slots(redis, slots, name)
+
+                if flight is not None:
+                    names = redis.smembers(flight + ':followers')
+                    progress.attach(_query_followers(
+                        [_text(n) for n in names]))
+
+                progress.finish(plan.name)
+                log.info(', '.join(map(str, [
+                    len(checkpoints), len(partitions), plan.name])))
+
+            if database is not None:
+                _finish_database(database, archive, export, plans, since)
+
+            else:
+                if export.is_incremental:
+                    with archive.open(exports.TOMBSTONES_FILE_NAME) as fp:
+                        _write_tombstones(plans, fp, since)
+
+                with archive.open(exports.codebook.FILE_NAME) as fp:
+                    exports.write_codebook(fp, _get_codebooks().rows(plans))
+
+                if partitions is not plans:
+                    with archive.open(
+                            exports.partition.MANIFEST_FILE_NAME) as fp:
+                        exports.write_manifest(fp, partitions, export.format)
+
+    finally:
+        if database is not None:
+            database.close()
+        shutil.rmtree(tmp_dir)
+
+    export.watermark = watermark
+    export.actual_cost = sum(c.get('cost', 0) for c in checkpoints)
+    export.checkpoints = None
     export.status = 'complete'
-    redis.hmset(export.redis_key, {
-        'status': export.status,
-        'file_size': humanize.naturalsize(export.file_size)
-    })
-    redis.publish('export', json.dumps(redis.hgetall(export.redis_key)))
+
+    if flight is not None:
+        followers = _query_followers(_land_flight(redis, flight, name))
+        for follower in followers:
+            exports.cache.link_file(export.path, follower.path)
+            follower.watermark = watermark
+            follower.status = 'complete'
+        progress.attach(followers)
+
+    progress.publish(
+        status=export.status,
+        file_size=humanize.naturalsize(export.file_size))
+
+
+class _Progress(object):
+    """
+    Publishes the progress of an export as its rows are written
+
+    Rows are counted per plan against the plan's estimated number of rows,
+    which is replaced by the actual number once the plan is finished.
+    Updates are throttled to one per interval, and each one is sent to
+    redis in a single pipelined call, along with the updates of the
+    exports attached to the export (see ``queue_export``).
+
+    Rows may be reported from several threads at once (see
+    ``_generate_plans``).
+    """
+
+    def __init__(self, redis, export, estimates, interval, total=None):
+        """
+        Parameters:
+        redis -- redis connection
+        export -- the export being processed
+        estimates -- dictionary of pending plan names and their estimated
+                     number of rows
+        interval -- minimum number of seconds between updates
+        total -- (Optional) number of data files of the export, if not one
+                 per plan (i.e. when plans are partitioned)
+        """
+        self.redis = redis
+        self.key = export.redis_key
+        self.estimates = dict(estimates)
+        self.written = dict((name, 0) for name in estimates)
+        self.generated = set()
+        self.interval = interval
+        self.followers = []
+        self.lock = threading.Lock()
+        self.started = self.published = time.time()
+        self.data = {
+            'export_id': export.id,
+            'owner_user': export.owner_user.key,
+            'status': export.status,
+            'count': 0,
+            'total': len(export.contents) if total is None else total,
+        }
+
+    def attach(self, followers):
+        """
+        Sets the exports attached to the export, which get its progress too
+        """
+        self.followers = [
+            (f.redis_key, f.id, f.owner_user.key) for f in followers]
+
+    def reporter(self, name):
+        """
+        Returns a callable that counts the rows written for a plan
+        """
+        return partial(self.add, name)
+
+    def add(self, name, rows):
+        """
+        Counts rows written for a plan, publishing them if due
+        """
+        with self.lock:
+            self.written[name] += rows
+            self.generated.add(name)
+            due = time.time() - self.published >= self.interval
+        if due:
+            self.publish()
+
+    def finish(self, name):
+        """
+        Marks a plan as finished and publishes the progress right away
+
+        Rows of plans copied from the cache are never counted, so they
+        are assumed to have had as many rows as estimated.
+        """
+        with self.lock:
+            if name not in self.generated:
+                self.written[name] = self.estimates[name]
+            self.estimates[name] = self.written[name]
+        self.publish(count=self.data['count'] + 1)
+
+    def publish(self, **data):
+        """
+        Sends the current progress, updated with the specified values
+        """
+        with self.lock:
+            rows = sum(self.written.values())
+            # Plans that outgrow their estimate are about to finish
+            estimated_rows = sum(
+                max(estimate, self.written[name])
+                for name, estimate in self.estimates.items())
+            elapsed = time.time() - self.started
+            self.data.update(data)
+            self.data.update({
+                'rows': rows,
+                'estimated_rows': estimated_rows,
+                'eta': (int((estimated_rows - rows) * elapsed / rows)
+                        if rows else None),
+            })
+            progress = dict(self.data)
+            self.published = time.time()
+
+        with self.redis.pipeline(transaction=False) as pipe:
+            for key, data in self._updates(progress):
+                if data['eta'] is None:
+                    pipe.hdel(key, 'eta')
+                pipe.hmset(key, dict(
+                    (k, v) for k, v in data.items() if v is not None))
+                pipe.publish('export', json.dumps(data))
+            pipe.execute()
+
+    def _updates(self, progress):
+        yield self.key, progress
+        for key, export_id, owner_user in self.followers:
+            yield key, dict(
+                progress, export_id=export_id, owner_user=owner_user)
+
+
+def _current_watermark():
+    """
+    Determines the point in time up to which the current export is complete
+
+    Rows are timestamped when they are written, not when they are
+    committed, so a transaction still in progress may commit rows that
+    are older than what this export can see. The start of the oldest
+    running transaction is used instead, so that those rows are picked
+    up by the next incremental export.
+    """
+    return Session.execute(sa.text(
+        'SELECT MIN(xact_start) '
+        'FROM pg_stat_activity '
+        'WHERE datname = current_database()')).scalar()
+
+
+def _previous_watermarks(export, plans):
+    """
+    Looks up where each plan of an incremental export should resume from
+
+    Returns:
+    A dictionary of plan names and the watermark of the most recent
+    completed export by the same owner that included the plan with the
+    same options. Plans that have never been exported are not included.
+    """
+    Export = models.Export
+    query = (
+        Session.query(sa.func.max(Export.watermark))
+        .filter(Export.id != export.id)
+        .filter(Export.owner_user_id == export.owner_user_id)
+        .filter(Export.status == u'complete')
+        .filter(Export.expand_collections == export.expand_collections)
+        .filter(Export.layout == export.layout)
+        .filter(Export.use_choice_labels == export.use_choice_labels))
+
+    since = {}
+
+    for plan in plans:
+        watermark = (
+            query
+            .filter(Export.contents.contains([{'name': plan.name}]))
+            .scalar())
+        if watermark is not None:
+            since[plan.name] = watermark
+
+    return since
+
+
+def _write_tombstones(plans, fp, since):
+    """
+    Writes the rows deleted from the plans since their watermarks
+    """
+    queries = [plan.tombstones(since.get(plan.name)) for plan in plans]
+    query = queries[0].union_all(*queries[1:])
+    exports.write_data(fp, query)
+
+
+def _save_checkpoints(export, checkpoints, watermark):
+    """
+    Records the data files that have been added to an export's archive
+
+    Checkpoints are committed right away in a transaction of their own,
+    so that they outlive the export's transaction if it fails.
+    """
+    _save_export(export, checkpoints=checkpoints, watermark=watermark)
+
+
+def _save_export(export, **values):
+    """
+    Commits the specified values of an export in a transaction of its own
+
+    The export must not have pending changes in the task's session, which
+    would lock its row until the end of the task and block the update
+    forever (the task would be waiting on itself, which the database
+    cannot detect).
+    """
+    export_table = models.Export.__table__
+    with Session.get_bind().begin() as connection:
+        models.set_pg_locals(connection, 'celery', app.userid)
+        connection.execute(
+            export_table.update()
+            .where(export_table.c.id == export.id)
+            .values(**values))
+
+
+def _get_codebooks():
+    """
+    Returns the store of pre-cooked codebooks
+    """
+    return exports.codebook.CodebookStore(os.path.join(
+        app.settings['studies.export.dir'],
+        exports.codebook.STORE_DIR_NAME))
+
+
+def _get_cache():
+    """
+    Returns the cache of generated data files, if enabled
+    """
+    cache_size = app.settings.get('studies.export.cache_size')
+    if cache_size:
+        path = os.path.join(app.settings['studies.export.dir'], 'cache')
+        return exports.PlanCache(path, cache_size, redis=app.redis)
+
+
+def _open_archive(path, mode='w'):
+    """
+    Opens an export archive with the configured compression
+    """
+    compression = COMPRESSION[
+        app.settings.get('studies.export.compression', 'deflated')]
+    compression_level = app.settings.get('studies.export.compression_level')
+
+    # Compression levels are only supported by zipfile as of Python 3.7
+    if sys.version_info >= (3, 7):
+        return ZipFile(
+            path, mode, compression,
+            allowZip64=True,
+            compresslevel=compression_level)
+
+    zfp = ZipFile(path, mode, compression, allowZip64=True)
+    # Honored by members written with ``exports.open_member``
+    zfp.compresslevel = compression_level
+    return zfp
+
+
+class _Archive(object):
+    """
+    An export's zip archive that can be resumed after a failure
+
+    The central directory of a zip archive is only written when the
+    archive is closed, so it is closed at every checkpoint to make the
+    members written so far readable. New members are then appended after
+    that central directory instead of over it, so an interrupted archive
+    can be restored by truncating it back to the size of its last
+    checkpoint.
+    """
+
+    def __init__(self, path, size=None):
+        """
+        Parameters:
+        path -- location of the archive
+        size -- (Optional) size of the archive at the checkpoint to resume
+                from, otherwise a new archive is created
+        """
+        self.path = path
+
+        if size is None:
+            self.zfp = _open_archive(path)
+        else:
+            with open(path, 'r+b') as fp:
+                fp.truncate(size)
+            self._append()
+
+    def _append(self):
+        self.zfp = _open_archive(self.path, 'a')
+        # Leave the current central directory intact until the next one
+        # (Python 2 writes at the file's position instead of ``start_dir``)
+        self.zfp.start_dir = os.path.getsize(self.path)
+        self.zfp.fp.seek(self.zfp.start_dir)
+
+    def open(self, name):
+        """
+        Opens a new member for writing (see ``exports.open_member``)
+        """
+        return exports.open_member(self.zfp, name)
+
+    def write(self, path, name):
+        """
+        Adds a file as a new member
+        """
+        self.zfp.write(path, name)
+
+    def checkpoint(self):
+        """
+        Saves all members written so far to disk
+
+        Returns:
+        The size of the archive to resume from
+        """
+        self.zfp.close()
+        with open(self.path, 'rb') as fp:
+            os.fsync(fp.fileno())
+        size = os.path.getsize(self.path)
+        self._append()
+        return size
+
+    def close(self):
+        self.zfp.close()
+
+
+def _archive_plans(
+        archive, export, plans, tmp_dir, parallelism=1, since=None,
+        cache=None, progress=None):
+    """
+    Adds the data files of an export's plans to its archive
+
+    When plans are generated one at a time, their data is streamed
+    straight into the archive without any intermediate file. Concurrently
+    generated plans are written to temporary files instead, since only one
+    archive member can be written at a time.
+
+    Returns:
+    An iterator of (plan, cost) tuples in the order the plans were added,
+    where cost is the number of values generated for the plan (zero if
+    its data file was reused from the cache)
+    """
+
+    since = since or {}
+    format = export.format
+
+    if parallelism > 1 and len(plans) > 1:
+        # Plans may finish in any order, so they are only added to the
+        # archive once all plans requested before them are also done
+        remaining = [plan.name for plan in plans]
+        finished = {}
+
+        for plan, path, cost in _generate_plans(
+                export, plans, tmp_dir, parallelism, since, cache,
+                progress):
+            finished[plan.name] = (plan, path, cost)
+
+            while remaining and remaining[0] in finished:
+                done, done_path, done_cost = finished.pop(remaining.pop(0))
+                archive.write(
+                    done_path, exports.data_file_name(done, format))
+                os.unlink(done_path)
+                yield done, done_cost
+
+        return
+
+    options = _plan_options(export)
+
+    for plan in plans:
+        with archive.open(exports.data_file_name(plan, format)) as fp:
+            cost = _stream_plan(
+                plan, fp, tmp_dir, options, since.get(plan.name), cache,
+                _reporter(progress, plan), format)
+        yield plan, cost
+
+
+def _load_plans(database, export, plans, since=None, progress=None):
+    """
+    Loads the data of an export's plans into its database, one at a time
+
+    SQLite only allows one writer at a time, so plans are never generated
+    concurrently, and tables are not cached since they are not files of
+    their own.
+
+    Returns:
+    An iterator of (plan, cost) tuples in the order the plans were loaded
+    """
+
+    since = since or {}
+    options = _plan_options(export)
+    fetch_size = app.settings.get(
+        'studies.export.fetch_size', exports.FETCH_SIZE)
+
+    for plan in plans:
+        query = plan.delta(since.get(plan.name), **options)
+        rows = exports.database.load_table(
+            database, plan.name, query, _get_codebooks().get(plan),
+            fetch_size=fetch_size, progress=_reporter(progress, plan))
+        yield plan, rows * len(query.column_descriptions)
+
+
+def _finish_database(database, archive, export, plans, since):
+    """
+    Loads the codebook (and tombstones) into an export's database, then
+    moves the database into the export's archive
+    """
+    exports.database.load_codebook(database, _get_codebooks().rows(plans))
+
+    if export.is_incremental:
+        queries = [plan.tombstones(since.get(plan.name)) for plan in plans]
+        exports.database.load_table(
+            database, exports.database.TOMBSTONES_TABLE,
+            queries[0].union_all(*queries[1:]), [])
+
+    database.close()
+    path = _database_path(export)
+    archive.write(path, exports.database.FILE_NAME)
+    os.unlink(path)
+
+
+def _database_path(export):
+    return export.path + '.sqlite'
+
+
+def _plan_options(export):
+    options = {
+        'use_choice_labels': export.use_choice_labels,
+        'expand_collections': export.expand_collections,
+    }
+    # Only set for long exports, so that the cache keys of wide data files
+    # are the same as before layouts were supported
+    if export.layout != 'wide':
+        options['layout'] = export.layout
+    return options
+
+
+def _file_options(options, format):
+    """
+    Returns the options that identify a data file in the specified format
+
+    CSV files are identified by their plan options alone, so that their
+    keys are the same as before other formats were supported.
+    """
+    if format == 'csv':
+        return options
+    return dict(options, format=format)
+
+
+def _generate_plans(
+        export, plans, tmp_dir, parallelism=1, since=None, cache=None,
+        progress=None):
+    """
+    Generates the data files of an export's plans
+
+    Plans are independent of each other, so when ``parallelism`` is greater
+    than one, up to that many plans are generated concurrently, each in
+    its own thread with its own database connection. Threads are used
+    instead of processes since the Celery worker pool processes are not
+    allowed to have children, and the bulk of the work is spent waiting
+    on the database.
+
+    Parameters:
+    export -- the export being processed
+    plans -- the plans to generate
+    tmp_dir -- directory to write the generated files to
+    parallelism -- maximum number of plans to generate at the same time
+    since -- (Optional) dictionary of plan names and the time since
+             which their changes should be generated
+    cache -- (Optional) cache to reuse previously generated files from
+    progress -- (Optional) progress to count the rows written in
+
+    Returns:
+    An iterator of (plan, path, cost) tuples in the order they finished
+    """
+
+    since = since or {}
+    options = _plan_options(export)
+    format = export.format
+
+    if parallelism <= 1 or len(plans) <= 1:
+        for plan in plans:
+            yield (plan,) + _write_plan(
+                plan, tmp_dir, options, since.get(plan.name), cache,
+                _reporter(progress, plan), format)
+        return
+
+    engine = Session.get_bind()
+    snapshot = None
+
+    # Have all connections read the same data as the main transaction
+    if engine.dialect.name == 'postgresql':
+        snapshot = Session.execute('SELECT pg_export_snapshot()').scalar()
+
+    def worker(plan):
+        session = orm.Session(bind=engine)
+        try:
+            if snapshot:
+                session.execute(
+                    'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                session.execute(
+                    sa.text('SET TRANSACTION SNAPSHOT :snapshot'),
+                    {'snapshot': snapshot})
+            plan = copy(plan)
+            plan.dbsession = session
+            return (plan,) + _write_plan(
+                plan, tmp_dir, options, since.get(plan.name), cache,
+                _reporter(progress, plan), format)
+        finally:
+            session.rollback()
+            session.close()
+
+    pool = ThreadPool(min(parallelism, len(plans)))
+
+    try:
+        for result in pool.imap_unordered(worker, plans):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _write_plan(
+        plan, tmp_dir, options, since=None, cache=None, report=None,
+        format='csv'):
+    """
+    Writes a plan's data file to the specified directory
+
+    If ``since`` is specified, only the rows changed since then are written.
+    Otherwise, if a ``cache`` is specified, the file is reused from the
+    cache if the plan's data has not changed since it was last generated.
+
+    Returns:
+    A (path, cost) tuple of the generated file and the number of values
+    generated (zero if the file was reused from the cache)
+    """
+
+    path = _tmp_path(tmp_dir, plan, format)
+
+    if cache is not None and since is None:
+        key = cache.key(plan, _file_options(options, format))
+        if cache.get(key, path):
+            return path, 0
+    else:
+        key = None
+
+    with open(path, 'w+b') as fp:
+        cost = _write_data(
+            fp, plan, plan.delta(since, **options), format, report)
+
+    if key is not None:
+        cache.put(key, path)
+
+    return path, cost
+
+
+def _stream_plan(
+        plan, fp, tmp_dir, options, since=None, cache=None, report=None,
+        format='csv'):
+    """
+    Streams a plan's data file into the specified file object
+
+    Cached files are copied over as-is. Otherwise the generated data is
+    also written to a temporary file that is then added to the cache, so
+    the data only ever hits the disk when it is being cached.
+
+    Returns:
+    The number of values generated (zero if the file was cached)
+    """
+
+    query = plan.delta(since, **options)
+
+    if cache is None or since is not None:
+        return _write_data(fp, plan, query, format, report)
+
+    key = cache.key(plan, _file_options(options, format))
+    cached = cache.open(key)
+
+    if cached is not None:
+        with closing(cached):
+            shutil.copyfileobj(cached, fp, COPY_BUFFER_SIZE)
+        return 0
+
+    path = _tmp_path(tmp_dir, plan, format)
+
+    with open(path, 'w+b') as tfp:
+        cost = _write_data(_Tee(fp, tfp), plan, query, format, report)
+
+    cache.put(key, path)
+    os.unlink(path)
+
+    return cost
+
+
+def _tmp_path(tmp_dir, plan, format):
+    """
+    Returns where a plan's data file is written before it is archived
+
+    Partitions are in their plan's directory, which is created as needed.
+    """
+    path = os.path.join(tmp_dir, exports.data_file_name(plan, format))
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    return path
+
+
+def _codebook_rows(plan):
+    """
+    Returns the codebook rows of a plan, which partitions share
+    """
+    if isinstance(plan, exports.partition.Partition):
+        plan = plan.parent
+    return _get_codebooks().get(plan)
+
+
+def _write_data(fp, plan, query, format='csv', report=None):
+    """
+    Writes a plan's query to a data file with the configured backend
+
+    Parameters:
+    fp -- the file object to write to
+    plan -- the plan the query belongs to
+    query -- the query to write
+    format -- (Optional) the format of the data file
+    report -- (Optional) callable that counts the rows as they are written
+
+    Returns:
+    The number of values (rows times columns) written
+    """
+    if format == 'parquet':
+        rows = exports.columnar.write_parquet(
+            fp, query, _codebook_rows(plan), progress=report)
+    elif app.settings.get('studies.export.use_copy'):
+        rows = exports.copy_data(fp, query, progress=report)
+    else:
+        fetch_size = app.settings.get(
+            'studies.export.fetch_size', exports.FETCH_SIZE)
+        rows = exports.write_data(
+            fp, query, fetch_size=fetch_size, progress=report)
+    return rows * len(query.column_descriptions)
+
+
+def _reporter(progress, plan):
+    if progress is not None:
+        return progress.reporter(plan.name)
+
+
+class _Tee(object):
+    """
+    Writes to several file objects at once
+    """
+
+    def __init__(self, *files):
+        self.files = files
+
+    def write(self, data):
+        for fp in self.files:
+            fp.write(data)
+
+    def flush(self):
+        for fp in self.files:
+            fp.flush()
 
 
 @celery.task(name='make_codebook', ignore_result=True, bind=True)
@@ -166,14 +1292,18 @@ def make_export(name):
 def make_codebook(task):
     """
     Pre-cooks a codebook file for faster downloading
+
+    Only the codebooks of plans that have changed since the last run
+    are actually rebuilt.
     """
     try:
-        codebook_chain = \
-            [p.codebook() for p in six.itervalues(exports.list_all(Session))]
-        path = os.path.join(app.settings['studies.export.dir'],
-                            exports.codebook.FILE_NAME)
-        with open(path, 'w+b') as fp:
-            exports.write_codebook(fp, chain.from_iterable(codebook_chain))
+        plans = six.itervalues(exports.list_all(Session))
+        export_dir = app.settings['studies.export.dir']
+        path = os.path.join(export_dir, exports.codebook.FILE_NAME)
+        # Replace the file atomically so downloads never get a partial file
+        with open(path + '.tmp', 'w+b') as fp:
+            exports.write_codebook(fp, _get_codebooks().rows(plans))
+        os.rename(fp.name, path)
     except Exception as exc:
         # Need to keep retrying (default is every 3 min)
         task.retry(exc=exc)
@@ -247,8 +247,10 @@ def terminate_ajax(context, request):
                 # changing termination version *should* not be
                 # allowed, just assign the schema that's already being used
                 context.entities.add(entity)
-            upload_dir = request.registry.settings['studies.blob.dir']
-            apply_data(dbsession, entity, form.data, upload_dir)
+            settings = request.registry.settings
+            apply_data(
+                dbsession, entity, form.data, settings['studies.blob.dir'],
+                max_size=settings.get('studies.blob.max_size'))
             context.termination_date = form.termination_date.data
             dbsession.flush()
             return HTTPOk(json=view_json(context, request))
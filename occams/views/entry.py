@@ -1,7 +1,9 @@
 from datetime import date
-from pyramid.httpexceptions import HTTPBadRequest, HTTPOk
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound, HTTPOk
+from pyramid.response import FileResponse, Response
 from pyramid.session import check_csrf_token
 from pyramid.view import view_config
+import six
 import sqlalchemy as sa
 from sqlalchemy import orm
 import wtforms
@@ -10,6 +12,7 @@ from wtforms_components import DateRange
 
 
 from .. import _, models
+from ..blobs import BlobStore
 from ..utils.forms import wtferrors, ModelField, Form
 from ..renderers import make_form, render_form, entity_data, form2json, version2json
 
@@ -205,6 +208,59 @@ def markup_ajax(context, request):
     return render_form(form)
 
 
+@view_config(
+    route_name='studies.visit_form',
+    permission='view',
+    request_param='attachment')
+@view_config(
+    route_name='studies.patient_form',
+    permission='view',
+    request_param='attachment')
+def attachment_download(context, request):
+    """
+    Returns the file of one of the entity's attachments
+
+    Files in the blob store are served directly from the file system
+    (using the server's file wrapper, if any), rather than being loaded
+    through the database.
+    """
+    try:
+        attachment = context.attachments[int(request.GET['attachment'])]
+    except (KeyError, ValueError):
+        raise HTTPNotFound()
+
+    blob = attachment.blob
+
+    if blob.digest is None:
+        response = Response(
+            body=blob.content, content_type=attachment.mime_type)
+    else:
+        store = BlobStore(request.registry.settings['studies.blob.dir'])
+        response = FileResponse(
+            store.file_path(blob.digest),
+            request=request,
+            content_type=attachment.mime_type)
+
+    response.content_disposition = _content_disposition(attachment.file_name)
+    return response
+
+
+def _content_disposition(file_name):
+    """
+    Builds the header that downloads a file under its uploaded name
+
+    Uploaded names may contain spaces, quotes or non-ASCII characters, so
+    the name is sent both as a quoted ASCII fallback and percent-encoded
+    as UTF-8 for clients that support it (RFC 6266 / RFC 5987).
+    """
+    fallback = file_name.encode('ascii', 'replace').decode('ascii')
+    for char in '"\\\r\n':
+        fallback = fallback.replace(char, '_')
+    encoded = six.moves.urllib.parse.quote(file_name.encode('utf-8'), safe='')
+    return 'attachment; filename="%s"; filename*=UTF-8\'\'%s' % (
+        fallback, encoded)
+
+
 @view_config(
     route_name='studies.visit_forms',
     xhr=True,
@@ -2,6 +2,7 @@ from pyramid.exceptions import URLDecodeError
 from pyramid.httpexceptions import (
     HTTPBadRequest,
     HTTPForbidden,
+    HTTPRequestEntityTooLarge,
     HTTPUnauthorized,
 )
 from pyramid.view import (
@@ -10,6 +11,8 @@ from pyramid.view import (
     view_config
 )
 
+from ..blobs import BlobTooLarge
+
 
 # @notfound_view_config(append_slash=True)
 # def notfound(exc, request):
@@ -44,3 +47,14 @@ def invalid_url_encoding(exc, request):
     Handler whent he URL contains malformed encoded strings (i.e. %c5, %80)
     """
     return HTTPBadRequest()
+
+
+@view_config(context=BlobTooLarge)
+def blob_too_large(exc, request):
+    """
+    Handler when an uploaded file exceeds ``studies.blob.max_size``
+
+    The transaction is aborted, so the rest of the submitted form is not
+    saved either.
+    """
+    return HTTPRequestEntityTooLarge(str(exc))
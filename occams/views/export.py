@@ -1,3 +1,4 @@
+from copy import copy
 from datetime import datetime, timedelta
 import json
 import os
@@ -19,6 +20,10 @@ from ..utils.forms import wtferrors, Form
 from ..utils.pagination import Pagination
 
 
+# Default maximum number of data files that can be streamed at once
+STREAM_LIMIT = 5
+
+
 @view_config(
     route_name='studies.exports',
     permission='view',
@@ -74,6 +79,16 @@ def checkout(context, request):
                     wtforms.validators.InputRequired()])
             expand_collections = wtforms.BooleanField(default=False)
             use_choice_labels = wtforms.BooleanField(default=False)
+            is_incremental = wtforms.BooleanField(default=False)
+            format = wtforms.SelectField(
+                choices=[(f, f) for f in exports.available_formats()],
+                default='csv')
+            layout = wtforms.SelectField(
+                choices=[(l, l) for l in exports.LAYOUTS], default='wide')
+            partition_by = wtforms.SelectField(
+                choices=[('', '')] + [
+                    (p, p) for p in exports.partition.PARTITIONS],
+                default='')
 
         form = CheckoutForm(request.POST)
 
@@ -81,22 +96,40 @@ def checkout(context, request):
             errors = wtferrors(form)
         else:
             task_id = six.text_type(str(uuid.uuid4()))
+            plans = [exportables[k] for k in form.contents.data]
+            options = {
+                'use_choice_labels': form.use_choice_labels.data,
+                'expand_collections': form.expand_collections.data}
+            if form.layout.data != 'wide':
+                options['layout'] = form.layout.data
+            cost = tasks.estimate_cost(plans, options)
             dbsession.add(models.Export(
                 name=task_id,
                 expand_collections=form.expand_collections.data,
                 use_choice_labels=form.use_choice_labels.data,
+                is_incremental=form.is_incremental.data,
+                format=form.format.data,
+                layout=form.layout.data,
+                partition_by=form.partition_by.data or None,
                 owner_user=(dbsession.query(models.User)
                             .filter_by(key=request.authenticated_userid)
                             .one()),
-                contents=[exportables[k].to_json() for k in form.contents.data]
+                contents=[exportables[k].to_json() for k in form.contents.data],
+                estimated_cost=cost
             ))
 
+            # Incremental exports depend on the owner's previous exports,
+            # so only full exports can share their archive with others
+            if form.is_incremental.data:
+                flight = None
+            else:
+                flight = tasks.flight_key(
+                    plans, options, form.format.data,
+                    form.partition_by.data or None)
+
             def apply_after_commit(success):
                 if success:
-                    tasks.make_export.apply_async(
-                        args=[task_id],
-                        task_id=task_id,
-                        countdown=4)
+                    tasks.queue_export(request.redis, task_id, flight, cost)
 
             # Avoid race-condition by executing the task after succesful commit
             transaction.get().addAfterCommitHook(apply_after_commit)
@@ -111,9 +144,119 @@ def checkout(context, request):
         'errors': errors,
         'exceeded': exceeded,
         'limit': limit,
-        'exportables': exportables
+        'exportables': exportables,
+        'formats': exports.available_formats()
+    }
+
+
+@view_config(
+    route_name='studies.exports_stream',
+    permission='add')
+def stream(context, request):
+    """
+    Streams a few data files straight to the client.
+
+    Meant for small ad-hoc pulls that would otherwise have to wait for
+    the export queue. A single data file is sent as a CSV file, whereas
+    several are sent as a zip file along with their codebook. Files are
+    generated as their rows come off the database cursor, so nothing is
+    written to disk.
+
+    The same data files are available as in ``checkout``.
+    """
+    settings = request.registry.settings
+    exportables = exports.list_all(request.dbsession, include_rand=False)
+    limit = settings.get('studies.export.stream_limit', STREAM_LIMIT)
+
+    def check_exportable(form, field):
+        if any(value not in exportables for value in field.data):
+            raise wtforms.ValidationError(request.localizer.translate(
+                _(u'Invalid selection')))
+
+    def check_limit(form, field):
+        if len(field.data) > limit:
+            raise wtforms.ValidationError(request.localizer.translate(
+                _(u'Cannot stream more than ${limit} files at once',
+                  mapping={'limit': limit})))
+
+    class StreamForm(Form):
+        contents = wtforms.SelectMultipleField(
+            choices=[(k, v.title) for k, v in six.iteritems(exportables)],
+            validators=[
+                wtforms.validators.InputRequired(),
+                check_exportable,
+                check_limit])
+        expand_collections = wtforms.BooleanField(default=False)
+        use_choice_labels = wtforms.BooleanField(default=False)
+        layout = wtforms.SelectField(
+            choices=[(l, l) for l in exports.LAYOUTS], default='wide')
+
+    form = StreamForm(request.GET)
+
+    if not form.validate():
+        raise HTTPBadRequest(json={'errors': wtferrors(form)})
+
+    options = {
+        'use_choice_labels': form.use_choice_labels.data,
+        'expand_collections': form.expand_collections.data,
+        'ignore_private': True,
+        'layout': form.layout.data,
     }
 
+    # The request's session is committed as soon as this view returns,
+    # so the files are generated in a session of their own
+    dbsession = request.registry['dbsession_factory']()
+    plans = []
+    for name in form.contents.data:
+        plan = copy(exportables[name])
+        plan.dbsession = dbsession
+        plans.append(plan)
+
+    fetch_size = settings.get('studies.export.fetch_size', exports.FETCH_SIZE)
+
+    if len(plans) == 1:
+        file_name = plans[0].file_name
+        content_type = 'text/csv'
+    else:
+        file_name = 'export.zip'
+        content_type = 'application/zip'
+
+    def generate():
+        try:
+            if dbsession.bind.dialect.name == 'postgresql':
+                # Have all files read the same data
+                dbsession.execute(
+                    'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+
+            if len(plans) == 1:
+                chunks = exports.iter_data(
+                    plans[0].data(**options), fetch_size)
+            else:
+                codebooks = exports.codebook.CodebookStore(os.path.join(
+                    settings['studies.export.dir'],
+                    exports.codebook.STORE_DIR_NAME))
+                chunks = exports.iter_archive(
+                    plans, options, codebooks.rows(plans), fetch_size)
+
+            for chunk in chunks:
+                yield chunk
+
+        except GeneratorExit:
+            log.info('Client disconnected from streamed export')
+            raise
+
+        finally:
+            dbsession.rollback()
+            dbsession.close()
+
+    response = request.response
+    response.content_type = content_type
+    response.content_disposition = 'attachment;filename=%s' % file_name
+    # Set reverse proxies (if any, i.e nginx) not to buffer this connection
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.app_iter = generate()
+    return response
+
 
 @view_config(
     route_name='studies.exports_codebook',
@@ -137,13 +280,6 @@ def codebook_json(context, request):
     Loads codebook rows for the specified data file
     """
     dbsession = request.dbsession
-
-    def massage(row):
-        publish_date = row['publish_date']
-        if publish_date:
-            row['publish_date'] = publish_date.isoformat()
-        return row
-
     exportables = exports.list_all(dbsession)
 
     file = request.GET.get('file')
@@ -151,8 +287,10 @@ def codebook_json(context, request):
     if file not in exportables:
         raise HTTPBadRequest(u'File specified does not exist')
 
-    plan = exportables[file]
-    return [massage(row) for row in plan.codebook()]
+    export_dir = request.registry.settings['studies.export.dir']
+    codebooks = exports.codebook.CodebookStore(
+        os.path.join(export_dir, exports.codebook.STORE_DIR_NAME))
+    return codebooks.get(exportables[file])
 
 
 @view_config(
@@ -217,6 +355,16 @@ def status_json(context, request):
             data = {}
         log.debug('info: {}'.format(str(data)))
         count = len(export.contents)
+        # Exports that have not started yet are still waiting
+        started_at = (export.started_at
+                      or datetime.now(export.created_at.tzinfo))
+        queue_wait = started_at - export.created_at
+
+        def progress(key):
+            # redis-py returns everything as string
+            value = data.get(key)
+            return int(value) if value is not None else None
+
         return {
             'id': export.id,
             'title': localizer.pluralize(
@@ -227,15 +375,28 @@ def status_json(context, request):
             'status': export.status,
             'use_choice_labels': export.use_choice_labels,
             'expand_collections': export.expand_collections,
+            'is_incremental': export.is_incremental,
+            'format': export.format,
+            'layout': export.layout,
+            'partition_by': export.partition_by,
             'contents': sorted(export.contents, key=lambda v: v['title']),
             'count': data.get('count'),
             'total': data.get('total'),
+            'rows': progress('rows'),
+            'estimated_rows': progress('estimated_rows'),
+            'eta': progress('eta'),
+            'lane': tasks.export_lane(export.estimated_cost),
+            'queue_wait': int(queue_wait.total_seconds()),
+            'estimated_cost': export.estimated_cost,
+            'actual_cost': export.actual_cost,
             'file_size': (naturalsize(export.file_size)
                           if export.file_size else None),
             'download_url': request.route_path('studies.export_download',
                                                export=export.id),
             'delete_url': request.route_path('studies.export',
                                              export=export.id),
+            'resume_url': request.route_path('studies.export',
+                                             export=export.id),
             'create_date': format_datetime(export.create_date, locale=locale),
             'expire_date': format_datetime(export.expire_date, locale=locale)
         }
@@ -307,6 +468,40 @@ def delete_json(context, request):
     return HTTPOk()
 
 
+@view_config(
+    route_name='studies.export',
+    permission='edit',
+    request_method='POST',
+    xhr=True)
+def resume_json(context, request):
+    """
+    Handles resume AJAX request
+
+    Failed exports are queued again and continue from the last data file
+    they managed to archive.
+    """
+    check_csrf_token(request)
+    export = context
+
+    if export.status != 'failed':
+        raise HTTPBadRequest(json={
+            'user_message': request.localizer.translate(
+                _(u'Only failed exports can be resumed'))})
+
+    export.status = u'pending'
+    task_id = export.name
+    cost = export.estimated_cost
+
+    def apply_after_commit(success):
+        if success:
+            tasks.queue_export(request.redis, task_id, cost=cost)
+
+    # Avoid race-condition by executing the task after succesful commit
+    transaction.get().addAfterCommitHook(apply_after_commit)
+
+    return HTTPOk()
+
+
 @view_config(
     route_name='studies.export_download',
     permission='view')
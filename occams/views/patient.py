@@ -585,8 +585,10 @@ def form(context, request):
         if not request.has_permission('edit', context):
             raise HTTPForbidden()
         if form.validate():
-            upload_dir = request.registry.settings['studies.blob.dir']
-            apply_data(dbsession, context, form.data, upload_dir)
+            settings = request.registry.settings
+            apply_data(
+                dbsession, context, form.data, settings['studies.blob.dir'],
+                max_size=settings.get('studies.blob.max_size'))
             dbsession.flush()
             request.session.flash(
                 _(u'Changes saved to: %s' % context.schema.title), 'success')
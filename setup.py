@@ -47,13 +47,16 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=REQUIRES,
-    extras_require={'develop': DEVELOP},
+    extras_require={'develop': DEVELOP, 'parquet': ['pyarrow']},
     tests_require=DEVELOP,
     entry_points="""\
     [paste.app_factory]
     main = occams:main
     [console_scripts]
     occams_buildassets = occams.scripts.buildassets:main
+    occams_export = occams.scripts.export:main
     occams_initdb = occams.scripts.initdb:main
+    occams_migrateblobs = occams.scripts.migrateblobs:main
+    occams_valueindex = occams.scripts.valueindex:main
     """,
 )
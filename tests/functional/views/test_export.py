@@ -86,6 +86,34 @@ class TestPermissionsCheckout:
         app.get(self.url, status=401)
 
 
+class TestPermissionsStream:
+
+    url = '/studies/exports/stream?contents=pid'
+
+    @pytest.fixture(autouse=True)
+    def populate(self, app, dbsession):
+        import transaction
+        from occams import models
+
+        # Any view-dependent data goes here
+        # Webtests will use a different scope for its transaction
+        with transaction.manager:
+            dbsession.add(models.User(key=USERID))
+
+    @pytest.mark.parametrize('group', ['administrator', 'manager', 'consumer'])
+    def test_allowed(self, app, dbsession, group):
+        environ = make_environ(userid=USERID, groups=[group])
+        app.get(self.url, extra_environ=environ, status=200)
+
+    @pytest.mark.parametrize('group', [None])
+    def test_not_allowed(self, app, dbsession, group):
+        environ = make_environ(userid=USERID, groups=[group])
+        app.get(self.url, extra_environ=environ, status=403)
+
+    def test_not_authenticated(self, app, dbsession):
+        app.get(self.url, status=401)
+
+
 class TestPermissionsStatus:
 
     url = '/studies/exports/status'
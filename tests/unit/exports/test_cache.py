@@ -0,0 +1,83 @@
+import pytest
+
+
+class DummyPlan(object):
+
+    name = 'dummy'
+
+    versions = []
+
+    def __init__(self, fingerprint):
+        self._fingerprint = fingerprint
+
+    def fingerprint(self, **kw):
+        return self._fingerprint
+
+
+class TestPlanCache:
+
+    @pytest.fixture
+    def cache(self, tmpdir):
+        from occams.exports.cache import PlanCache
+        return PlanCache(str(tmpdir.join('cache')), 10)
+
+    def _write(self, tmpdir, name, content):
+        path = tmpdir.join(name)
+        path.write(content)
+        return str(path)
+
+    def test_key(self, cache):
+        """
+        It should generate a different key when the plan's data changes
+        """
+        options = {'use_choice_labels': False}
+        key = cache.key(DummyPlan([1, None, None]), options)
+
+        assert key == cache.key(DummyPlan([1, None, None]), options)
+        assert key != cache.key(DummyPlan([2, None, None]), options)
+        assert key != cache.key(
+            DummyPlan([1, None, None]), {'use_choice_labels': True})
+
+    def test_key_extension(self, cache):
+        """
+        It should name cached files after their format
+        """
+        plan = DummyPlan([1, None, None])
+
+        assert cache.key(plan, {}).endswith('.csv')
+        assert cache.key(plan, {'format': 'parquet'}).endswith('.parquet')
+
+    def test_get(self, cache, tmpdir):
+        """
+        It should place a previously cached file at the specified path
+        """
+        cache.put('abc', self._write(tmpdir, 'generated.csv', 'data'))
+
+        assert not cache.get('xyz', str(tmpdir.join('miss.csv')))
+        assert cache.get('abc', str(tmpdir.join('hit.csv')))
+        assert tmpdir.join('hit.csv').read() == 'data'
+
+    def test_open(self, cache, tmpdir):
+        """
+        It should open a previously cached file for reading
+        """
+        from contextlib import closing
+
+        cache.put('abc', self._write(tmpdir, 'generated.csv', 'data'))
+
+        assert cache.open('xyz') is None
+        with closing(cache.open('abc')) as fp:
+            assert fp.read() == b'data'
+
+    def test_evict(self, cache, tmpdir):
+        """
+        It should evict the least recently used files over the size limit
+        """
+        import os
+
+        cache.put('old', self._write(tmpdir, 'old.csv', '123456'))
+        os.utime(cache._path('old'), (0, 0))
+        cache.put('new', self._write(tmpdir, 'new.csv', '123456'))
+
+        assert not os.path.exists(cache._path('old'))
+        assert os.path.exists(cache._path('new'))
@@ -0,0 +1,123 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def invalidate():
+    from occams.exports import catalog
+    catalog.invalidate()
+    yield
+    catalog.invalidate()
+
+
+def _make_schema(name, publish_date=None, is_private=False):
+    from occams import models
+    return models.Schema(
+        name=name,
+        title=name.title(),
+        publish_date=publish_date,
+        attributes={
+            'foo': models.Attribute(
+                name='foo',
+                title=u'',
+                type='string',
+                order=0,
+                is_private=is_private
+            )})
+
+
+class TestListSchemata:
+
+    def _call_fut(self, *args, **kw):
+        from occams.exports.catalog import list_schemata
+        return list_schemata(*args, **kw)
+
+    def test_published(self, dbsession):
+        """
+        It should summarize all published versions of each schema
+        """
+        from datetime import date
+        from occams.exports.catalog import SchemaInfo
+
+        dbsession.add_all([
+            _make_schema(u'vitals', date(2017, 1, 2)),
+            _make_schema(u'vitals', date(2016, 1, 2), is_private=True),
+            _make_schema(u'vitals'),
+            _make_schema(u'draft')])
+        dbsession.flush()
+
+        assert [SchemaInfo(
+            name=u'vitals',
+            title=u'Vitals',
+            has_private=True,
+            has_rand=False,
+            versions=[date(2016, 1, 2), date(2017, 1, 2)],
+        )] == self._call_fut(dbsession)
+
+    def test_cached(self, dbsession):
+        """
+        It should reuse the catalog until it is invalidated
+        """
+        from occams.exports import catalog
+
+        first = self._call_fut(dbsession)
+        assert first is self._call_fut(dbsession)
+
+        catalog.invalidate()
+        assert first is not self._call_fut(dbsession)
+
+    def test_uncommitted_changes(self, dbsession):
+        """
+        It should not cache catalogs of sessions with uncommitted changes
+        """
+        from datetime import date
+
+        assert [] == self._call_fut(dbsession)
+
+        dbsession.add(_make_schema(u'vitals', date(2017, 1, 2)))
+        changed = self._call_fut(dbsession)
+        assert [u'vitals'] == [i.name for i in changed]
+        assert changed is not self._call_fut(dbsession)
+
+        dbsession.rollback()
+        assert [] == self._call_fut(dbsession)
+
+    def test_changed_elsewhere(self, dbsession):
+        """
+        It should pick up schemata changed outside of this process
+        """
+        from datetime import date
+        from occams import models
+
+        assert [] == self._call_fut(dbsession)
+
+        # Inserted without the ORM, the way another process' changes are
+        # never seen by this process' session
+        dbsession.execute(models.Schema.__table__.insert().values(
+            name=u'vitals', title=u'Vitals', publish_date=date(2017, 1, 2)))
+
+        assert [u'vitals'] == [i.name for i in self._call_fut(dbsession)]
+
+    def test_revision(self, dbsession):
+        """
+        It should only query the catalog again once the schemata changed
+        """
+        from datetime import date
+        import mock
+        from occams import models
+        from occams.exports import catalog
+
+        first = self._call_fut(dbsession)
+
+        with mock.patch('occams.exports.catalog._query_schemata') as query:
+            assert first is self._call_fut(dbsession)
+            assert not query.called
+
+        revision = catalog._revision(dbsession)
+        dbsession.execute(models.Schema.__table__.insert().values(
+            name=u'vitals', title=u'Vitals', publish_date=date(2017, 1, 2)))
+        assert revision != catalog._revision(dbsession)
+
+        revision = catalog._revision(dbsession)
+        dbsession.execute(
+            models.Stratum.__table__.update().values(block_number=1))
+        assert revision != catalog._revision(dbsession)
@@ -0,0 +1,57 @@
+import pytest
+
+
+class DummyPlan(object):
+
+    name = 'dummy'
+
+    def __init__(self, versions):
+        self.versions = versions
+        self.calls = 0
+
+    def codebook_fingerprint(self):
+        return {'versions': self.versions}
+
+    def codebook(self):
+        from datetime import date
+        from occams.exports.codebook import row, types
+        self.calls += 1
+        yield row('foo', self.name, types.CHOICE,
+                  choices=[(u'1', u'One')],
+                  publish_date=date(2017, 1, 2))
+
+
+class TestCodebookStore:
+
+    @pytest.fixture
+    def store(self, tmpdir):
+        from occams.exports.codebook import CodebookStore
+        return CodebookStore(str(tmpdir.join('codebooks')))
+
+    def test_get(self, store):
+        """
+        It should only generate the codebook rows once
+        """
+        plan = DummyPlan(['2017-01-02'])
+
+        first = store.get(plan)
+        second = store.get(plan)
+
+        assert plan.calls == 1
+        assert first == second
+        assert first[0]['publish_date'] == '2017-01-02'
+        assert first[0]['choices'] == [(u'1', u'One')]
+
+    def test_get_changed(self, store):
+        """
+        It should regenerate the codebook rows when the plan changes
+        """
+        import os
+
+        store.get(DummyPlan(['2017-01-02']))
+
+        plan = DummyPlan(['2017-01-02', '2017-02-03'])
+        store.get(plan)
+
+        assert plan.calls == 1
+        assert len(os.listdir(store.path)) == 1
@@ -0,0 +1,193 @@
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+
+
+class TestWriteParquet:
+
+    def _read(self, query, codebook_rows, **kw):
+        from contextlib import closing
+        import six
+        from occams.exports import columnar
+
+        with closing(six.BytesIO()) as fp:
+            rows = columnar.write_parquet(fp, query, codebook_rows, **kw)
+            table = pq.read_table(six.BytesIO(fp.getvalue()))
+
+        assert rows == table.num_rows
+        return table
+
+    def test_types(self, dbsession):
+        """
+        It should type each column according to the codebook
+        """
+        from datetime import date
+        from occams import models
+        from occams.exports.schema import SchemaPlan
+
+        schema = models.Schema(
+            name=u'vitals',
+            title=u'Vitals',
+            publish_date=date.today(),
+            attributes={
+                'weight': models.Attribute(
+                    name=u'weight', title=u'', type=u'number',
+                    decimal_places=1, order=0),
+                'visits': models.Attribute(
+                    name=u'visits', title=u'', type=u'number',
+                    decimal_places=0, order=1),
+                'seen': models.Attribute(
+                    name=u'seen', title=u'', type=u'date', order=2),
+                'sex': models.Attribute(
+                    name=u'sex', title=u'', type=u'choice', order=3,
+                    choices={
+                        '001': models.Choice(
+                            name=u'001', title=u'Female', order=0),
+                        '002': models.Choice(
+                            name=u'002', title=u'Male', order=1)}),
+                'notes': models.Attribute(
+                    name=u'notes', title=u'', type=u'text', order=4)})
+        patient = models.Patient(
+            site=models.Site(name=u'ucsd', title=u'UCSD'),
+            pid=u'12345',
+            entities=[
+                models.Entity(
+                    schema=schema,
+                    collect_date=date(2017, 1, 2),
+                    data={
+                        'weight': 70.5,
+                        'visits': 3,
+                        'seen': u'2017-01-01',
+                        'sex': u'002',
+                        'notes': u'¿Qué pasa?'}),
+                models.Entity(
+                    schema=schema,
+                    collect_date=date(2017, 1, 3),
+                    data={})])
+        dbsession.add_all([schema, patient])
+        dbsession.flush()
+
+        plan = SchemaPlan.from_schema(dbsession, schema.name)
+        table = self._read(plan.data(), list(plan.codebook()))
+        types = dict((field.name, field.type) for field in table.schema)
+
+        assert pa.float64() == types['weight']
+        assert pa.int64() == types['visits']
+        assert pa.date32() == types['seen']
+        assert pa.types.is_dictionary(types['sex'])
+        assert pa.string() == types['notes']
+        assert pa.date32() == types['collect_date']
+        assert pa.bool_() == types['not_done']
+
+        rows = sorted(table.to_pylist(), key=lambda r: r['collect_date'])
+        assert 70.5 == rows[0]['weight']
+        assert 3 == rows[0]['visits']
+        assert date(2017, 1, 1) == rows[0]['seen']
+        assert u'002' == rows[0]['sex']
+        assert u'¿Qué pasa?' == rows[0]['notes']
+        assert rows[1]['weight'] is None
+        assert rows[1]['sex'] is None
+
+    def test_private(self, dbsession):
+        """
+        It should write de-identified private fields as strings
+        """
+        from datetime import date
+        from occams import models
+        from occams.exports.schema import SchemaPlan
+
+        schema = models.Schema(
+            name=u'contact',
+            title=u'Contact',
+            publish_date=date.today(),
+            attributes={
+                'birth_date': models.Attribute(
+                    name=u'birth_date', title=u'', type=u'date',
+                    is_private=True, order=0)})
+        patient = models.Patient(
+            site=models.Site(name=u'ucsd', title=u'UCSD'),
+            pid=u'12345',
+            entities=[
+                models.Entity(
+                    schema=schema,
+                    collect_date=date(2017, 1, 2),
+                    data={'birth_date': u'1980-01-01'})])
+        dbsession.add_all([schema, patient])
+        dbsession.flush()
+
+        plan = SchemaPlan.from_schema(dbsession, schema.name)
+        codebook_rows = list(plan.codebook())
+
+        table = self._read(plan.data(), codebook_rows)
+        assert pa.string() == table.schema.field('birth_date').type
+        assert [u'[PRIVATE]'] == table.column('birth_date').to_pylist()
+
+        table = self._read(
+            plan.data(ignore_private=False), codebook_rows,
+            ignore_private=False)
+        assert pa.date32() == table.schema.field('birth_date').type
+        assert [date(1980, 1, 1)] == table.column('birth_date').to_pylist()
+
+    def test_versions(self):
+        """
+        It should type each column according to all versions of its field
+        """
+        from occams.exports.codebook import types, row
+        from occams.exports.columnar import column_types
+
+        found = column_types([
+            row('weight', u'vitals', types.NUMBER, decimal_places=1),
+            row('weight', u'vitals', types.NUMBER, decimal_places=0),
+            row('visits', u'vitals', types.NUMBER, decimal_places=0),
+            row('visits', u'vitals', types.NUMBER, decimal_places=0),
+            row('height', u'vitals', types.STRING),
+            row('height', u'vitals', types.NUMBER, decimal_places=0),
+        ])
+
+        assert pa.float64() == found['weight']
+        assert pa.int64() == found['visits']
+        assert pa.string() == found['height']
+
+    def test_no_truncation(self):
+        """
+        It should refuse to write fractions in integer columns
+        """
+        from decimal import Decimal
+        from occams.exports.columnar import _table
+
+        schema = pa.schema([pa.field('visits', pa.int64())])
+
+        table = _table(schema, [(Decimal('3'),), (u'4',), (None,)])
+        assert [3, 4, None] == table.column('visits').to_pylist()
+
+        with pytest.raises(ValueError):
+            _table(schema, [(Decimal('72.5'),)])
+
+    def test_unknown_columns(self, dbsession):
+        """
+        It should write columns missing from the codebook as strings
+        """
+        from sqlalchemy import func
+
+        query = dbsession.query(func.generate_series(1, 3).label(u'num'))
+        table = self._read(query, [])
+
+        assert pa.string() == table.schema.field('num').type
+        assert [u'1', u'2', u'3'] == table.column('num').to_pylist()
+
+    def test_progress(self, dbsession):
+        """
+        It should report the rows written every row group
+        """
+        import mock
+        from sqlalchemy import func
+
+        query = dbsession.query(func.generate_series(1, 25).label(u'num'))
+        reported = []
+
+        with mock.patch('occams.exports.columnar.ROW_GROUP_SIZE', 10):
+            table = self._read(query, [], progress=reported.append)
+
+        assert 25 == table.num_rows
+        assert [10, 10, 5] == reported
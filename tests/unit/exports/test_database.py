@@ -0,0 +1,122 @@
+import pytest
+
+
+@pytest.fixture
+def database():
+    from contextlib import closing
+    from occams.exports import database
+
+    with closing(database.connect(':memory:')) as connection:
+        yield connection
+
+
+class TestLoadTable:
+
+    def test_types(self, dbsession, database):
+        """
+        It should type each column according to the codebook
+        """
+        from sqlalchemy import func, literal
+        from occams.exports.database import load_table
+
+        query = dbsession.query(
+            func.generate_series(1, 3).label(u'id'),
+            literal(1.5).label(u'weight'),
+            literal(True).label(u'done'),
+            func.current_date().label(u'seen'))
+        codebook_rows = [
+            {'field': u'id', 'type': u'number', 'decimal_places': 0},
+            {'field': u'weight', 'type': u'number', 'decimal_places': 1},
+            {'field': u'done', 'type': u'boolean'},
+            {'field': u'seen', 'type': u'date'}]
+
+        rows = load_table(database, u'vitals', query, codebook_rows)
+
+        assert 3 == rows
+        columns = dict(
+            (c[1], c[2])
+            for c in database.execute('PRAGMA table_info(vitals)'))
+        assert {
+            'id': 'INTEGER',
+            'weight': 'REAL',
+            'done': 'INTEGER',
+            'seen': 'TEXT'} == columns
+
+        id, weight, done, seen = \
+            database.execute('SELECT * FROM vitals ORDER BY id').fetchone()
+        assert 1 == id
+        assert 1.5 == weight
+        assert 1 == done
+        assert 10 == len(seen)
+
+    def test_indexes(self, dbsession, database):
+        """
+        It should index the columns data files are joined on
+        """
+        from sqlalchemy import func, literal
+        from occams.exports.database import load_table
+
+        query = dbsession.query(
+            func.generate_series(1, 3).label(u'id'),
+            literal(u'xxx-xxx').label(u'pid'),
+            literal(u'foo').label(u'other'))
+
+        load_table(database, u'pid', query, [])
+
+        indexes = [
+            r[0] for r in database.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'")]
+        assert ['ix_pid_id', 'ix_pid_pid'] == sorted(indexes)
+
+    def test_replace(self, dbsession, database):
+        """
+        It should replace the table if it was already loaded
+        """
+        from sqlalchemy import func
+        from occams.exports.database import load_table
+
+        query = dbsession.query(func.generate_series(1, 3).label(u'id'))
+
+        load_table(database, u'pid', query, [])
+        load_table(database, u'pid', query, [])
+
+        assert 3 == database.execute('SELECT COUNT(*) FROM pid').fetchone()[0]
+
+    def test_progress(self, dbsession, database):
+        """
+        It should report the rows loaded every batch
+        """
+        import mock
+        from sqlalchemy import func
+        from occams.exports.database import load_table
+
+        query = dbsession.query(func.generate_series(1, 25).label(u'id'))
+        reported = []
+
+        with mock.patch('occams.exports.database.BATCH_SIZE', 10):
+            rows = load_table(
+                database, u'pid', query, [], progress=reported.append)
+
+        assert 25 == rows
+        assert [10, 10, 5] == reported
+
+
+class TestLoadCodebook:
+
+    def test_choices(self, database):
+        """
+        It should join choices the same way as the codebook file
+        """
+        from occams.exports import codebook
+        from occams.exports.database import load_codebook
+
+        load_codebook(database, [codebook.row(
+            u'sex', u'vitals', u'choice',
+            choices=[(u'001', u'Female'), (u'002', u'Male')],
+            order=3)])
+
+        choices, order, is_system = database.execute(
+            'SELECT choices, "order", is_system FROM codebook').fetchone()
+        assert u'001=Female;002=Male' == choices
+        assert 3 == order
+        assert 0 == is_system
@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
 
+from zipfile import ZIP_DEFLATED, ZIP_STORED
+
+import pytest
+
 
 class TestWriteData:
 
@@ -25,6 +29,232 @@ class TestWriteData:
         assert sorted(['anumeric', 'astring']) == sorted(rows[0])
         assert sorted([u'420', u'¿Qué pasa?']) == sorted(rows[1])
 
+    def test_fetch_size(self, dbsession):
+        """
+        It should stream all rows when a fetch size is specified
+        """
+        from contextlib import closing
+        import six
+        from sqlalchemy import func
+        from occams import exports
+
+        query = dbsession.query(func.generate_series(1, 5).label(u'num'))
+
+        with closing(six.BytesIO()) as fp:
+            exports.write_data(fp, query, fetch_size=2)
+            fp.seek(0)
+            rows = [r for r in exports.csv.reader(fp)]
+
+        assert [[u'num'], [u'1'], [u'2'], [u'3'], [u'4'], [u'5']] == rows
+
+    def test_progress(self, dbsession):
+        """
+        It should report the rows written every so many rows
+        """
+        from contextlib import closing
+        import six
+        from sqlalchemy import func
+        from occams import exports
+
+        query = dbsession.query(func.generate_series(1, 2500).label(u'num'))
+        reported = []
+
+        with closing(six.BytesIO()) as fp:
+            rows = exports.write_data(fp, query, progress=reported.append)
+
+        assert 2500 == rows
+        assert [1000, 1000, 500] == reported
+
+
+class TestCopyData:
+
+    def _write_both(self, query):
+        from contextlib import closing
+        import six
+        from occams import exports
+
+        with closing(six.BytesIO()) as written, \
+                closing(six.BytesIO()) as copied:
+            exports.write_data(written, query)
+            exports.copy_data(copied, query)
+            return written.getvalue(), copied.getvalue()
+
+    def test_matches_write_data(self, dbsession):
+        """
+        It should generate the same file as the CSV writer
+        """
+        from sqlalchemy import (
+            literal, literal_column, cast, null,
+            Boolean, Date, DateTime, Integer, Numeric, Unicode)
+
+        query = dbsession.query(
+            literal_column(u"420", Integer).label(u'anumeric'),
+            literal(u'¿Qué, "pasa"?\nbien', Unicode).label(u'astring'),
+            cast(null(), Unicode).label(u'anull'),
+            literal(u'', Unicode).label(u'aempty'),
+            cast(literal(u'2017-01-02'), Date).label(u'adate'),
+            literal_column(
+                u"TIMESTAMPTZ '2017-01-02 03:04:05.5+00'",
+                DateTime(timezone=True)).label(u'atimestamp'),
+            literal_column(
+                u"TIMESTAMP '2017-01-02 03:04:05'",
+                DateTime).label(u'adatetime'),
+            literal_column(u"TRUE", Boolean).label(u'aboolean'),
+            literal_column(u"3.140", Numeric).label(u'adecimal'))
+
+        written, copied = self._write_both(query)
+        assert written == copied
+
+    def test_plan(self, dbsession):
+        """
+        It should generate the same file as the CSV writer for plans
+        """
+        from datetime import date
+        from occams import models
+        from occams.exports.schema import SchemaPlan
+
+        schema = models.Schema(
+            name=u'contact',
+            title=u'Contact Details',
+            publish_date=date.today(),
+            attributes={
+                'foo': models.Attribute(
+                    name='foo',
+                    title=u'',
+                    type='string',
+                    order=0,
+                )})
+        entity = models.Entity(
+            schema=schema,
+            collect_date=date.today(),
+            data={'foo': u'bar'})
+        patient = models.Patient(
+            site=models.Site(name='ucsd', title=u'UCSD'),
+            pid=u'12345',
+            entities=[entity])
+        dbsession.add_all([schema, entity, patient])
+        dbsession.flush()
+
+        plan = SchemaPlan.from_schema(dbsession, schema.name)
+        written, copied = self._write_both(plan.data())
+        assert written == copied
+
+    def test_progress(self, dbsession):
+        """
+        It should report the rows copied every so many rows
+        """
+        from contextlib import closing
+        import six
+        from sqlalchemy import func, literal
+        from occams import exports
+
+        # Records with line breaks are still counted once
+        query = dbsession.query(
+            func.generate_series(1, 2500).label(u'num'),
+            literal(u'a\nb').label(u'text'))
+        reported = []
+
+        with closing(six.BytesIO()) as fp:
+            rows = exports.copy_data(fp, query, progress=reported.append)
+
+        assert 2500 == rows
+        assert [1000, 1000, 500] == reported
+
+
+class TestIterData:
+
+    def test_matches_write_data(self, dbsession):
+        """
+        It should generate the same file as the CSV writer
+        """
+        from contextlib import closing
+        import six
+        from sqlalchemy import func
+        from occams import exports
+
+        query = dbsession.query(func.generate_series(1, 100).label(u'num'))
+
+        with closing(six.BytesIO()) as fp:
+            exports.write_data(fp, query)
+            written = fp.getvalue()
+
+        chunks = list(exports.iter_data(query, fetch_size=10, chunk_size=50))
+
+        assert len(chunks) > 2
+        assert written == b''.join(chunks)
+
+    def test_header_first(self, dbsession):
+        """
+        It should generate the header before executing the query
+        """
+        from sqlalchemy import func
+        from occams import exports
+
+        query = dbsession.query(func.generate_series(1, 5).label(u'num'))
+        chunks = exports.iter_data(query)
+
+        assert next(chunks).strip() == b'num'
+
+
+class TestIterArchive:
+
+    def test_archive(self, dbsession):
+        """
+        It should generate a zip file of the data files and their codebook
+        """
+        from contextlib import closing
+        from zipfile import ZipFile
+        import six
+        from occams import models, exports
+        from occams.exports.pid import PidPlan
+        from occams.exports.visit import VisitPlan
+
+        dbsession.add(models.Patient(
+            pid=u'xxx-xxx',
+            site=models.Site(name=u'someplace', title=u'Some Place')))
+        dbsession.flush()
+
+        plans = [PidPlan(dbsession), VisitPlan(dbsession)]
+        codebook_rows = [r for p in plans for r in p.codebook()]
+        chunks = exports.iter_archive(plans, {}, codebook_rows)
+
+        with closing(six.BytesIO(b''.join(chunks))) as fp, \
+                closing(ZipFile(fp)) as zfp:
+            assert zfp.testzip() is None
+            assert ['pid.csv', 'visit.csv', 'codebook.csv'] == zfp.namelist()
+            pids = [r['pid'] for r in exports.csv.DictReader(
+                zfp.open('pid.csv'))]
+
+        assert [u'xxx-xxx'] == pids
+
+
+class TestMemberWriter:
+
+    @pytest.mark.parametrize('compression', [ZIP_DEFLATED, ZIP_STORED])
+    def test_write(self, compression):
+        """
+        It should stream members the same way zipfile does on Python 3.6+
+        """
+        from contextlib import closing
+        from zipfile import ZipFile
+        import six
+        from occams.exports import _MemberWriter, _StreamBuffer
+
+        buffer = _StreamBuffer()
+
+        with closing(ZipFile(buffer, 'w', compression)) as zfp:
+            with _MemberWriter(zfp, 'a.csv') as fp:
+                fp.write(b'foo,bar\n' * 1000)
+            with _MemberWriter(zfp, 'b.csv') as fp:
+                fp.write(b'')
+
+        with closing(six.BytesIO(buffer.drain())) as fp, \
+                closing(ZipFile(fp)) as zfp:
+            assert zfp.testzip() is None
+            assert ['a.csv', 'b.csv'] == zfp.namelist()
+            assert b'foo,bar\n' * 1000 == zfp.read('a.csv')
+            assert b'' == zfp.read('b.csv')
+
 
 class TestDumpCodeBook:
 
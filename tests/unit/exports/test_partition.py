@@ -0,0 +1,197 @@
+class TestSplit:
+
+    def _patients(self, dbsession):
+        from datetime import date, timedelta
+        from occams import models
+
+        ucsd = models.Site(name=u'ucsd', title=u'UCSD')
+        ucla = models.Site(name=u'ucla', title=u'UCLA')
+        study = models.Study(
+            name=u'cooties',
+            short_title=u'CTY',
+            code=u'999',
+            consent_date=date.today() - timedelta(365),
+            title=u'Cooties')
+        patients = [
+            models.Patient(site=ucsd, pid=u'111'),
+            models.Patient(site=ucsd, pid=u'222'),
+            models.Patient(site=ucla, pid=u'333')]
+        enrollment = models.Enrollment(
+            patient=patients[0],
+            study=study,
+            consent_date=date.today() - timedelta(5))
+        dbsession.add_all(patients + [study, enrollment])
+        dbsession.flush()
+
+    def _pids(self, partition):
+        return sorted(r.pid for r in partition.data())
+
+    def test_unpartitioned(self, dbsession):
+        """
+        It should return the plans as-is if they are not partitioned
+        """
+        from occams.exports.partition import split
+        from occams.exports.pid import PidPlan
+
+        plans = [PidPlan(dbsession)]
+
+        assert plans == split(plans, None)
+
+    def test_site(self, dbsession):
+        """
+        It should split a plan's rows by site
+        """
+        from occams.exports.partition import split
+        from occams.exports.pid import PidPlan
+
+        self._patients(dbsession)
+
+        partitions = split([PidPlan(dbsession)], 'site')
+
+        assert ['pid/ucla', 'pid/ucsd'] == [p.name for p in partitions]
+        assert [u'333'] == self._pids(partitions[0])
+        assert [u'111', u'222'] == self._pids(partitions[1])
+
+    def test_study(self, dbsession):
+        """
+        It should split a plan's rows by the studies of their patients
+        """
+        from occams.exports.partition import split
+        from occams.exports.pid import PidPlan
+
+        self._patients(dbsession)
+
+        partitions = split([PidPlan(dbsession)], 'study')
+
+        assert ['pid/cooties', 'pid/_unassigned'] == \
+            [p.name for p in partitions]
+        assert [u'111'] == self._pids(partitions[0])
+        assert [u'222', u'333'] == self._pids(partitions[1])
+
+    def test_without_rows(self, dbsession):
+        """
+        It should only create the partitions a plan has rows for
+        """
+        from occams import models
+        from occams.exports.partition import split
+        from occams.exports.enrollment import EnrollmentPlan
+        from occams.exports.pid import PidPlan
+
+        self._patients(dbsession)
+        dbsession.add(models.Site(name=u'ucr', title=u'UCR'))
+        dbsession.flush()
+
+        partitions = split(
+            [EnrollmentPlan(dbsession), PidPlan(dbsession)], 'site')
+
+        assert ['enrollment/ucsd', 'pid/ucla', 'pid/ucsd'] == \
+            [p.name for p in partitions]
+
+        dbsession.query(models.Enrollment).delete()
+        dbsession.flush()
+
+        partitions = split([EnrollmentPlan(dbsession)], 'study')
+
+        assert ['enrollment/_unassigned'] == [p.name for p in partitions]
+
+    def test_site_without_column(self, dbsession):
+        """
+        It should match rows by their pid if the plan has no site column
+        """
+        from datetime import date
+        from occams import models
+        from occams.exports.partition import split
+        from occams.exports.schema import SchemaPlan
+
+        schema = models.Schema(
+            name=u'contact',
+            title=u'Contact Details',
+            publish_date=date.today(),
+            attributes={
+                'foo': models.Attribute(
+                    name='foo', title=u'', type='string', order=0)})
+        patient = models.Patient(
+            site=models.Site(name=u'ucsd', title=u'UCSD'),
+            pid=u'111',
+            entities=[
+                models.Entity(schema=schema, data={'foo': u'x'})])
+        orphan = models.Entity(schema=schema, data={'foo': u'y'})
+        dbsession.add_all([schema, patient, orphan])
+        dbsession.flush()
+
+        plan = SchemaPlan.from_schema(dbsession, schema.name)
+        ucsd, unassigned = split([plan], 'site')
+
+        assert [u'x'] == [r.value for r in ucsd.data(layout='long')]
+        assert [u'y'] == [r.value for r in unassigned.data(layout='long')]
+
+    def test_schema_entities(self, dbsession):
+        """
+        It should restrict a form's entities before building its report
+        """
+        from datetime import date
+        import mock
+        from occams import models
+        from occams.exports.partition import split
+        from occams.exports.schema import SchemaPlan
+        from occams.reporting import build_report
+
+        self._patients(dbsession)
+        schema = models.Schema(
+            name=u'contact',
+            title=u'Contact Details',
+            publish_date=date.today(),
+            attributes={
+                'foo': models.Attribute(
+                    name='foo', title=u'', type='string', order=0)})
+        for patient in dbsession.query(models.Patient):
+            patient.entities.add(
+                models.Entity(schema=schema, data={'foo': patient.pid}))
+        dbsession.flush()
+
+        plan = SchemaPlan.from_schema(dbsession, schema.name)
+        cooties, unassigned = split([plan], 'study')
+
+        with mock.patch(
+                'occams.exports.schema.build_report',
+                wraps=build_report) as report:
+            assert [u'111'] == [r.foo for r in cooties.data()]
+            assert [u'222', u'333'] == \
+                sorted(r.foo for r in unassigned.data())
+
+        for call in report.call_args_list:
+            assert call[1]['condition'] is not None
+
+
+class TestPartition:
+
+    def test_fingerprint(self, dbsession):
+        """
+        It should change along with the tables joined into the rows
+        """
+        from occams import models
+        from occams.exports.cache import plan_key
+        from occams.exports.partition import split
+        from occams.exports.pid import PidPlan
+
+        patient = models.Patient(
+            site=models.Site(name=u'ucsd', title=u'UCSD'), pid=u'111')
+        dbsession.add(patient)
+        dbsession.flush()
+
+        partition, = split([PidPlan(dbsession)], 'site')
+        key = plan_key(partition, {})
+
+        reference_type = models.ReferenceType(name=u'mrn', title=u'MRN')
+        patient.references.append(models.PatientReference(
+            reference_type=reference_type, reference_number=u'123'))
+        dbsession.flush()
+
+        referenced = plan_key(partition, {})
+        assert key != referenced
+
+        reference, = patient.references
+        reference.reference_number = u'456'
+        dbsession.flush()
+
+        assert referenced != plan_key(partition, {})
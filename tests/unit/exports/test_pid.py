@@ -86,6 +86,54 @@ class TestPidPlan:
         data = query.one()._asdict()
         assert data['med_num'] == '999'
 
+    def test_data_with_multiple_refs(self, dbsession):
+        """
+        It should list each patient's reference numbers under their type
+        """
+        from occams import models
+
+        plan = self._create_one(dbsession)
+
+        med_num = models.ReferenceType(
+            name=u'med_num', title=u'Medical Number')
+        aeh_num = models.ReferenceType(
+            name=u'aeh_num', title=u'AEH Number')
+        site = models.Site(name=u'someplace', title=u'Some Place')
+
+        dbsession.add_all([
+            models.Patient(
+                pid=u'xxx-xxx',
+                site=site,
+                references=[
+                    models.PatientReference(
+                        reference_type=med_num, reference_number=u'111'),
+                    models.PatientReference(
+                        reference_type=med_num, reference_number=u'222'),
+                    models.PatientReference(
+                        reference_type=aeh_num, reference_number=u'333'),
+                ]),
+            models.Patient(
+                pid=u'yyy-yyy',
+                site=site,
+                references=[
+                    models.PatientReference(
+                        reference_type=aeh_num, reference_number=u'444'),
+                ]),
+            models.Patient(pid=u'zzz-zzz', site=site),
+        ])
+        dbsession.flush()
+
+        rows = [r._asdict() for r in plan.data()]
+
+        assert [u'xxx-xxx', u'yyy-yyy', u'zzz-zzz'] == \
+            [r['pid'] for r in rows]
+        assert sorted(rows[0]['med_num'].split(';')) == [u'111', u'222']
+        assert rows[0]['aeh_num'] == u'333'
+        assert rows[1]['med_num'] is None
+        assert rows[1]['aeh_num'] == u'444'
+        assert rows[2]['med_num'] is None
+        assert rows[2]['aeh_num'] is None
+
     @pytest.mark.parametrize('study_code', [u'ET', u'LTW', u'CVCT'])
     def test_data_with_early_test(self, dbsession, study_code):
         """
@@ -117,3 +165,149 @@ class TestPidPlan:
         query = plan.data()
         data = query.one()._asdict()
         assert data['early_id'] == patient.enrollments[0].reference_number
+
+    def test_delta(self, dbsession):
+        """
+        It should only include patients modified since the specified time
+        """
+        from occams import models
+
+        plan = self._create_one(dbsession)
+        site = models.Site(name=u'someplace', title=u'Some Place')
+
+        dbsession.add(models.Patient(pid=u'xxx-xxx', site=site))
+        dbsession.flush()
+
+        since = dbsession.execute('SELECT timeofday()::timestamptz').scalar()
+
+        dbsession.add(models.Patient(pid=u'yyy-yyy', site=site))
+        dbsession.flush()
+
+        assert [u'xxx-xxx', u'yyy-yyy'] == [r.pid for r in plan.delta()]
+        assert [u'yyy-yyy'] == [r.pid for r in plan.delta(since)]
+
+    def test_delta_joined(self, dbsession):
+        """
+        It should include patients whose joined rows changed since the
+        specified time
+        """
+        from datetime import date
+        from occams import models
+
+        plan = self._create_one(dbsession)
+        site = models.Site(name=u'someplace', title=u'Some Place')
+        enrollment = models.Enrollment(
+            consent_date=date.today(),
+            reference_number=u'76C000000',
+            study=models.Study(
+                name=u'some_study',
+                code=u'ET',
+                consent_date=date.today(),
+                short_title=u'smstdy',
+                title=u'Some Study'))
+
+        dbsession.add(models.Patient(
+            pid=u'xxx-xxx', site=site, enrollments=[enrollment]))
+        dbsession.flush()
+
+        since = dbsession.execute('SELECT timeofday()::timestamptz').scalar()
+        assert [] == plan.delta(since).all()
+
+        site.title = u'Some Other Place'
+        dbsession.flush()
+        assert [u'xxx-xxx'] == [r.pid for r in plan.delta(since)]
+
+        since = dbsession.execute('SELECT timeofday()::timestamptz').scalar()
+        dbsession.delete(enrollment)
+        dbsession.flush()
+        assert [u'xxx-xxx'] == [r.pid for r in plan.delta(since)]
+
+    def test_tombstones(self, dbsession):
+        """
+        It should list patients deleted since the specified time
+        """
+        from occams import models
+
+        plan = self._create_one(dbsession)
+        site = models.Site(name=u'someplace', title=u'Some Place')
+        old = models.Patient(pid=u'xxx-xxx', site=site)
+        new = models.Patient(pid=u'yyy-yyy', site=site)
+
+        dbsession.add_all([old, new])
+        dbsession.flush()
+        old_id, new_id = old.id, new.id
+
+        dbsession.delete(old)
+        dbsession.flush()
+
+        since = dbsession.execute('SELECT timeofday()::timestamptz').scalar()
+
+        dbsession.delete(new)
+        dbsession.flush()
+
+        rows = plan.tombstones().order_by('id').all()
+        assert [(u'pid', old_id), (u'pid', new_id)] == \
+            [(r.table, r.id) for r in rows]
+
+        rows = plan.tombstones(since).all()
+        assert [(u'pid', new_id)] == [(r.table, r.id) for r in rows]
+
+    def test_fingerprint(self, dbsession):
+        """
+        It should change whenever patients are added, modified or removed
+        """
+        from occams import models
+
+        plan = self._create_one(dbsession)
+        patient = models.Patient(
+            pid=u'xxx-xxx',
+            site=models.Site(name=u'someplace', title=u'Some Place'))
+
+        empty = plan.fingerprint()
+        assert empty[:3] == [0, None, None]
+
+        dbsession.add(patient)
+        dbsession.flush()
+        added = plan.fingerprint()
+        assert added not in (empty,)
+
+        patient.initials = u'ABC'
+        dbsession.flush()
+        modified = plan.fingerprint()
+        assert modified not in (empty, added)
+
+        patient.site.name = u'elsewhere'
+        dbsession.flush()
+        moved = plan.fingerprint()
+        assert moved not in (empty, added, modified)
+
+        reftype = models.ReferenceType(name=u'mrn', title=u'MRN')
+        patient.references.append(models.PatientReference(
+            reference_type=reftype, reference_number=u'123'))
+        dbsession.flush()
+        referenced = plan.fingerprint()
+        assert referenced not in (empty, added, modified, moved)
+
+        dbsession.delete(patient)
+        dbsession.flush()
+        removed = plan.fingerprint()
+        assert removed not in (empty, added, modified, moved, referenced)
+
+    def test_fingerprint_reftypes(self, dbsession):
+        """
+        It should change whenever reference types are added, since they
+        are exported as columns even without any reference numbers
+        """
+        from occams import models
+        from occams.exports.cache import plan_key
+
+        dbsession.add(models.Patient(
+            pid=u'xxx-xxx',
+            site=models.Site(name=u'someplace', title=u'Some Place')))
+        dbsession.flush()
+        key = plan_key(self._create_one(dbsession), {})
+
+        dbsession.add(models.ReferenceType(name=u'mrn', title=u'MRN'))
+        dbsession.flush()
+
+        assert key != plan_key(self._create_one(dbsession), {})
@@ -123,6 +123,82 @@ class TestSchemaPlan:
         assert record.visit_date is None
         assert record.collect_date == entity.collect_date
 
+    def test_fingerprint_contexts(self, dbsession):
+        """
+        It should change when the context of the entities changes
+        """
+        from datetime import date
+        from occams import models
+        from occams.exports.schema import SchemaPlan
+
+        schema = models.Schema(
+            name=u'contact',
+            title=u'Contact Details',
+            publish_date=date.today(),
+            attributes={
+                'foo': models.Attribute(
+                    name='foo', title=u'', type='string', order=0)})
+        entity = models.Entity(schema=schema, collect_date=date.today())
+        patient = models.Patient(
+            site=models.Site(name='ucsd', title=u'UCSD'),
+            pid=u'12345',
+            entities=[entity])
+        dbsession.add_all([schema, entity, patient])
+        dbsession.flush()
+
+        plan = SchemaPlan.from_schema(dbsession, schema.name)
+        fingerprint = plan.fingerprint()
+
+        patient.site = models.Site(name='ucla', title=u'UCLA')
+        dbsession.flush()
+
+        assert fingerprint != plan.fingerprint()
+
+    def test_long_layout(self, dbsession):
+        """
+        It should generate one row per value with the entity's patient
+        """
+        from datetime import date, datetime
+        from occams import models
+        from occams.exports.schema import SchemaPlan
+
+        schema = models.Schema(
+            name=u'contact',
+            title=u'Contact Details',
+            publish_date=date.today(),
+            attributes={
+                'foo': models.Attribute(
+                    name='foo',
+                    title=u'',
+                    type='string',
+                    order=0),
+                'bar': models.Attribute(
+                    name='bar',
+                    title=u'',
+                    type='string',
+                    order=1)})
+        entity = models.Entity(
+            schema=schema,
+            collect_date=date.today(),
+            data={'foo': u'x'})
+        patient = models.Patient(
+            site=models.Site(name='ucsd', title=u'UCSD'),
+            pid=u'12345',
+            entities=[entity])
+        dbsession.add_all([schema, entity, patient])
+        dbsession.flush()
+
+        plan = SchemaPlan.from_schema(dbsession, schema.name)
+        query = plan.data(layout='long')
+        data_columns = [c['name'] for c in query.column_descriptions]
+        record = query.one()
+        assert ['id', 'pid', 'attribute', 'value', 'modified_at'] == \
+            data_columns
+        assert (entity.id, u'12345', u'foo', u'x') == record[:4]
+
+        assert 1 == plan.delta(layout='long').count()
+        assert 0 == plan.delta(datetime(3000, 1, 1), layout='long').count()
+
     def test_enrollment(self, dbsession):
         """
         It should add enrollment-specific metadata to the report
@@ -319,3 +395,39 @@ class TestSchemaPlan:
         assert record.block_number == stratum.block_number
         assert record.arm_name == stratum.arm.title
         assert record.randid == stratum.randid
+
+    def test_tombstones(self, dbsession):
+        """
+        It should only list deleted entities of the plan's schema
+        """
+        from datetime import date
+        from occams import models
+        from occams.exports.schema import SchemaPlan
+
+        def make_entity(name):
+            schema = models.Schema(
+                name=name,
+                title=name,
+                publish_date=date.today(),
+                attributes={
+                    'foo': models.Attribute(
+                        name='foo',
+                        title=u'',
+                        type='string',
+                        order=0,
+                    )})
+            return models.Entity(schema=schema, collect_date=date.today())
+
+        entity = make_entity(u'vitals')
+        other = make_entity(u'contact')
+        dbsession.add_all([entity, other])
+        dbsession.flush()
+        entity_id = entity.id
+
+        dbsession.delete(entity)
+        dbsession.delete(other)
+        dbsession.flush()
+
+        plan = SchemaPlan.from_schema(dbsession, u'vitals')
+        rows = plan.tombstones().all()
+        assert [(u'vitals', entity_id)] == [(r.table, r.id) for r in rows]
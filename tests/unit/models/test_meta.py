@@ -0,0 +1,24 @@
+"""
+Tests the metadata hooks
+"""
+
+
+def test_after_create_audit_exclude():
+    """
+    It should skip excluded tables and still audit the tables after them
+    """
+    import mock
+    from occams import models  # NOQA (registers the tables)
+    from occams.models.meta import metadata, after_create
+
+    connection = mock.Mock()
+    after_create(metadata, connection)
+
+    audited = [c[0][0].split("'")[1]
+               for c in connection.execute.call_args_list]
+    names = [t.name for t in metadata.sorted_tables]
+
+    excluded = ['revision', 'tombstone']
+
+    assert names.index('tombstone') < names.index('visit')
+    assert [n for n in names if n not in excluded] == audited
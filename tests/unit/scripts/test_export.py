@@ -44,6 +44,7 @@ class TestPrintList:
                 'request': req,
                 'registry': req.registry,
             }).start()
+        mock.patch('occams.scripts.export.setup_logging').start()
 
         self.dir = tempfile.mkdtemp()
 
@@ -100,6 +101,87 @@ class TestPrintList:
             output = self._call_fut([None, '--config', 'fake.ini', '--list'])
             assert '*' in output
 
+    def _add_form(self, dbsession):
+        from datetime import date
+        from occams import models
+
+        schema = models.Schema(
+            name=u'vitals',
+            title=u'Vitals',
+            publish_date=date.today(),
+            attributes={
+                'weight': models.Attribute(
+                    name=u'weight', title=u'', type=u'number',
+                    decimal_places=1, order=0)})
+        patient = models.Patient(
+            site=models.Site(name=u'ucsd', title=u'UCSD'),
+            pid=u'12345',
+            entities=[
+                models.Entity(
+                    schema=schema,
+                    collect_date=date(2017, 1, 2),
+                    data={'weight': u'70.5'})])
+        dbsession.add_all([schema, patient])
+        dbsession.flush()
+
+    def test_print_list_plans(self, dbsession):
+        """
+        It should list the plans available in the database
+        """
+        self._add_form(dbsession)
+        output = self._call_fut([None, '--config', 'fake.ini', '--list'])
+        assert 'pid' in output
+        assert 'vitals' in output
+
+    def test_make_export_parquet(self, dbsession):
+        """
+        It should write the data files in the requested format
+        """
+        import os
+        pq = pytest.importorskip('pyarrow.parquet')
+        from occams.exports.codebook import FILE_NAME
+
+        self._add_form(dbsession)
+        self._call_fut(
+            [None, '--config', 'fake.ini', '--dir', self.dir,
+             '--format', 'parquet', 'pid', 'vitals'])
+
+        files = sorted(os.listdir(self.dir))
+        assert sorted([FILE_NAME, 'pid.parquet', 'vitals.parquet']) == files
+
+        table = pq.read_table(os.path.join(self.dir, 'vitals.parquet'))
+        assert [70.5] == table.column('weight').to_pylist()
+
+    def test_make_export_sqlite(self, dbsession):
+        """
+        It should load all data files into a single database
+        """
+        from contextlib import closing
+        import os
+        import sqlite3
+        from occams.exports import database
+
+        self._add_form(dbsession)
+        self._call_fut(
+            [None, '--config', 'fake.ini', '--dir', self.dir,
+             '--format', 'sqlite', '--all'])
+
+        assert [database.FILE_NAME] == os.listdir(self.dir)
+
+        path = os.path.join(self.dir, database.FILE_NAME)
+        with closing(sqlite3.connect(path)) as connection:
+            tables = set(name for name, in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"))
+            weights = connection.execute(
+                'SELECT pid, weight FROM vitals').fetchall()
+            codebook = connection.execute(
+                'SELECT DISTINCT "table" FROM codebook').fetchall()
+
+        assert set(['pid', 'enrollment', 'visit', 'vitals',
+                    database.CODEBOOK_TABLE]) <= tables
+        assert [(u'12345', 70.5)] == weights
+        assert set(['pid', 'vitals']) <= set(t for t, in codebook)
+
     def test_make_export_all(self, dbsession, plan):
         """
         It should be able to export data for all plans
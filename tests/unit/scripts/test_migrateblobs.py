@@ -0,0 +1,23 @@
+def test_migrate_batch(dbsession, tmpdir):
+    """
+    It should move blobs out of the database in resumable batches
+    """
+    from occams import models
+    from occams.blobs import BlobStore
+    from occams.scripts.migrateblobs import migrate_batch
+
+    store = BlobStore(str(tmpdir))
+    blobs = [
+        models.EntityAttachmentBlob(content=b'foo'),
+        models.EntityAttachmentBlob(content=b'bar'),
+        models.EntityAttachmentBlob(content=b'foo')]
+    dbsession.add_all(blobs)
+    dbsession.flush()
+
+    assert 2 == migrate_batch(dbsession, store, batch_size=2)
+    assert 1 == migrate_batch(dbsession, store, batch_size=2)
+    assert 0 == migrate_batch(dbsession, store, batch_size=2)
+
+    assert all(blob.content is None for blob in blobs)
+    assert blobs[0].digest == blobs[2].digest
+    assert [b'foo', b'bar', b'foo'] == [store.open(b).read() for b in blobs]
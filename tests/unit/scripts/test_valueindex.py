@@ -0,0 +1,45 @@
+def test_build_statements(dbsession):
+    """
+    It should build concurrent index statements for each attribute
+    """
+    from datetime import date
+    from occams import models
+    from occams.scripts.valueindex import build_statements
+
+    schema = models.Schema(
+        name=u'vitals',
+        title=u'Vitals',
+        publish_date=date.today(),
+        attributes={
+            'weight': models.Attribute(
+                name=u'weight', title=u'', type='number', order=0),
+            'seen': models.Attribute(
+                name=u'seen', title=u'', type='date', order=1)})
+    dbsession.add(schema)
+    dbsession.flush()
+
+    create_weight, create_seen = \
+        build_statements(dbsession, u'vitals', [u'weight', u'seen'])
+
+    assert (
+        "CREATE INDEX CONCURRENTLY ix_entity_vitals_weight ON entity "
+        "(CAST(data ->> 'weight' AS NUMERIC)) "
+        "WHERE schema_id IN ({})".format(schema.id)) == create_weight
+    assert 'NUMERIC' not in create_seen
+
+    drop_weight, = \
+        build_statements(dbsession, u'vitals', [u'weight'], drop=True)
+
+    assert 'DROP INDEX CONCURRENTLY IF EXISTS ix_entity_vitals_weight' == \
+        drop_weight
+
+
+def test_unknown_attribute(dbsession):
+    """
+    It should exit if the attribute is not part of the form
+    """
+    import pytest
+    from occams.scripts.valueindex import build_statements
+
+    with pytest.raises(SystemExit):
+        build_statements(dbsession, u'vitals', [u'weight'])
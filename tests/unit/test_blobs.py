@@ -0,0 +1,114 @@
+"""
+Tests the content-addressed blob store
+"""
+
+import pytest
+
+
+@pytest.fixture
+def store(tmpdir):
+    from occams.blobs import BlobStore
+    return BlobStore(str(tmpdir.join('blobs')))
+
+
+def test_put(store):
+    """
+    It should store files named after the SHA-256 digest of their content
+    """
+    import hashlib
+    import os
+    from six import BytesIO
+
+    digest, size, mime_type = store.put(BytesIO(b'hello'))
+
+    assert hashlib.sha256(b'hello').hexdigest() == digest
+    assert 5 == size
+    assert 'text/plain' == mime_type
+    path = store.file_path(digest)
+    assert os.path.join(store.path, digest[:2], digest[2:4], digest) == path
+    with open(path, 'rb') as fp:
+        assert b'hello' == fp.read()
+
+
+def test_put_duplicate(store):
+    """
+    It should only store identical files once
+    """
+    import os
+    from six import BytesIO
+
+    first = store.put(BytesIO(b'hello'))
+    second = store.put(BytesIO(b'hello'))
+
+    assert first.digest == second.digest
+    assert [] == [n for n in os.listdir(store.path) if n.endswith('.tmp')]
+
+
+def test_put_chunked(store):
+    """
+    It should stream files larger than a chunk, one chunk at a time
+    """
+    import mock
+    from six import BytesIO
+
+    fp = BytesIO(b'%PDF-1.4 hello')
+
+    with mock.patch('occams.blobs.CHUNK_SIZE', 8), \
+            mock.patch.object(fp, 'read', wraps=fp.read) as read:
+        stored = store.put(fp)
+
+    assert [mock.call(8)] * 3 == read.call_args_list
+    assert 14 == stored.size
+    assert 'application/pdf' == stored.mime_type
+    with open(store.file_path(stored.digest), 'rb') as fp:
+        assert b'%PDF-1.4 hello' == fp.read()
+
+
+def test_put_max_size(store):
+    """
+    It should stop storing files as soon as they exceed the maximum size
+    """
+    import os
+    import mock
+    from six import BytesIO
+    from occams.blobs import BlobTooLarge
+
+    fp = BytesIO(b'x' * 10)
+
+    with mock.patch('occams.blobs.CHUNK_SIZE', 4), \
+            pytest.raises(BlobTooLarge):
+        store.put(fp, max_size=6)
+
+    assert 8 == fp.tell()
+    assert [] == os.listdir(store.path)
+
+    assert 10 == store.put(BytesIO(b'x' * 10), max_size=10).size
+
+
+def test_save(dbsession, store):
+    """
+    It should only keep the digest and size of saved blobs in the database
+    """
+    from six import BytesIO
+    from occams import models
+
+    blob = models.EntityAttachmentBlob()
+    store.save(blob, BytesIO(b'hello'))
+    dbsession.add(blob)
+    dbsession.flush()
+
+    assert blob.content is None
+    assert 5 == blob.size
+    with store.open(blob) as fp:
+        assert b'hello' == fp.read()
+
+
+def test_open_legacy(store):
+    """
+    It should read blobs that are still stored in the database
+    """
+    from occams import models
+
+    blob = models.EntityAttachmentBlob(content=b'hello')
+
+    assert b'hello' == store.open(blob).read()
@@ -0,0 +1,238 @@
+"""
+Tests the compiled entity codecs
+"""
+
+import pytest
+
+
+@pytest.fixture
+def schema(dbsession):
+    from datetime import date
+    from occams import models
+
+    schema = models.Schema(
+        name=u'vitals',
+        title=u'Vitals',
+        publish_date=date.today(),
+        attributes={
+            'section': models.Attribute(
+                name=u'section',
+                title=u'Section',
+                type='section',
+                order=0,
+                attributes={
+                    'weight': models.Attribute(
+                        name=u'weight', title=u'', type='number', order=1),
+                    'seen': models.Attribute(
+                        name=u'seen', title=u'', type='date', order=2)}),
+            'seen_at': models.Attribute(
+                name=u'seen_at', title=u'', type='datetime', order=3),
+            'notes': models.Attribute(
+                name=u'notes', title=u'', type='string', order=4)})
+    dbsession.add(schema)
+    dbsession.flush()
+    return schema
+
+
+def test_decode(dbsession, schema):
+    """
+    It should convert the entity document into nested, typed form data
+    """
+    from datetime import date, datetime
+    from decimal import Decimal
+    from occams import models
+    from occams.codec import get_codec
+
+    entity = models.Entity(schema=schema, data={
+        'weight': u'72.5',
+        'seen': u'2017-03-01',
+        'seen_at': u'2017-03-01 13:45:00',
+        'notes': None})
+
+    data = get_codec(schema).decode(entity)
+
+    assert {
+        'section': {
+            'weight': Decimal('72.5'),
+            'seen': date(2017, 3, 1)},
+        'seen_at': datetime(2017, 3, 1, 13, 45),
+        'notes': None} == data
+
+
+def test_encode(dbsession, schema):
+    """
+    It should store numbers and dates as strings
+    """
+    from datetime import date
+    from decimal import Decimal
+    from occams.codec import get_codec
+
+    codec = get_codec(schema)
+    fields = dict((f.name, f) for f in codec.fields)
+
+    assert u'72.5' == codec.encode(fields['weight'], Decimal('72.5'))
+    assert u'2017-03-01' == codec.encode(fields['seen'], date(2017, 3, 1))
+    assert codec.encode(fields['seen'], None) is None
+    assert u'foo' == codec.encode(fields['notes'], u'foo')
+
+
+def test_cached(dbsession, schema):
+    """
+    It should compile published versions only once
+    """
+    from occams.codec import get_codec
+
+    assert get_codec(schema) is get_codec(schema)
+
+
+def test_draft(dbsession, schema):
+    """
+    It should always compile drafts
+    """
+    from occams.codec import get_codec
+
+    schema.publish_date = None
+    dbsession.flush()
+
+    assert get_codec(schema) is not get_codec(schema)
+
+
+def test_invalidate_on_change(dbsession, schema):
+    """
+    It should discard the cached codec when the attributes are changed
+    """
+    from occams import models
+    from occams.codec import get_codec
+
+    codec = get_codec(schema)
+
+    schema.attributes['height'] = models.Attribute(
+        name=u'height', title=u'', type='number', order=5)
+    dbsession.flush()
+
+    updated = get_codec(schema)
+
+    assert codec is not updated
+    assert 'height' in [f.name for f in updated.fields]
+
+
+def test_changed_elsewhere(dbsession, schema):
+    """
+    It should pick up attributes changed outside of this process
+    """
+    from occams import models
+    from occams.codec import get_codec
+
+    codec = get_codec(schema)
+
+    # Inserted without the ORM, the way another process' changes are
+    # never seen by this process' session
+    dbsession.execute(models.Attribute.__table__.insert().values(
+        schema_id=schema.id, name=u'height', title=u'', type='number',
+        order=5))
+    dbsession.expire(schema, ['attributes'])
+
+    updated = get_codec(schema)
+
+    assert codec is not updated
+    assert 'height' in [f.name for f in updated.fields]
+    assert updated is get_codec(schema)
+
+
+@pytest.mark.parametrize('value,expected', [
+    (u'2017-03-01', (2017, 3, 1)),
+    (u'March 1, 2017', (2017, 3, 1)),
+])
+def test_parse_date(value, expected):
+    """
+    It should parse ISO dates and fall back to dateutil otherwise
+    """
+    from datetime import date
+    from occams.codec import parse_date
+
+    assert date(*expected) == parse_date(value)
+
+
+@pytest.mark.parametrize('value,expected', [
+    (u'2017-03-01 13:45:00', (2017, 3, 1, 13, 45)),
+    (u'2017-03-01 13:45:00.000001', (2017, 3, 1, 13, 45, 0, 1)),
+    (u'2017-03-01T13:45', (2017, 3, 1, 13, 45)),
+])
+def test_parse_datetime(value, expected):
+    """
+    It should parse stored datetimes and fall back to dateutil otherwise
+    """
+    from datetime import datetime
+    from occams.codec import parse_datetime
+
+    assert datetime(*expected) == parse_datetime(value)
+
+
+class TestWriteData:
+
+    @pytest.fixture
+    def statements(self, dbsession):
+        import sqlalchemy as sa
+
+        statements = []
+        connection = dbsession.connection()
+
+        def capture(conn, cursor, statement, *args):
+            if statement.startswith('UPDATE entity '):
+                statements.append(statement)
+
+        sa.event.listen(connection, 'before_cursor_execute', capture)
+        yield statements
+        sa.event.remove(connection, 'before_cursor_execute', capture)
+
+    def test_new(self, dbsession, schema, statements):
+        """
+        It should write the whole document of new entities
+        """
+        from occams import models
+        from occams.codec import write_data
+
+        entity = models.Entity(schema=schema)
+        dbsession.add(entity)
+
+        write_data(dbsession, entity, {'notes': u'foo'})
+        dbsession.flush()
+
+        assert {'notes': u'foo'} == entity.data
+
+    def test_patch(self, dbsession, schema, statements):
+        """
+        It should only update the changed keys of stored entities
+        """
+        from occams import models
+        from occams.codec import write_data
+
+        entity = models.Entity(
+            schema=schema, data={'notes': u'foo', 'weight': u'72.5'})
+        dbsession.add(entity)
+        dbsession.flush()
+
+        write_data(dbsession, entity, {'notes': u'bar', 'weight': u'72.5'})
+
+        assert 1 == len(statements)
+        assert '||' in statements[0]
+        assert {'notes': u'bar', 'weight': u'72.5'} == entity.data
+
+        dbsession.expire(entity)
+        assert {'notes': u'bar', 'weight': u'72.5'} == entity.data
+
+    def test_unchanged(self, dbsession, schema, statements):
+        """
+        It should not update entities whose values did not change
+        """
+        from occams import models
+        from occams.codec import write_data
+
+        entity = models.Entity(schema=schema, data={'notes': u'foo'})
+        dbsession.add(entity)
+        dbsession.flush()
+
+        write_data(dbsession, entity, {'notes': u'foo'})
+        dbsession.flush()
+
+        assert [] == statements
@@ -0,0 +1,192 @@
+"""
+Tests the entity value query module
+"""
+
+import pytest
+
+
+@pytest.fixture
+def schema(dbsession):
+    from datetime import date
+    from occams import models
+
+    schema = models.Schema(
+        name=u'HIVTest',
+        title=u'HIV Test',
+        publish_date=date.today(),
+        attributes={
+            'result': models.Attribute(
+                name=u'result',
+                title=u'',
+                type='choice',
+                order=0,
+                choices={
+                    '001': models.Choice(
+                        name=u'001', title=u'Negative', order=0),
+                    '002': models.Choice(
+                        name=u'002', title=u'Positive', order=1)}),
+            'symptoms': models.Attribute(
+                name=u'symptoms',
+                title=u'',
+                type='choice',
+                is_collection=True,
+                order=1,
+                choices={
+                    '001': models.Choice(
+                        name=u'001', title=u'Fever', order=0),
+                    '002': models.Choice(
+                        name=u'002', title=u'Rash', order=1)}),
+            'viral_load': models.Attribute(
+                name=u'viral_load',
+                title=u'',
+                type='number',
+                order=2),
+            'test_date': models.Attribute(
+                name=u'test_date',
+                title=u'',
+                type='date',
+                order=3)})
+    dbsession.add(schema)
+    dbsession.flush()
+    return schema
+
+
+@pytest.fixture
+def entities(dbsession, schema):
+    from occams import models
+
+    entities = [
+        models.Entity(schema=schema, data={
+            'result': u'002',
+            'symptoms': [u'001', u'002'],
+            'viral_load': u'20000',
+            'test_date': u'2017-03-01'}),
+        models.Entity(schema=schema, data={
+            'result': u'001',
+            'symptoms': [u'002'],
+            'viral_load': u'9.5',
+            'test_date': u'2016-12-31'}),
+        models.Entity(schema=schema, data={
+            'result': None,
+            'symptoms': []})]
+    dbsession.add_all(entities)
+    dbsession.flush()
+    return entities
+
+
+def _matches(dbsession, entities, *criteria):
+    from occams import querying
+    query = querying.entities(dbsession, u'HIVTest', *criteria)
+    return sorted(entities.index(e) for e in query)
+
+
+def test_values(dbsession, schema):
+    """
+    It should list the values of the published form by attribute name
+    """
+    from occams import querying
+
+    values = querying.values(dbsession, u'HIVTest')
+
+    assert ['result', 'symptoms', 'test_date', 'viral_load'] == \
+        sorted(values)
+    assert 'number' == values['viral_load'].type
+    assert values['symptoms'].is_collection
+
+
+def test_equality(dbsession, entities):
+    """
+    It should match values by containment
+    """
+    from occams import querying
+
+    values = querying.values(dbsession, u'HIVTest')
+
+    assert [0] == _matches(dbsession, entities, values['result'] == u'002')
+    assert [0, 1] == _matches(
+        dbsession, entities, values['symptoms'] == u'002')
+    assert [1] == _matches(
+        dbsession, entities, values['viral_load'] == 9.50)
+
+    criterion = values['result'] == u'002'
+    assert '@>' in str(criterion.compile())
+
+
+def test_ranges(dbsession, entities):
+    """
+    It should compare numbers numerically and dates chronologically
+    """
+    from datetime import date
+    from occams import querying
+
+    values = querying.values(dbsession, u'HIVTest')
+
+    assert [0] == _matches(dbsession, entities, values['viral_load'] > 100)
+    assert [0] == _matches(
+        dbsession, entities, values['test_date'] >= date(2017, 1, 1))
+    assert [1] == _matches(
+        dbsession, entities,
+        values['test_date'].between(date(2016, 1, 1), date(2016, 12, 31)))
+
+
+def test_choice_membership(dbsession, entities):
+    """
+    It should match any or all of the specified choices
+    """
+    from occams import querying
+
+    values = querying.values(dbsession, u'HIVTest')
+
+    assert [0, 1] == _matches(
+        dbsession, entities, values['result'].in_([u'001', u'002']))
+    assert [0] == _matches(
+        dbsession, entities, values['symptoms'].contains(u'001', u'002'))
+
+
+def test_null(dbsession, entities):
+    """
+    It should treat missing and JSON null values as unanswered
+    """
+    from occams import querying
+
+    values = querying.values(dbsession, u'HIVTest')
+
+    assert [2] == _matches(dbsession, entities, values['result'] == None)  # NOQA
+    assert [2] == _matches(dbsession, entities, values['viral_load'].is_null())
+    assert [0, 1] == _matches(
+        dbsession, entities, values['test_date'].is_not_null())
+
+
+def test_unpublished(dbsession, entities, schema):
+    """
+    It should only query the published versions of the form
+    """
+    schema.publish_date = None
+    dbsession.flush()
+
+    assert [] == _matches(dbsession, entities)
+
+
+def test_build_index(dbsession, entities, schema):
+    """
+    It should build an index usable by the value lookups
+    """
+    from occams import models, querying
+
+    index = querying.build_index(dbsession, u'HIVTest', u'viral_load')
+    index.create(dbsession.connection())
+
+    assert 'ix_entity_hivtest_viral_load' == index.name
+    assert index not in models.Entity.__table__.indexes
+
+    values = querying.values(dbsession, u'HIVTest')
+    dbsession.execute('SET LOCAL enable_seqscan = off')
+    query = querying.entities(
+        dbsession, u'HIVTest', values['viral_load'] > 100)
+    statement = query.statement.compile(
+        dialect=dbsession.bind.dialect,
+        compile_kwargs={'literal_binds': True})
+    plan = u'\n'.join(
+        r[0] for r in dbsession.execute('EXPLAIN ' + str(statement)))
+
+    assert index.name in plan
@@ -263,10 +263,10 @@ def test_build_report_expected_metadata_columns(dbsession):
     assert u'state' in report.c
     assert u'collect_date' in report.c
     assert u'not_done' in report.c
-    assert u'create_date' in report.c
-    assert u'create_user' in report.c
-    assert u'modify_date' in report.c
-    assert u'modify_user' in report.c
+    assert u'created_at' in report.c
+    assert u'created_by' in report.c
+    assert u'modified_at' in report.c
+    assert u'modified_by' in report.c
 
 
 def test_build_report_scalar_values(dbsession):
@@ -300,14 +300,13 @@ def test_build_report_scalar_values(dbsession):
     dbsession.flush()
 
     # add some entries for the schema
-    entity1 = models.Entity(schema=schema1)
-    entity1['a'] = u'foovalue'
+    entity1 = models.Entity(schema=schema1, data={'a': u'foovalue'})
     dbsession.add(entity1)
     dbsession.flush()
 
     report = reporting.build_report(dbsession, u'A')
     result = dbsession.query(report).one()
-    assert entity1[u'a'] == result.a
+    assert entity1.data[u'a'] == result.a
 
 
 def test_build_report_datetime(dbsession):
@@ -339,8 +338,7 @@ def test_build_report_datetime(dbsession):
     dbsession.flush()
 
     # add some entries for the schema
-    entity1 = models.Entity(schema=schema1)
-    entity1['a'] = date(1976, 7, 4)
+    entity1 = models.Entity(schema=schema1, data={'a': u'1976-07-04'})
     dbsession.add(entity1)
     dbsession.flush()
 
@@ -400,8 +398,7 @@ def test_build_report_choice_types(dbsession):
     dbsession.add(schema1)
     dbsession.flush()
 
-    entity1 = models.Entity(schema=schema1)
-    entity1['a'] = u'002'
+    entity1 = models.Entity(schema=schema1, data={'a': u'002'})
     dbsession.add(entity1)
     dbsession.flush()
 
@@ -417,7 +414,7 @@ def test_build_report_choice_types(dbsession):
 
     # switch to multiple-choice
     schema1.attributes['a'].is_collection = True
-    entity1['a'] = ['002', '003']
+    entity1.data = {'a': [u'002', u'003']}
     dbsession.flush()
 
     # delimited multiple-choice, labels off
@@ -616,8 +613,7 @@ def test_build_report_context(dbsession):
     dbsession.add(schema1)
     dbsession.flush()
 
-    entity1 = models.Entity(schema=schema1)
-    entity1['a'] = u'002'
+    entity1 = models.Entity(schema=schema1, data={'a': u'002'})
     dbsession.add(entity1)
     dbsession.flush()
 
@@ -709,17 +705,185 @@ def test_build_report_ignore_private(dbsession):
     dbsession.flush()
 
     # add some entries for the schema
-    entity1 = models.Entity(schema=schema1)
-    entity1['name'] = u'Jane Doe'
+    entity1 = models.Entity(schema=schema1, data={'name': u'Jane Doe'})
     dbsession.add(entity1)
     dbsession.flush()
 
     # not de-identified
     report = reporting.build_report(dbsession, u'A', ignore_private=False)
     result = dbsession.query(report).one()
-    assert entity1[u'name'] == result.name
+    assert entity1.data[u'name'] == result.name
 
     # de-identified
     report = reporting.build_report(dbsession, u'A', ignore_private=True)
     result = dbsession.query(report).one()
     assert '[PRIVATE]' == result.name
+
+
+def test_build_report_number(dbsession):
+    """
+    It should cast numeric values stored as strings in the JSON document
+    """
+    from datetime import date
+    from decimal import Decimal
+    from occams import models, reporting
+
+    schema1 = models.Schema(
+        name=u'A',
+        title=u'A',
+        publish_date=date.today(),
+        attributes={
+            'a': models.Attribute(
+                name=u'a',
+                title=u'',
+                type='number',
+                decimal_places=2,
+                order=0)})
+    dbsession.add(schema1)
+    dbsession.flush()
+
+    entity1 = models.Entity(schema=schema1, data={'a': u'3.14'})
+    dbsession.add(entity1)
+    dbsession.flush()
+
+    report = reporting.build_report(dbsession, u'A')
+    result = dbsession.query(report).one()
+    assert result.a == Decimal('3.14')
+
+
+def test_build_report_collection_null(dbsession):
+    """
+    It should leave collections blank if the stored value is a JSON null
+    """
+    from datetime import date
+    from occams import models, reporting
+
+    schema1 = models.Schema(
+        name=u'A',
+        title=u'A',
+        publish_date=date.today(),
+        attributes={
+            'a': models.Attribute(
+                name=u'a',
+                title=u'',
+                type='choice',
+                is_collection=True,
+                order=0,
+                choices={
+                    '001': models.Choice(
+                        name=u'001',
+                        title=u'Green',
+                        order=0)})})
+    dbsession.add(schema1)
+    dbsession.flush()
+
+    # Cleared fields are saved as JSON nulls
+    entity1 = models.Entity(schema=schema1, data={'a': None})
+    dbsession.add(entity1)
+    dbsession.flush()
+
+    report = reporting.build_report(dbsession, u'A')
+    result = dbsession.query(report).one()
+    assert result.a is None
+
+    report = reporting.build_report(dbsession, u'A', expand_collections=True)
+    result = dbsession.query(report).one()
+    assert result.a_001 is None
+
+
+def test_build_long_report(dbsession):
+    """
+    It should generate one row per value, skipping blank values
+    """
+    from datetime import date
+    from occams import models, reporting
+
+    schema1 = models.Schema(
+        name=u'A',
+        title=u'A',
+        publish_date=date.today(),
+        attributes={
+            'a': models.Attribute(
+                name=u'a',
+                title=u'',
+                type='number',
+                decimal_places=0,
+                order=0),
+            'b': models.Attribute(
+                name=u'b',
+                title=u'',
+                type='choice',
+                is_collection=True,
+                order=1,
+                choices={
+                    '001': models.Choice(
+                        name=u'001', title=u'Green', order=0),
+                    '002': models.Choice(
+                        name=u'002', title=u'Red', order=1)}),
+            'c': models.Attribute(
+                name=u'c',
+                title=u'',
+                type='string',
+                order=2)})
+    dbsession.add(schema1)
+    dbsession.flush()
+
+    entity1 = models.Entity(
+        schema=schema1, data={'a': 5, 'b': [u'001', u'002'], 'c': None})
+    entity2 = models.Entity(schema=schema1, data={'b': [], 'c': u'foo'})
+    dbsession.add_all([entity1, entity2])
+    dbsession.flush()
+
+    report = reporting.build_long_report(dbsession, u'A')
+    rows = sorted(
+        (r.id, r.attribute, r.value) for r in dbsession.query(report))
+
+    assert [
+        (entity1.id, u'a', u'5'),
+        (entity1.id, u'b', u'001'),
+        (entity1.id, u'b', u'002'),
+        (entity2.id, u'c', u'foo'),
+    ] == rows
+
+    report = reporting.build_long_report(
+        dbsession, u'A', use_choice_labels=True)
+    values = sorted(
+        r.value for r in dbsession.query(report).filter_by(attribute=u'b'))
+
+    assert [u'Green', u'Red'] == values
+
+
+def test_build_long_report_ignore_private(dbsession):
+    """
+    It should de-identify private values without expanding them
+    """
+    from datetime import date
+    from occams import models, reporting
+
+    schema1 = models.Schema(
+        name=u'A',
+        title=u'A',
+        publish_date=date.today(),
+        attributes={
+            'names': models.Attribute(
+                name=u'names',
+                title=u'',
+                type='string',
+                is_collection=True,
+                is_private=True,
+                order=0)})
+    dbsession.add(schema1)
+    dbsession.flush()
+
+    entity1 = models.Entity(
+        schema=schema1, data={'names': [u'Jane Doe', u'John Doe']})
+    dbsession.add(entity1)
+    dbsession.flush()
+
+    report = reporting.build_long_report(dbsession, u'A', ignore_private=False)
+    values = sorted(r.value for r in dbsession.query(report))
+    assert [u'Jane Doe', u'John Doe'] == values
+
+    report = reporting.build_long_report(dbsession, u'A', ignore_private=True)
+    values = [r.value for r in dbsession.query(report)]
+    assert [u'[PRIVATE]'] == values
@@ -1,6 +1,54 @@
+import os
+
 import pytest
 
 
+@pytest.fixture
+def committed_export(request, celery):
+    """
+    Commits a pending export so that other connections can update it
+
+    Returns the engine it was committed with, whose statements fail
+    instead of hanging if its row is already locked, and the export's
+    name. The export and its owner are deleted afterwards.
+    """
+    import sqlalchemy as sa
+    from sqlalchemy import orm
+    from occams.celery import Session
+    from occams import models
+
+    engine = sa.create_engine(
+        Session.get_bind().url,
+        connect_args={'options': '-c lock_timeout=5000'})
+
+    setup = orm.Session(bind=engine)
+    models.set_pg_locals(setup, 'test', u'joe')
+    owner = models.User(key=u'joe')
+    export = models.Export(
+        owner_user=owner,
+        contents=[
+            {'name': 'pid', 'title': 'PID', 'versions': []},
+            {'name': 'visit', 'title': 'Visits', 'versions': []},
+        ],
+        status='pending')
+    setup.add_all([owner, export])
+    setup.commit()
+
+    def cleanup():
+        Session.remove()
+        setup.rollback()
+        models.set_pg_locals(setup, 'test', u'joe')
+        setup.delete(setup.merge(export))
+        setup.delete(setup.merge(owner))
+        setup.commit()
+        setup.close()
+        engine.dispose()
+
+    request.addfinalizer(cleanup)
+
+    return engine, export.name
+
+
 class TestIncludeme:
 
     def test_settings(self, config):
@@ -14,7 +62,17 @@ class TestIncludeme:
             'studies.export.user': 'dummy',
             'studies.export.dir': '/tmp',
             'studies.export.limit': '1234',
-            'studies.export.expire': '123'
+            'studies.export.expire': '123',
+            'studies.export.fetch_size': '500',
+            'studies.export.use_copy': 'true',
+            'studies.export.parallelism': '4',
+            'studies.export.cache_size': '1048576',
+            'studies.export.compression': 'stored',
+            'studies.export.compression_level': '1',
+            'studies.export.fast_lane_cost': '5000',
+            'studies.export.user_concurrency': '3',
+            'studies.export.heavy_concurrency': '1',
+            'studies.export.progress_interval': '0.5'
         }
 
         expected = input.copy()
@@ -22,6 +80,23 @@ class TestIncludeme:
             int(expected['studies.export.limit'])
         expected['studies.export.expire'] = \
             int(expected['studies.export.expire'])
+        expected['studies.export.fetch_size'] = \
+            int(expected['studies.export.fetch_size'])
+        expected['studies.export.use_copy'] = True
+        expected['studies.export.parallelism'] = \
+            int(expected['studies.export.parallelism'])
+        expected['studies.export.cache_size'] = \
+            int(expected['studies.export.cache_size'])
+        expected['studies.export.compression_level'] = \
+            int(expected['studies.export.compression_level'])
+        expected['studies.export.fast_lane_cost'] = \
+            int(expected['studies.export.fast_lane_cost'])
+        expected['studies.export.user_concurrency'] = \
+            int(expected['studies.export.user_concurrency'])
+        expected['studies.export.heavy_concurrency'] = \
+            int(expected['studies.export.heavy_concurrency'])
+        expected['studies.export.progress_interval'] = \
+            float(expected['studies.export.progress_interval'])
 
         config.registry.settings.update(input)
         config.include('occams.tasks')
@@ -40,6 +115,7 @@ class TestMakeExport:
         from occams.celery import Session
         from occams import models as datastore
         from occams import models, tasks
+        from occams.exports import csv
         from occams.exports.pid import PidPlan
 
         owner = datastore.User(key=u'joe')
@@ -63,3 +139,856 @@ class TestMakeExport:
             file_names = zfp.namelist()
 
         assert sorted(['pid.csv', 'codebook.csv']) == sorted(file_names)
+
+        # Only the selected plans should be described by the codebook
+        with ZipFile(export.path, 'r') as zfp:
+            rows = csv.DictReader(zfp.open('codebook.csv'))
+            assert set(['pid']) == set(r['table'] for r in rows)
+
+    def test_stored(self):
+        """
+        It should skip compression if configured to store files as-is
+        """
+        from zipfile import ZipFile, ZIP_STORED
+        from occams.celery import Session
+        from occams import models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner,
+            contents=[{'name': 'pid', 'title': 'PID', 'versions': []}],
+            status='pending')
+        Session.add(export)
+        Session.flush()
+
+        tasks.app.settings['studies.export.compression'] = 'stored'
+        tasks.make_export(export.name)
+
+        export = Session.merge(export)
+        with ZipFile(export.path, 'r') as zfp:
+            assert zfp.testzip() is None
+            assert set([ZIP_STORED]) == \
+                set(i.compress_type for i in zfp.infolist())
+
+    def test_compression_level_py2(self, tmpdir):
+        """
+        It should not pass compression levels to zipfile before Python 3.7
+        """
+        import mock
+        from zipfile import ZipFile
+        from occams import tasks
+
+        def py2_zipfile(file, mode='r', compression=0, allowZip64=False):
+            return ZipFile(file, mode, compression, allowZip64)
+
+        tasks.app.settings['studies.export.compression_level'] = 1
+
+        with mock.patch('occams.tasks.sys') as sys, \
+                mock.patch('occams.tasks.ZipFile', py2_zipfile):
+            sys.version_info = (2, 7, 17)
+            zfp = tasks._open_archive(str(tmpdir.join('export.zip')))
+
+        with zfp:
+            assert 1 == zfp.compresslevel
+
+    def test_parquet(self):
+        """
+        It should write data files as Parquet if requested
+        """
+        import pytest
+        pq = pytest.importorskip('pyarrow.parquet')
+        import six
+        from zipfile import ZipFile
+        from occams.celery import Session
+        from occams import models, tasks
+        from occams.exports.pid import PidPlan
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner,
+            contents=[{'name': 'pid', 'title': 'PID', 'versions': []}],
+            format='parquet',
+            status='pending')
+        Session.add(export)
+        Session.flush()
+        path = export.path
+        columns = [
+            d['name'] for d in PidPlan(Session).data().column_descriptions]
+
+        tasks.app.settings['studies.export.plans'] = [PidPlan]
+        tasks.make_export(export.name)
+
+        with ZipFile(path, 'r') as zfp:
+            assert set(['pid.parquet', 'codebook.csv']) == \
+                set(zfp.namelist())
+            table = pq.read_table(six.BytesIO(zfp.read('pid.parquet')))
+
+        assert columns == table.column_names
+
+    def test_sqlite(self, tmpdir):
+        """
+        It should load all data files into a single database if requested
+        """
+        import os
+        import sqlite3
+        from zipfile import ZipFile
+        from occams.celery import Session
+        from occams import models, tasks
+        from occams.exports.pid import PidPlan
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner,
+            contents=[{'name': 'pid', 'title': 'PID', 'versions': []}],
+            format='sqlite',
+            status='pending')
+        Session.add(export)
+        Session.flush()
+        path = export.path
+
+        tasks.app.settings['studies.export.plans'] = [PidPlan]
+        tasks.make_export(export.name)
+
+        assert not os.path.exists(path + '.sqlite')
+
+        with ZipFile(path, 'r') as zfp:
+            assert ['export.sqlite'] == zfp.namelist()
+            database_path = zfp.extract('export.sqlite', str(tmpdir))
+
+        connection = sqlite3.connect(database_path)
+        tables = set(r[0] for r in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"))
+        assert set(['pid', 'codebook']) == tables
+        assert set([u'pid']) == set(r[0] for r in connection.execute(
+            'SELECT "table" FROM codebook'))
+        connection.close()
+
+    def test_parallel(self, monkeypatch):
+        """
+        It should generate plans concurrently in the requested order
+        """
+        from zipfile import ZipFile
+        from occams.celery import Session
+        from occams import models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner,
+            contents=[
+                {'name': 'visit', 'title': 'Visits', 'versions': []},
+                {'name': 'pid', 'title': 'PID', 'versions': []},
+                {'name': 'enrollment', 'title': 'Enrollments',
+                 'versions': []},
+            ],
+            status='pending')
+        Session.add(export)
+        Session.flush()
+
+        monkeypatch.setitem(
+            tasks.app.settings, 'studies.export.parallelism', 2)
+        tasks.make_export(export.name)
+
+        export = Session.merge(export)
+        with ZipFile(export.path, 'r') as zfp:
+            file_names = zfp.namelist()
+
+        assert file_names == [
+            'visit.csv', 'pid.csv', 'enrollment.csv', 'codebook.csv']
+        assert tasks.app.redis.hget(export.redis_key, 'count') == '3'
+
+    def test_partitions(self):
+        """
+        It should split data files by site and list them in a manifest
+        """
+        from zipfile import ZipFile
+        from occams.celery import Session
+        from occams import models, tasks
+        from occams.exports import csv
+        from occams.exports.pid import PidPlan
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.add(models.Patient(
+            pid=u'xxx-xxx',
+            site=models.Site(name=u'ucsd', title=u'UCSD')))
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner,
+            contents=[{'name': 'pid', 'title': 'PID', 'versions': []}],
+            partition_by='site',
+            status='pending')
+        Session.add(export)
+        Session.flush()
+        path = export.path
+        redis_key = export.redis_key
+
+        tasks.app.settings['studies.export.plans'] = [PidPlan]
+        tasks.make_export(export.name)
+
+        with ZipFile(path, 'r') as zfp:
+            assert zfp.namelist() == [
+                'pid/ucsd.csv', 'codebook.csv', 'manifest.csv']
+            rows = list(csv.DictReader(zfp.open('pid/ucsd.csv')))
+            assert [u'xxx-xxx'] == [r['pid'] for r in rows]
+            manifest = list(csv.DictReader(zfp.open('manifest.csv')))
+            assert [
+                {'table': 'pid', 'partition_by': 'site',
+                 'partition': 'ucsd', 'file': 'pid/ucsd.csv'},
+            ] == manifest
+
+        assert tasks.app.redis.hget(redis_key, 'total') == '1'
+
+    def test_incremental(self):
+        """
+        It should only include changes since the last export of the contents
+        """
+        from zipfile import ZipFile
+        from occams.celery import Session
+        from occams import models, tasks
+        from occams.exports import csv
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        site = models.Site(name=u'someplace', title=u'Some Place')
+        old = models.Patient(pid=u'xxx-xxx', site=site)
+        deleted = models.Patient(pid=u'yyy-yyy', site=site)
+        Session.add_all([old, deleted])
+        Session.flush()
+        deleted_id = deleted.id
+
+        contents = [{'name': 'pid', 'title': 'PID', 'versions': []}]
+        previous = models.Export(
+            owner_user=owner,
+            contents=contents,
+            status='complete',
+            watermark=Session.execute(
+                'SELECT timeofday()::timestamptz').scalar())
+        Session.add(previous)
+        Session.flush()
+
+        Session.add(models.Patient(pid=u'zzz-zzz', site=site))
+        Session.delete(deleted)
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner,
+            contents=contents,
+            is_incremental=True,
+            status='pending')
+        Session.add(export)
+        Session.flush()
+
+        tasks.make_export(export.name)
+
+        export = Session.merge(export)
+        assert export.watermark is not None
+
+        with ZipFile(export.path, 'r') as zfp:
+            file_names = zfp.namelist()
+            pids = [r['pid'] for r in csv.DictReader(zfp.open('pid.csv'))]
+            tombstones = list(csv.DictReader(zfp.open('tombstones.csv')))
+
+        assert ['pid.csv', 'tombstones.csv', 'codebook.csv'] == file_names
+        assert [u'zzz-zzz'] == pids
+        assert [(u'pid', str(deleted_id))] == \
+            [(r['table'], r['id']) for r in tombstones]
+
+    def test_cache(self):
+        """
+        It should reuse data files that have not changed since last generated
+        """
+        from zipfile import ZipFile
+        from occams.celery import Session
+        from occams import models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+        owner_id = owner.id
+
+        tasks.app.settings['studies.export.cache_size'] = 1024 * 1024
+
+        def make_export():
+            export = models.Export(
+                owner_user_id=owner_id,
+                contents=[{'name': 'pid', 'title': 'PID', 'versions': []}],
+                status='pending')
+            Session.add(export)
+            Session.flush()
+            tasks.make_export(export.name)
+            export = Session.merge(export)
+            with ZipFile(export.path, 'r') as zfp:
+                return zfp.read('pid.csv')
+
+        first = make_export()
+        assert tasks._get_cache().stats() == {'misses': 1}
+
+        second = make_export()
+        assert tasks._get_cache().stats() == {'misses': 1, 'hits': 1}
+        assert first == second
+
+    def test_checkpoints(self):
+        """
+        It should record a checkpoint every time a data file is archived
+        """
+        import mock
+        from occams.celery import Session
+        from occams import models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner,
+            contents=[
+                {'name': 'pid', 'title': 'PID', 'versions': []},
+                {'name': 'visit', 'title': 'Visits', 'versions': []},
+            ],
+            status='pending')
+        Session.add(export)
+        Session.flush()
+
+        saved = []
+
+        def save(export, checkpoints, watermark):
+            saved.append([dict(c) for c in checkpoints])
+
+        with mock.patch('occams.tasks._save_checkpoints', save):
+            tasks.make_export(export.name)
+
+        assert [['pid'], ['pid', 'visit']] == \
+            [[c['name'] for c in checkpoints] for checkpoints in saved]
+        assert saved[-1][0]['size'] < saved[-1][1]['size']
+
+        export = Session.merge(export)
+        assert export.checkpoints is None
+
+    def test_checkpoints_committed(self, committed_export):
+        """
+        It should commit checkpoints without waiting on the task's own locks
+
+        The export is committed beforehand so that the checkpoints, which
+        are saved on connections of their own, actually update its row.
+        """
+        import sqlalchemy as sa
+        from occams.celery import Session
+        from occams import models, tasks
+
+        engine, name = committed_export
+
+        Session.remove()
+        Session.configure(bind=engine)
+        Session.info['blame'] = (
+            Session.query(models.User).filter_by(key=u'joe').one())
+
+        tasks.make_export(name)
+        Session.flush()
+
+        with engine.connect() as connection:
+            started_at, checkpoints = connection.execute(
+                sa.select([models.Export.started_at,
+                           models.Export.checkpoints])
+                .where(models.Export.name == name)).first()
+
+        assert started_at is not None
+        assert ['pid', 'visit'] == [c['name'] for c in checkpoints]
+
+    def test_resume(self):
+        """
+        It should resume an interrupted export from its last checkpoint
+        """
+        from datetime import datetime
+        from zipfile import ZipFile
+        import mock
+        from occams.celery import Session
+        from occams import models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner,
+            contents=[
+                {'name': 'pid', 'title': 'PID', 'versions': []},
+                {'name': 'visit', 'title': 'Visits', 'versions': []},
+            ],
+            watermark=datetime(2017, 1, 1),
+            status='failed')
+        Session.add(export)
+        Session.flush()
+
+        # Simulate an export that died while archiving its second file
+        with ZipFile(export.path, 'w') as zfp:
+            zfp.writestr('pid.csv', b'already archived')
+        size = os.path.getsize(export.path)
+        with open(export.path, 'ab') as fp:
+            fp.write(b'partially archived')
+
+        export.checkpoints = [{'name': 'pid', 'size': size}]
+        Session.flush()
+
+        with mock.patch('occams.tasks._save_checkpoints'):
+            tasks.make_export(export.name)
+
+        export = Session.merge(export)
+        assert export.watermark.year == 2017
+
+        with ZipFile(export.path, 'r') as zfp:
+            assert zfp.testzip() is None
+            assert ['pid.csv', 'visit.csv', 'codebook.csv'] == zfp.namelist()
+            assert b'already archived' == zfp.read('pid.csv')
+
+    def test_resume_sqlite(self, tmpdir):
+        """
+        It should keep the tables loaded before an export was interrupted
+        """
+        import sqlite3
+        from zipfile import ZipFile
+        import mock
+        from occams.celery import Session
+        from occams import models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner,
+            contents=[
+                {'name': 'pid', 'title': 'PID', 'versions': []},
+                {'name': 'visit', 'title': 'Visits', 'versions': []},
+            ],
+            format='sqlite',
+            status='failed')
+        Session.add(export)
+        Session.flush()
+
+        # Simulate an export that died while loading its second table
+        with ZipFile(export.path, 'w'):
+            pass
+        size = os.path.getsize(export.path)
+        connection = sqlite3.connect(export.path + '.sqlite')
+        with connection:
+            connection.execute('CREATE TABLE pid (loaded TEXT)')
+        connection.close()
+
+        export.checkpoints = [{'name': 'pid', 'size': size}]
+        Session.flush()
+        path = export.path
+
+        with mock.patch('occams.tasks._save_checkpoints'):
+            tasks.make_export(export.name)
+
+        with ZipFile(path, 'r') as zfp:
+            database_path = zfp.extract('export.sqlite', str(tmpdir))
+
+        connection = sqlite3.connect(database_path)
+        tables = set(r[0] for r in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"))
+        columns = [r[1] for r in connection.execute('PRAGMA table_info(pid)')]
+        connection.close()
+
+        assert set(['pid', 'visit', 'codebook']) == tables
+        assert ['loaded'] == columns
+
+
+@pytest.mark.usefixtures('celery')
+class TestSingleFlight:
+
+    def _make_exports(self, count):
+        from occams.celery import Session
+        from occams import models
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        exports = [
+            models.Export(
+                owner_user=owner,
+                contents=[{'name': 'pid', 'title': 'PID', 'versions': []}],
+                status='pending')
+            for i in range(count)]
+        Session.add_all(exports)
+        Session.flush()
+        return exports
+
+    def _flight(self):
+        import uuid
+        return 'export:flight:' + str(uuid.uuid4())
+
+    def test_flight_key(self):
+        """
+        It should identify exports of the same plans with the same options
+        """
+        from occams.celery import Session
+        from occams import tasks
+        from occams.exports.pid import PidPlan
+
+        options = {'use_choice_labels': False, 'expand_collections': False}
+        key = tasks.flight_key([PidPlan(Session)], options)
+
+        assert key == tasks.flight_key([PidPlan(Session)], options)
+        assert key != tasks.flight_key(
+            [PidPlan(Session)], dict(options, use_choice_labels=True))
+        assert key != tasks.flight_key(
+            [PidPlan(Session)], options, 'parquet')
+        assert key != tasks.flight_key(
+            [PidPlan(Session)], options, partition_by='site')
+
+    def test_flight_key_no_queries(self):
+        """
+        It should not query the data of the plans
+        """
+        import mock
+        from occams.celery import Session
+        from occams import tasks
+        from occams.exports.pid import PidPlan
+
+        options = {'use_choice_labels': False, 'expand_collections': False}
+
+        with mock.patch.object(PidPlan, 'data') as data:
+            tasks.flight_key([PidPlan(Session)], options)
+
+        assert not data.called
+
+    def test_queue_attaches(self):
+        """
+        It should attach identical exports to the one in flight
+        """
+        import mock
+        from occams import tasks
+
+        redis = tasks.app.redis
+
+        flight = self._flight()
+
+        with mock.patch('occams.tasks.make_export.apply_async') as apply:
+            assert tasks.queue_export(redis, 'first', flight) is None
+            assert tasks.queue_export(redis, 'second', flight) == 'first'
+            assert tasks.queue_export(redis, 'third', None) is None
+
+        assert 2 == apply.call_count
+        assert set(['second']) == \
+            set(tasks._text(n) for n in redis.smembers(flight + ':followers'))
+
+    def test_link_followers(self):
+        """
+        It should link the archive to the exports attached to it
+        """
+        import os
+        from occams import tasks
+
+        leader, follower = self._make_exports(2)
+        leader_path, follower_path = leader.path, follower.path
+        redis = tasks.app.redis
+        flight = self._flight()
+
+        assert tasks._join_flight(redis, flight, leader.name) is None
+        assert tasks._join_flight(redis, flight, follower.name) == \
+            leader.name
+
+        tasks.make_export(leader.name, flight=flight)
+
+        assert follower.status == 'complete'
+        assert os.path.samefile(leader_path, follower_path)
+        assert redis.get(flight) is None
+        assert tasks._text(redis.hget(follower.redis_key, 'status')) == \
+            'complete'
+
+        # Later exports are no longer attached
+        assert tasks._join_flight(redis, flight, 'later') is None
+
+    def test_fail_followers(self):
+        """
+        It should fail the exports attached to a failed export
+        """
+        from occams import tasks
+
+        leader, follower = self._make_exports(2)
+        redis = tasks.app.redis
+        flight = self._flight()
+
+        tasks._join_flight(redis, flight, leader.name)
+        tasks._join_flight(redis, flight, follower.name)
+
+        tasks.ExportTask().on_failure(
+            Exception(), leader.name, [leader.name], {'flight': flight},
+            None)
+
+        assert leader.status == 'failed'
+        assert follower.status == 'failed'
+        assert redis.get(flight) is None
+
+
+@pytest.mark.usefixtures('celery')
+class TestScheduler:
+
+    def _make_export(self, user_key, **kw):
+        from occams.celery import Session
+        from occams import models
+
+        owner = models.User(key=user_key)
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner,
+            contents=[{'name': 'pid', 'title': 'PID', 'versions': []}],
+            status='pending',
+            **kw)
+        Session.add(export)
+        Session.flush()
+        return export
+
+    def _user_key(self):
+        import uuid
+        return u'user-' + str(uuid.uuid4())
+
+    def test_estimate_cost(self):
+        """
+        It should estimate the number of values of the data files
+        """
+        from occams.celery import Session
+        from occams import tasks
+        from occams.exports.pid import PidPlan
+        from occams.exports.visit import VisitPlan
+
+        options = {'use_choice_labels': False, 'expand_collections': False}
+        pid, visit = PidPlan(Session), VisitPlan(Session)
+        pid_columns = len(pid.data(**options).column_descriptions)
+
+        assert 0 == pid.estimate(**options) % pid_columns
+        assert tasks.estimate_cost([pid, visit], options) == \
+            pid.estimate(**options) + visit.estimate(**options)
+
+    def test_lanes(self):
+        """
+        It should only put exports estimated to be cheap in the fast lane
+        """
+        from occams import tasks
+
+        tasks.app.settings['studies.export.fast_lane_cost'] = 100
+
+        assert 'fast' == tasks.export_lane(0)
+        assert 'fast' == tasks.export_lane(100)
+        assert 'heavy' == tasks.export_lane(101)
+        assert 'heavy' == tasks.export_lane(None)
+
+    def test_queue_lane(self):
+        """
+        It should queue exports in the queue of their lane
+        """
+        import mock
+        from occams import tasks
+
+        tasks.app.settings.update({
+            'studies.export.fast_lane_cost': 100,
+            'studies.export.fast_queue': 'export.fast',
+            'studies.export.heavy_queue': 'export.heavy',
+        })
+
+        with mock.patch('occams.tasks.make_export.apply_async') as apply:
+            tasks.queue_export(tasks.app.redis, 'small', cost=10)
+            assert 'export.fast' == apply.call_args[1]['queue']
+            tasks.queue_export(tasks.app.redis, 'large', cost=1000)
+            assert 'export.heavy' == apply.call_args[1]['queue']
+
+    def test_user_concurrency(self):
+        """
+        It should defer exports of users who are at their limit
+        """
+        import mock
+        from occams import tasks
+
+        user_key = self._user_key()
+        export = self._make_export(user_key, estimated_cost=0)
+        path = export.path
+        redis = tasks.app.redis
+        slot = 'export:running:user:' + user_key
+
+        tasks.app.settings['studies.export.user_concurrency'] = 1
+        assert tasks._acquire_slots(redis, [(slot, 1)], 'other')
+
+        with mock.patch('occams.tasks.make_export.apply_async') as apply:
+            tasks.make_export(export.name)
+
+        assert not os.path.exists(path)
+        assert tasks.DEFER_COUNTDOWN == apply.call_args[1]['countdown']
+
+        tasks._release_slots(redis, [(slot, 1)], 'other')
+
+    def test_expired_slots(self):
+        """
+        It should reclaim the slots of exports whose worker died
+        """
+        import mock
+        from occams import tasks
+
+        redis = tasks.app.redis
+        slot = 'export:running:user:' + self._user_key()
+
+        assert tasks._acquire_slots(redis, [(slot, 1)], 'dead')
+        assert not tasks._acquire_slots(redis, [(slot, 1)], 'alive')
+        # The same export can always get its own slot back
+        assert tasks._acquire_slots(redis, [(slot, 1)], 'dead')
+
+        later = tasks.time.time() + tasks.SLOT_TTL + 1
+        with mock.patch('occams.tasks.time.time', return_value=later):
+            assert tasks._acquire_slots(redis, [(slot, 1)], 'alive')
+
+        assert ['alive'] == [tasks._text(k) for k in redis.hkeys(slot)]
+        redis.delete(slot)
+
+    def test_costs(self):
+        """
+        It should record when the export started and what it actually cost
+        """
+        from occams.celery import Session
+        from occams import models, tasks
+        from occams.exports.pid import PidPlan
+
+        user_key = self._user_key()
+        export = self._make_export(user_key)
+        Session.add(models.Patient(
+            pid=u'xxx-xxx',
+            site=models.Site(name=u'someplace', title=u'Some Place')))
+        Session.flush()
+        columns = len(PidPlan(Session).data().column_descriptions)
+
+        tasks.make_export(export.name)
+
+        assert export.started_at is not None
+        assert export.actual_cost == columns
+        # Slots are released once done
+        assert not tasks.app.redis.hgetall(
+            'export:running:user:' + user_key)
+
+
+@pytest.mark.usefixtures('celery')
+class TestProgress:
+
+    def _make_export(self):
+        from occams.celery import Session
+        from occams import models
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner,
+            contents=[
+                {'name': 'pid', 'title': 'PID', 'versions': []},
+                {'name': 'visit', 'title': 'Visits', 'versions': []},
+            ],
+            status='pending')
+        Session.add(export)
+        Session.flush()
+        return export
+
+    def _progress(self, export, estimates, interval):
+        from occams import tasks
+        return tasks._Progress(tasks.app.redis, export, estimates, interval)
+
+    def _published(self, export):
+        from occams import tasks
+        data = tasks.app.redis.hgetall(export.redis_key)
+        return dict((tasks._text(k), tasks._text(v)) for k, v in data.items())
+
+    def test_throttle(self):
+        """
+        It should publish rows no more often than the interval
+        """
+        export = self._make_export()
+        progress = self._progress(export, {'pid': 100, 'visit': 100}, 3600)
+
+        progress.publish()
+        report = progress.reporter('pid')
+        report(10)
+        report(10)
+        assert '0' == self._published(export)['rows']
+
+        progress.interval = 0
+        report(10)
+        assert '30' == self._published(export)['rows']
+        assert '200' == self._published(export)['estimated_rows']
+
+    def test_eta(self):
+        """
+        It should estimate the time left from the rows written per second
+        """
+        import mock
+
+        export = self._make_export()
+
+        with mock.patch('occams.tasks.time.time', return_value=1000):
+            progress = self._progress(export, {'pid': 100, 'visit': 300}, 0)
+            progress.publish()
+        assert 'eta' not in self._published(export)
+
+        with mock.patch('occams.tasks.time.time', return_value=1010):
+            progress.add('pid', 50)
+        # 50 rows in 10 seconds, 350 to go
+        assert '70' == self._published(export)['eta']
+
+        with mock.patch('occams.tasks.time.time', return_value=1020):
+            progress.add('pid', 10)
+            progress.finish('pid')
+        # The finished plan turned out to be smaller than estimated
+        assert '360' == self._published(export)['estimated_rows']
+        assert '1' == self._published(export)['count']
+        assert '100' == self._published(export)['eta']
+
+    def test_make_export(self):
+        """
+        It should publish the rows of the export as it is generated
+        """
+        from occams.celery import Session
+        from occams import models, tasks
+
+        export = self._make_export()
+        Session.add(models.Patient(
+            pid=u'xxx-xxx',
+            site=models.Site(name=u'someplace', title=u'Some Place')))
+        Session.flush()
+        key = export.redis_key
+
+        tasks.make_export(export.name)
+
+        data = tasks.app.redis.hgetall(key)
+        data = dict((tasks._text(k), tasks._text(v)) for k, v in data.items())
+        assert 'complete' == data['status']
+        assert '2' == data['count']
+        assert '1' == data['rows']
+        assert '1' == data['estimated_rows']
@@ -117,6 +117,98 @@ class Test_markup_ajax:
             'Found entity metada when it should not have'
 
 
+class Test_attachment_download:
+
+    def _call_fut(self, *args, **kw):
+        from occams.views.entry import attachment_download as view
+        return view(*args, **kw)
+
+    def _attachment(self, dbsession, factories, blob, file_name=u'scan.pdf'):
+        from occams import models
+
+        entity = factories.EntityFactory()
+        attachment = models.EntityAttachment(
+            entity=entity,
+            file_name=file_name,
+            mime_type='application/pdf',
+            blob=blob)
+        dbsession.add(attachment)
+        dbsession.flush()
+        # Attachments are keyed by id, which is only known after the flush
+        dbsession.expire(entity, ['attachments'])
+        return entity, attachment
+
+    def test_blob_store(self, req, dbsession, factories, tmpdir):
+        """
+        It should serve files in the blob store from the file system
+        """
+        from six import BytesIO
+        from webob.multidict import MultiDict
+        from occams import models
+        from occams.blobs import BlobStore
+
+        req.registry.settings['studies.blob.dir'] = str(tmpdir)
+        blob = models.EntityAttachmentBlob()
+        BlobStore(str(tmpdir)).save(blob, BytesIO(b'%PDF'))
+        entity, attachment = self._attachment(dbsession, factories, blob)
+
+        req.GET = MultiDict([('attachment', str(attachment.id))])
+        res = self._call_fut(entity, req)
+
+        assert 'application/pdf' == res.content_type
+        assert 'attachment; filename="scan.pdf"; filename*=UTF-8\'\'scan.pdf' \
+            == res.content_disposition
+        assert b'%PDF' == b''.join(res.app_iter)
+
+    def test_database(self, req, dbsession, factories):
+        """
+        It should serve files that are still stored in the database
+        """
+        from webob.multidict import MultiDict
+        from occams import models
+
+        blob = models.EntityAttachmentBlob(content=b'%PDF')
+        entity, attachment = self._attachment(dbsession, factories, blob)
+
+        req.GET = MultiDict([('attachment', str(attachment.id))])
+        res = self._call_fut(entity, req)
+
+        assert b'%PDF' == res.body
+
+    def test_file_name(self, req, dbsession, factories):
+        """
+        It should quote file names and encode them for non-ASCII clients
+        """
+        from webob.multidict import MultiDict
+        from occams import models
+
+        blob = models.EntityAttachmentBlob(content=b'%PDF')
+        entity, attachment = self._attachment(
+            dbsession, factories, blob, file_name=u'résumé "final";.pdf')
+
+        req.GET = MultiDict([('attachment', str(attachment.id))])
+        res = self._call_fut(entity, req)
+
+        assert (
+            'attachment; filename="r?sum? _final_;.pdf"; '
+            'filename*=UTF-8\'\'r%C3%A9sum%C3%A9%20%22final%22%3B.pdf'
+        ) == res.content_disposition
+
+    def test_not_found(self, req, dbsession, factories):
+        """
+        It should not serve attachments of other entities
+        """
+        from pyramid.httpexceptions import HTTPNotFound
+        from webob.multidict import MultiDict
+
+        entity = factories.EntityFactory()
+        dbsession.flush()
+
+        req.GET = MultiDict([('attachment', '12345')])
+        with pytest.raises(HTTPNotFound):
+            self._call_fut(entity, req)
+
+
 class Test_add_json:
 
     def _call_fut(self, *args, **kw):
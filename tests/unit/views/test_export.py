@@ -103,6 +103,10 @@ class TestAdd:
         assert res.location == req.route_path('studies.exports_status')
         export = dbsession.query(models.Export).one()
         assert export.owner_user.key == 'joe'
+        assert export.estimated_cost is not None
+        assert export.format == 'csv'
+        assert export.layout == 'wide'
+        assert export.partition_by is None
 
     def test_exceed_limit(self, req, dbsession, config):
         """
@@ -320,6 +324,68 @@ class TestNotifications:
         assert '"export_id": 123' in notifications[0]
 
 
+class TestStream:
+
+    def _call_fut(self, *args, **kw):
+        from occams.views.export import stream as view
+        return view(*args, **kw)
+
+    def test_non_existent_file(self, req, dbsession):
+        """
+        It should not stream data files that cannot be checked out
+        """
+        from pyramid.httpexceptions import HTTPBadRequest
+        from webob.multidict import MultiDict
+        from occams import models
+
+        req.GET = MultiDict([('contents', 'does_not_exist')])
+
+        with pytest.raises(HTTPBadRequest):
+            self._call_fut(models.ExportFactory(req), req)
+
+    def test_exceed_limit(self, req, dbsession):
+        """
+        It should not stream more files than the limit at once
+        """
+        from pyramid.httpexceptions import HTTPBadRequest
+        from webob.multidict import MultiDict
+        from occams import models
+
+        req.registry.settings['studies.export.stream_limit'] = 1
+        req.GET = MultiDict([('contents', 'pid'), ('contents', 'visit')])
+
+        with pytest.raises(HTTPBadRequest):
+            self._call_fut(models.ExportFactory(req), req)
+
+    def test_csv(self, req, dbsession):
+        """
+        It should stream a single data file as a CSV file
+        """
+        from webob.multidict import MultiDict
+        from occams import models
+
+        req.GET = MultiDict([('contents', 'pid')])
+        res = self._call_fut(models.ExportFactory(req), req)
+
+        assert res.content_type == 'text/csv'
+        assert res.content_disposition == 'attachment;filename=pid.csv'
+        assert next(res.app_iter).startswith(b'id,site,pid')
+        res.app_iter.close()
+
+    def test_zip(self, req, dbsession):
+        """
+        It should stream several data files as a zip file
+        """
+        from webob.multidict import MultiDict
+        from occams import models
+
+        req.GET = MultiDict([('contents', 'pid'), ('contents', 'visit')])
+        res = self._call_fut(models.ExportFactory(req), req)
+
+        assert res.content_type == 'application/zip'
+        assert res.content_disposition == 'attachment;filename=export.zip'
+
+
 class TestCodebookJSON:
 
     def _call_fut(self, *args, **kw):
@@ -358,7 +424,7 @@ class TestCodebookJSON:
         with pytest.raises(HTTPBadRequest):
             self._call_fut(models.ExportFactory(req), req)
 
-    def test_file(self, req, dbsession):
+    def test_file(self, req, dbsession, tmpdir):
         """
         It should return the json rows for the codebook fragment
         """
@@ -384,8 +450,11 @@ class TestCodebookJSON:
 
         req.GET = MultiDict([('file', 'aform')])
         req.registry.settings['studies.export.plans'] = [SchemaPlan.list_all]
+        req.registry.settings['studies.export.dir'] = str(tmpdir)
         res = self._call_fut(models.ExportFactory(req), req)
         assert res is not None
+        row = next(row for row in res if row['field'] == 'myfield')
+        assert date.today().isoformat() == row['publish_date']
 
 
 class TestCodebookDownload:
@@ -452,6 +521,62 @@ class TestDelete:
         revoke.assert_called_with(export_name)
 
 
+class TestResume:
+
+    def _call_fut(self, *args, **kw):
+        from occams.views.export import resume_json as view
+        return view(*args, **kw)
+
+    def _make_export(self, dbsession, status):
+        from occams import models
+
+        blame = models.User(key=u'joe')
+        dbsession.add(blame)
+        dbsession.flush()
+        dbsession.info['blame'] = blame
+
+        export = models.Export(owner_user=blame, contents=[], status=status)
+        dbsession.add(export)
+        dbsession.flush()
+        return export
+
+    def test_resume(self, req, dbsession, config, check_csrf_token):
+        """
+        It should queue failed exports again
+        """
+        import mock
+        from pyramid.httpexceptions import HTTPOk
+
+        export = self._make_export(dbsession, u'failed')
+
+        config.testing_securitypolicy(userid='joe')
+        req.redis = mock.Mock()
+        with mock.patch('transaction.get') as get:
+            res = self._call_fut(export, req)
+        check_csrf_token.assert_called_with(req)
+        assert isinstance(res, HTTPOk)
+        assert export.status == u'pending'
+
+        hook = get.return_value.addAfterCommitHook.call_args[0][0]
+        with mock.patch('occams.tasks.queue_export') as queue:
+            hook(True)
+        queue.assert_called_with(req.redis, export.name, cost=None)
+
+    @pytest.mark.parametrize('status', ['pending', 'complete'])
+    def test_not_failed(self, req, dbsession, config, check_csrf_token,
+                        status):
+        """
+        It should only resume failed exports
+        """
+        from pyramid.httpexceptions import HTTPBadRequest
+
+        export = self._make_export(dbsession, status)
+
+        config.testing_securitypolicy(userid='joe')
+        with pytest.raises(HTTPBadRequest):
+            self._call_fut(export, req)
+
+
 class TestDownload:
 
     def _call_fut(self, *args, **kw):